@@ -0,0 +1,49 @@
+"""
+This module is to benchmark cold versus warm Chrome WebDriver startup.
+
+Usage: python -m benchmarks.driver_startup [-n 3]
+"""
+from __future__ import annotations
+import argparse
+import logging
+import statistics
+import time
+from services.base_service import create_driver, quit_driver
+from utils.chromedriver import MANIFEST_PATH, clear_process_cache, resolve_chromedriver
+
+
+def measure(logger: logging.Logger, cold: bool) -> tuple:
+    """Return (resolve seconds, total startup seconds) for one driver launch"""
+    if cold:
+        MANIFEST_PATH.unlink(missing_ok=True)
+    clear_process_cache()
+
+    start = time.perf_counter()
+    resolve_chromedriver()
+    resolved = time.perf_counter()
+    driver = create_driver(logger)
+    started = time.perf_counter()
+    quit_driver(driver)
+    return resolved - start, started - start
+
+
+def main() -> None:
+    """args command"""
+    parser = argparse.ArgumentParser(description="Benchmark ChromeDriver startup")
+    parser.add_argument('-n', '--runs', type=int, default=3, help="runs per mode")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(message)s', level=logging.WARNING)
+    logger = logging.getLogger(__name__)
+
+    for mode in ('cold', 'warm'):
+        results = [measure(logger, cold=(mode == 'cold')) for _ in range(args.runs)]
+        resolve_times = [r[0] * 1000 for r in results]
+        total_times = [r[1] * 1000 for r in results]
+        print(f"{mode:>4}: resolve median {statistics.median(resolve_times):8.1f} ms | "
+              f"startup median {statistics.median(total_times):8.1f} ms "
+              f"(min {min(total_times):.1f}, max {max(total_times):.1f})")
+
+
+if __name__ == "__main__":
+    main()
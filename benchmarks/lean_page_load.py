@@ -0,0 +1,166 @@
+"""
+This module is to benchmark the lean page-load mode against the default one.
+
+A recorded copy of the reservation page is replayed from a local server so
+both modes load identical bytes:
+
+    python -m benchmarks.lean_page_load record --out recordings/imint
+    python -m benchmarks.lean_page_load run --recording recordings/imint -n 5
+
+`record` saves the reservation document and the scripts, stylesheets and
+images it references (the captcha included) and rewrites their URLs to the
+local server. Third-party URLs (analytics, web fonts) are kept as-is.
+"""
+from __future__ import annotations
+import argparse
+import logging
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urljoin, urlsplit
+import httpx
+import orjson
+from lxml import html as lxml_html
+from configs.config import filenames, user_agent
+from services.base_service import create_driver, driver_options, quit_driver
+from utils.io import load_toml
+
+RESOURCE_XPATH = '//script[@src] | //link[@href] | //img[@src]'
+
+
+def record(out_dir: Path, url: str) -> None:
+    """Save the page and its same-site subresources with a replay manifest"""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    site = urlsplit(url).netloc
+    manifest = {}
+
+    with httpx.Client(headers={'User-Agent': user_agent}, follow_redirects=True, timeout=30) as client:
+        res = client.get(url)
+        tree = lxml_html.fromstring(res.content)
+
+        for index, element in enumerate(tree.xpath(RESOURCE_XPATH)):
+            attr = 'href' if element.tag == 'link' else 'src'
+            absolute = urljoin(str(res.url), element.get(attr))
+            if urlsplit(absolute).netloc != site:
+                continue
+            # Keep the extension so lean-mode URL patterns match like they do live
+            local_path = f'/r/{index}{Path(urlsplit(absolute).path).suffix}'
+            resource = client.get(absolute)
+            (out_dir / local_path.lstrip('/').replace('/', '_')).write_bytes(resource.content)
+            manifest[local_path] = resource.headers.get('content-type', 'application/octet-stream')
+            element.set(attr, local_path)
+
+        (out_dir / 'index.html').write_bytes(lxml_html.tostring(tree, encoding='utf-8'))
+        manifest['/'] = 'text/html; charset=utf-8'
+
+    (out_dir / 'manifest.json').write_bytes(orjson.dumps(manifest))   # pylint: disable=maybe-no-member
+    print(f"Recorded {len(manifest)} files to {out_dir}")
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """Serves a recording and counts the bytes it sends"""
+
+    def __init__(self, recording: Path):
+        self.recording = recording
+        self.manifest = orjson.loads((recording / 'manifest.json').read_bytes())   # pylint: disable=maybe-no-member
+        self.bytes_sent = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+        super().__init__(('127.0.0.1', 0), ReplayHandler)
+
+    def reset_counters(self) -> tuple:
+        """Return and clear (requests, bytes)"""
+        with self.lock:
+            counters = (self.requests, self.bytes_sent)
+            self.requests = self.bytes_sent = 0
+        return counters
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    """Replay handler"""
+
+    def do_GET(self):   # pylint: disable=invalid-name
+        """Serve a recorded file"""
+        path = urlsplit(self.path).path
+        content_type = self.server.manifest.get(path)
+        if not content_type:
+            self.send_error(404)
+            return
+        filename = 'index.html' if path == '/' else path.lstrip('/').replace('/', '_')
+        body = (self.server.recording / filename).read_bytes()
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.bytes_sent += len(body)
+
+    def log_message(self, *args):   # pylint: disable=arguments-differ
+        pass
+
+
+def run(recording: Path, runs: int) -> None:
+    """Load the recording in default and lean mode and compare"""
+    logger = logging.getLogger(__name__)
+    service_config = load_toml(str(filenames.config).format(service='THSRC'))
+    server = ReplayServer(recording)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/'
+
+    try:
+        for lean in (False, True):
+            driver = create_driver(logger, **driver_options(service_config, lean))
+            times, transferred, requests = [], [], []
+            try:
+                for _ in range(runs):
+                    driver.execute_cdp_cmd('Network.clearBrowserCache', {})
+                    server.reset_counters()
+                    start = time.perf_counter()
+                    driver.get(url)
+                    driver.execute_async_script("""
+                        var done = arguments[arguments.length - 1];
+                        (function check() {
+                            var img = document.querySelector('img.captcha-img');
+                            if (img && img.complete && img.naturalWidth > 0) { done(true); }
+                            else { setTimeout(check, 10); }
+                        })();
+                    """)
+                    times.append((time.perf_counter() - start) * 1000)
+                    count, sent = server.reset_counters()
+                    requests.append(count)
+                    transferred.append(sent)
+            finally:
+                quit_driver(driver)
+
+            print(f"{'lean' if lean else 'default':>7}: load median {statistics.median(times):8.1f} ms "
+                  f"(min {min(times):.1f}) | {statistics.median(requests):.0f} requests | "
+                  f"{statistics.median(transferred) / 1024:.1f} KiB")
+    finally:
+        server.shutdown()
+
+
+def main() -> None:
+    """args command"""
+    parser = argparse.ArgumentParser(description="Benchmark lean page-load mode")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    record_parser = subparsers.add_parser('record', help="record the live reservation page")
+    record_parser.add_argument('--out', type=Path, required=True)
+    record_parser.add_argument('--url', default='https://irs.thsrc.com.tw/IMINT/')
+    run_parser = subparsers.add_parser('run', help="replay a recording in both modes")
+    run_parser.add_argument('--recording', type=Path, required=True)
+    run_parser.add_argument('-n', '--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(message)s', level=logging.WARNING)
+    if args.command == 'record':
+        record(args.out, args.url)
+    else:
+        run(args.recording, args.runs)
+
+
+if __name__ == "__main__":
+    main()
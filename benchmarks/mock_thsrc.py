@@ -0,0 +1,522 @@
+"""
+This module is a local stand-in for the THSRC booking site, for end-to-end
+latency benchmarks and regression runs without irs.thsrc.com.tw.
+
+It serves the Wicket flow services/thsrc.py and services/thsrc_http.py
+drive: the S1 booking form with `img.captcha-img` and its ajax refresh
+link, `feedbackPanelERROR` responses, the `TrainQueryDataViewPanel` train
+list, the S2 passenger form and the PNR page. Every response is delayed by
+a log-normal latency; captchas are accepted with a configurable rate, the
+first searches can be sold out and dates beyond the bookable range are
+rejected. A holey.cc-compatible OCR endpoint (`POST /ocr`) answers from
+the captchas it served, so whole-flow runs need no network:
+
+    python -m benchmarks.mock_thsrc serve --port 8090 --accept-rate 0.7
+    THSRC_BASE_URL=http://127.0.0.1:8090 python ticket_bot.py thsrc-http -a
+    python -m benchmarks.mock_thsrc run --service thsrc-http -n 10
+
+THSRC_BASE_URL rebases the site URLs of configs/THSRC.toml (see
+services.base_service.rebase_urls). `run` does that in-process, points the
+OCR at the mock too and reports time to PNR per booking.
+"""
+from __future__ import annotations
+import argparse
+import base64
+import hashlib
+import html
+import io
+import logging
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from argparse import Namespace
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import NamedTuple, Optional
+from urllib.parse import parse_qs, urlsplit
+import orjson
+from configs.config import fields as user_fields, filenames
+from utils.io import load_toml
+from utils.local_ocr import CHARSET
+
+STATIONS = ['Nangang', 'Taipei', 'Banqiao', 'Taoyuan', 'Hsinchu', 'Miaoli', 'Taichung',
+            'Changhua', 'Yunlin', 'Chiayi', 'Tainan', 'Zuouing']
+TICKET_CODES = ['F', 'H', 'W', 'E', 'P', 'T']
+
+CAPTCHA_ERROR = '檢測碼輸入錯誤，請確認後重新輸入，謝謝！'
+SOLD_OUT_ERROR = '去程查無可售車次或選購的車票已售完，請重新輸入訂票條件。'
+DATE_ERROR = '選擇的日期超過目前開放預訂之日期，請重新選擇。'
+
+PAGE = """<!DOCTYPE html>
+<html lang="zh-TW"><head><meta charset="utf-8"><title>THSRC (mock)</title>
+<script>
+function wicketAjaxGet(url) {{
+    fetch(url + '&random=' + Math.random(), {{headers: {{'Wicket-Ajax': 'true'}}}})
+        .then(function (res) {{ return res.text(); }})
+        .then(function (text) {{
+            var markup = /<!\\[CDATA\\[([\\s\\S]*?)\\]\\]>/.exec(text)[1];
+            document.querySelector('img.captcha-img').outerHTML = markup;
+        }});
+    return false;
+}}
+</script></head>
+<body>{errors}{body}</body></html>
+"""
+
+S1_FORM = """<form id="BookingS1Form" method="post" action="/IMINT/;jsessionid={session}?wicket:interface=:0:BookingS1Form::IFormSubmitListener">
+<input type="hidden" name="BookingS1Form:hf:0" value="">
+<select name="selectStartStation">{stations}</select>
+<select name="selectDestinationStation">{stations}</select>
+<input type="radio" name="bookingMethod" value="radio31" checked> <input type="radio" name="bookingMethod" value="radio33">
+<input type="text" name="toTimeInputField" value="{today}">
+<select name="toTimeTable">{times}</select>
+<input type="text" name="toTrainIDInputField" value="">
+<input type="radio" name="trainCon:trainRadioGroup" value="0" checked> <input type="radio" name="trainCon:trainRadioGroup" value="1">
+<input type="radio" name="seatCon:seatRadioGroup" value="radio17" checked> <input type="radio" name="seatCon:seatRadioGroup" value="radio19"> <input type="radio" name="seatCon:seatRadioGroup" value="radio21">
+{tickets}
+<span id="BookingS1Form_homeCaptcha_passCode">{captcha}</span>
+<a id="BookingS1Form_homeCaptcha_reCodeLink" href="#" onclick="return wicketAjaxGet('/IMINT/;jsessionid={session}?wicket:interface=:0:BookingS1Form:homeCaptcha:reCodeLink::IBehaviorListener&amp;wicket:behaviorId=0');">refresh</a>
+<input type="text" name="homeCaptcha:securityCode" value="">
+<input type="submit" name="SubmitButton" value="開始查詢">
+</form>"""
+
+CAPTCHA_IMG = ('<img class="captcha-img" alt="captcha" '
+               'src="/IMINT/;jsessionid={session}?wicket:interface=:0:BookingS1Form:homeCaptcha:passCode::IResourceListener&amp;wicket:antiCache={serial}">')
+
+TRAIN = """<label><input type="radio" name="TrainQueryDataViewPanel:TrainGroup" value="radio{index}" querydeparture="{departure}" queryarrival="{arrival}"></label>
+<div><div class="duration">schedule{duration}|directions_railway{no}</div><div class="discount">{discount}</div></div>"""
+
+S2_FORM = """<form id="BookingS2Form" method="post" action="/IMINT/?wicket:interface=:1:BookingS2Form::IFormSubmitListener">
+<input type="hidden" name="BookingS2Form:hf:0" value="">
+<div id="TrainQueryDataViewPanel">{trains}</div>
+<input type="submit" name="SubmitButton" value="確認車次">
+</form>"""
+
+S3_FORM = """<form id="BookingS3Form" method="post" action="/IMINT/?wicket:interface=:2:BookingS3Form::IFormSubmitListener">
+<input type="hidden" name="BookingS3Form:hf:0" value="">
+<input type="radio" name="idInputRadio" value="0" checked>
+<input type="text" name="dummyId" value="">
+<input type="text" name="dummyPhone" value="">
+<input type="text" name="email" value="">
+<input type="text" name="TicketPassengerInfoInputPanel:passengerDataView:0:passengerDataView2:passengerDataIdNumber" value="">
+<input type="radio" name="TicketMemberSystemInputPanel:TakerMemberSystemDataView:memberSystemRadioGroup" value="" checked>
+<input type="radio" name="TicketMemberSystemInputPanel:TakerMemberSystemDataView:memberSystemRadioGroup" value="radio56">
+<input type="text" name="TicketMemberSystemInputPanel:TakerMemberSystemDataView:memberSystemRadioGroup:memberShipNumber" value="">
+<input type="checkbox" name="agree" value="on">
+<input type="submit" name="SubmitButton" value="完成訂位">
+</form>"""
+
+PNR_PAGE = """<div class="ticket-summary">
+<p class="pnr-code">{pnr}</p><p class="payment-status">未付款</p>
+<div class="car-type"><p class="info-data">標準車廂</p></div>
+<div class="ticket-type"><div>全票 {count}</div></div>
+<span id="setTrainTotalPriceValue">TWD {price}</span>
+<div class="ticket-card"><span class="date">{date}</span><span id="setTrainCode0">{no}</span>
+<p class="departure-time">{departure}</p><p class="departure-stn">{start}</p>
+<p class="arrival-time">{arrival}</p><p class="arrival-stn">{dest}</p>
+<span id="InfoEstimatedTime0">{duration}</span></div>
+<div class="detail">{seats}</div>
+</div>"""
+
+
+class Latency(NamedTuple):
+    """Log-normal response delay"""
+    median_ms: float
+    jitter: float
+
+    @classmethod
+    def parse(cls, text: str) -> Latency:
+        """MEDIAN_MS[:JITTER]"""
+        values = [float(value) for value in text.split(':')]
+        return cls(*(values + [0.3][len(values) - 1:]))
+
+    def sample(self, rng: random.Random) -> float:
+        """Seconds"""
+        return self.median_ms / 1000 * math.exp(rng.gauss(0, self.jitter))
+
+
+class Session:
+    """Server-side state of one booking session"""
+
+    def __init__(self, session_id: str):
+        self.id = session_id
+        self.answer = ''
+        self.serial = 0
+        self.search = None
+        self.train = None
+
+
+class MockTHSRC(ThreadingHTTPServer):
+    """Stand-in THSRC site (Wicket booking flow) plus a holey.cc-style OCR endpoint"""
+
+    def __init__(self, port: int = 0, latency: Latency = Latency(80, 0.3), accept_rate: float = 0.8,
+                 sold_out: int = 0, bookable_days: int = 28, ocr_latency: Latency = Latency(150, 0.3),
+                 ocr_accuracy: float = 0.9, seed: int = 0):
+        self.latency = latency
+        self.accept_rate = accept_rate
+        self.sold_out = sold_out
+        self.bookable_days = bookable_days
+        self.ocr_latency = ocr_latency
+        self.ocr_accuracy = ocr_accuracy
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.answers = {}   # sha256 of captcha bytes -> answer
+        self.counts = {'pages': 0, 'captchas': 0, 'refreshes': 0, 'searches': 0, 'rejected': 0,
+                       'sold_out': 0, 'bookings': 0, 'ocr': 0}
+        self.times = load_toml(str(filenames.config).format(service='THSRC'))['available-timetable']
+        super().__init__(('127.0.0.1', port), MockHandler)
+
+    @property
+    def url(self) -> str:
+        """Base URL of the server"""
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def draw(self, low: float = 0.0, high: float = 1.0) -> float:
+        """Shared seeded random number"""
+        with self.lock:
+            return self.rng.uniform(low, high)
+
+    def delay(self, latency: Latency) -> None:
+        """Sleep one sampled response time"""
+        with self.lock:
+            seconds = latency.sample(self.rng)
+        time.sleep(seconds)
+
+    def count(self, key: str) -> None:
+        """Bump a request counter"""
+        with self.lock:
+            self.counts[key] += 1
+
+    def new_session(self) -> Session:
+        """Start a booking session"""
+        session = Session(uuid.uuid4().hex[:24].upper())
+        with self.lock:
+            self.sessions[session.id] = session
+        return session
+
+    def new_captcha(self, session: Session) -> str:
+        """Pick a new answer for the session and return its <img>"""
+        with self.lock:
+            session.answer = ''.join(self.rng.choice(CHARSET) for _ in range(4))
+            session.serial += 1
+        return CAPTCHA_IMG.format(session=session.id, serial=session.serial)
+
+    def captcha_image(self, session: Session) -> bytes:
+        """PNG of the session's current answer (remembered for the OCR endpoint)"""
+        from PIL import Image, ImageDraw
+        image = Image.new('L', (140, 48), 255)
+        draw = ImageDraw.Draw(image)
+        for index, char in enumerate(session.answer):
+            draw.text((16 + index * 28, 16 + (index % 2) * 4), char, fill=0)
+        draw.arc((-20, 10, 160, 70), 200, 340, fill=60, width=2)
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG')
+        data = buffer.getvalue()
+        with self.lock:
+            self.answers[hashlib.sha256(data).hexdigest()] = session.answer
+        return data
+
+    def ocr(self, image_data: bytes) -> str:
+        """holey.cc-style answer: the served label, or a wrong character"""
+        self.count('ocr')
+        self.delay(self.ocr_latency)
+        answer = self.answers.get(hashlib.sha256(image_data).hexdigest(), 'AAAA')
+        if self.draw() < self.ocr_accuracy:
+            return answer
+        with self.lock:
+            index = self.rng.randrange(len(answer))
+            wrong = self.rng.choice([char for char in CHARSET if char != answer[index]])
+        return answer[:index] + wrong + answer[index + 1:]
+
+    def s1_page(self, session: Session, errors: tuple = ()) -> str:
+        """Booking form with a fresh captcha"""
+        stations = ''.join(f'<option value="{index}">{name}</option>' for index, name in enumerate(STATIONS, 1))
+        times = ''.join(f'<option value="{value}">{value}</option>' for value in self.times)
+        tickets = ''.join(
+            f'<select name="ticketPanel:rows:{row}:ticketAmount">'
+            + ''.join(f'<option value="{count}{code}"{" selected" if count == int(row == 0) else ""}>{count}</option>'
+                      for count in range(11))
+            + '</select>'
+            for row, code in enumerate(TICKET_CODES))
+        body = S1_FORM.format(session=session.id, stations=stations, times=times, tickets=tickets,
+                              today=date.today().strftime('%Y/%m/%d'), captcha=self.new_captcha(session))
+        return self.page(body, errors)
+
+    @staticmethod
+    def page(body: str, errors: tuple = ()) -> str:
+        """Full document, with a feedback panel for errors"""
+        panel = ''
+        if errors:
+            panel = '<ul class="feedbackPanel">' + ''.join(
+                f'<li class="feedbackPanelERROR"><span>{html.escape(error)}</span></li>' for error in errors) + '</ul>'
+        return PAGE.format(errors=panel, body=body)
+
+    def search(self, session: Session, form: dict) -> str:
+        """S1 submit: date range, captcha, availability; then the train list"""
+        self.count('searches')
+        try:
+            travel_date = datetime.strptime(form.get('toTimeInputField', ''), '%Y/%m/%d').date()
+        except ValueError:
+            travel_date = date.today()
+        if travel_date > date.today() + timedelta(days=self.bookable_days):
+            return self.s1_page(session, (DATE_ERROR,))
+        if self.draw() >= self.accept_rate or not form.get('homeCaptcha:securityCode'):
+            self.count('rejected')
+            return self.s1_page(session, (CAPTCHA_ERROR,))
+        with self.lock:
+            sold_out = self.counts['sold_out'] < self.sold_out
+            if sold_out:
+                self.counts['sold_out'] += 1
+        if sold_out:
+            return self.s1_page(session, (SOLD_OUT_ERROR,))
+
+        session.search = form
+        departure = datetime.combine(travel_date, datetime.min.time()) + timedelta(hours=12, minutes=11)
+        trains = []
+        for index in range(6):
+            start = departure + timedelta(minutes=25 * index)
+            duration = timedelta(minutes=95 + 10 * (index % 3))
+            trains.append(TRAIN.format(
+                index=18 + index, departure=start.strftime('%H:%M'), arrival=(start + duration).strftime('%H:%M'),
+                duration=f'{duration.seconds // 3600:02d}:{duration.seconds % 3600 // 60:02d}',
+                no=f'{600 + index * 4:04d}', discount='早鳥65折' if index == 2 else ''))
+        if form.get('bookingMethod') == 'radio33':
+            session.train = form.get('toTrainIDInputField')
+            return self.page(S3_FORM)
+        return self.page(S2_FORM.format(trains=''.join(trains)))
+
+    def confirm_train(self, session: Session, form: dict) -> str:
+        """S2 submit: the passenger form"""
+        choice = form.get('TrainQueryDataViewPanel:TrainGroup')
+        if not choice:
+            return self.page('', ('請選擇車次',))
+        session.train = choice
+        return self.page(S3_FORM)
+
+    def confirm_ticket(self, session: Session, form: dict) -> str:
+        """S3 submit: the PNR page"""
+        if not form.get('dummyId') or form.get('agree') != 'on':
+            return self.page(S3_FORM, ('請輸入身分證字號並同意訂位規定',))
+        self.count('bookings')
+        search = session.search or {}
+        count = sum(int(re.match(r'\d+', value).group()) for key, value in search.items()
+                    if key.startswith('ticketPanel:rows:') and re.match(r'\d+', value)) or 1
+        start = STATIONS[int(search.get('selectStartStation', 2)) - 1]
+        dest = STATIONS[int(search.get('selectDestinationStation', 12)) - 1]
+        seats = ''.join(f'<div class="seat-label">7車{index + 1}A</div>' for index in range(count))
+        return self.page(PNR_PAGE.format(
+            pnr=f'{int(self.draw(0, 1e8)):08d}', count=count, price=1490 * count,
+            date=search.get('toTimeInputField', ''), no='0608', departure='12:36', arrival='14:21',
+            start=start, dest=dest, duration='01:45', seats=seats))
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Routes by path and wicket:interface like the real site"""
+
+    server: MockTHSRC
+
+    def session(self) -> Optional[Session]:
+        """Session from the URL (;jsessionid=) or the JSESSIONID cookie"""
+        match = re.search(r';jsessionid=([^?;/]+)', self.path, re.IGNORECASE)
+        session_id = match.group(1) if match else None
+        if not session_id:
+            match = re.search(r'JSESSIONID=([^;\s]+)', self.headers.get('Cookie', ''))
+            session_id = match.group(1) if match else None
+        return self.server.sessions.get(session_id)
+
+    def interface(self) -> str:
+        """The wicket:interface (or bookmarkable page) of the request"""
+        query = parse_qs(urlsplit(self.path).query)
+        return (query.get('wicket:interface') or query.get('wicket:bookmarkablePage') or [''])[0]
+
+    def do_GET(self):   # pylint: disable=invalid-name
+        """Booking page, captcha image, captcha refresh"""
+        interface = self.interface()
+        session = self.session()
+        self.server.delay(self.server.latency)
+        if not interface:
+            session = self.server.new_session()
+            self.server.count('pages')
+            self._send(200, self.server.s1_page(session), cookie=session.id)
+        elif session is None:
+            self._send(200, self.server.page('', ('連線逾時，請重新訂位',)))
+        elif 'homeCaptcha:passCode' in interface:
+            self.server.count('captchas')
+            self._send(200, self.server.captcha_image(session), content_type='image/png')
+        elif 'reCodeLink' in interface:
+            self.server.count('refreshes')
+            component = self.server.new_captcha(session)
+            self._send(200, '<?xml version="1.0" encoding="UTF-8"?><ajax-response>'
+                            f'<component id="BookingS1Form_homeCaptcha_passCode"><![CDATA[{component}]]></component>'
+                            '</ajax-response>', content_type='text/xml')
+        else:
+            self._send(200, self.server.page('<p>mock</p>'))
+
+    def do_POST(self):   # pylint: disable=invalid-name
+        """Form submits and the OCR endpoint"""
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if urlsplit(self.path).path == '/ocr':
+            payload = orjson.loads(body)   # pylint: disable=maybe-no-member
+            encoded = payload['base64_str'].replace('-', '+').replace('_', '/')
+            answer = self.server.ocr(base64.b64decode(encoded + '=' * (-len(encoded) % 4)))
+            self._send(200, orjson.dumps({'data': answer}), content_type='application/json')   # pylint: disable=maybe-no-member
+            return
+
+        self.server.delay(self.server.latency)
+        session = self.session()
+        form = {key: values[-1] for key, values in parse_qs(body.decode(), keep_blank_values=True).items()}
+        interface = self.interface()
+        if session is None:
+            self._send(200, self.server.page('', ('連線逾時，請重新訂位',)))
+        elif 'BookingS1Form' in interface:
+            self._send(200, self.server.search(session, form))
+        elif 'BookingS2Form' in interface:
+            self._send(200, self.server.confirm_train(session, form))
+        elif 'BookingS3Form' in interface:
+            self._send(200, self.server.confirm_ticket(session, form))
+        else:
+            self._send(404, self.server.page('', ('Not found',)))
+
+    def _send(self, status: int, body, content_type: str = 'text/html; charset=utf-8',
+              cookie: Optional[str] = None) -> None:
+        data = body.encode() if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        if cookie:
+            self.send_header('Set-Cookie', f'JSESSIONID={cookie}; Path=/IMINT')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):   # pylint: disable=arguments-differ
+        pass
+
+
+def prepare(server: MockTHSRC, service: str) -> tuple:
+    """Point a service_map entry at the mock; returns the entry and its config"""
+    from services import service_map
+    entry = next(entry for entry in service_map if entry['keyword'] == service)
+    os.environ['THSRC_BASE_URL'] = server.url
+    config = load_toml(str(filenames.config).format(service=entry['name']))
+    config['api']['captcha_ocr'] = f'{server.url}/ocr'
+    config.setdefault('captcha', {}).update({'record': False, 'engine-order': 'holey-first'})
+
+    # A bookable date, auto pick, no prompts
+    user_fields[entry['name']].update({
+        'outbound-date': str(date.today() + timedelta(days=7)), 'inbound-time': '',
+        'id': user_fields[entry['name']].get('id') or 'A123456789'})
+    return entry, config
+
+
+def percentile(values: list, fraction: float) -> float:
+    """Nearest-rank percentile of a sorted list"""
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(server: MockTHSRC, service: str, bookings: int) -> None:
+    """Book `bookings` tickets against the mock in-process and report time to PNR"""
+    entry, config = prepare(server, service)
+    log = logging.getLogger(entry['class'].__module__)
+    timings = []
+    for _ in range(bookings):
+        args = Namespace(log=log, config=config, service=entry['name'], locale=None, auto=True, list=False)
+        start = time.perf_counter()
+        bot = entry['class'](args)
+        try:
+            bot.main()
+        except SystemExit as e:
+            # main() exits with 0 after a booking
+            if e.code:
+                continue
+        finally:
+            bot.close()
+        timings.append(time.perf_counter() - start)
+
+    print(f"{service}: {len(timings)}/{bookings} bookings completed")
+    if timings:
+        timings.sort()
+        print(f"time to PNR: p50 {timings[len(timings) // 2]:.3f}s, max {timings[-1]:.3f}s, "
+              f"mean {sum(timings) / len(timings):.3f}s")
+    print(f"server: {server.counts}")
+
+
+def race(server: MockTHSRC, service: str, sessions: list, races: int) -> None:
+    """
+    Run `races` booking races per session count and report the time to
+    success distribution next to what the extra sessions cost
+    """
+    from services.race import BookingRace
+    entry, config = prepare(server, service)
+    log = logging.getLogger(entry['class'].__module__)
+    print(f"{'N':>3} {'won':>5} {'p50 s':>7} {'p90 s':>7} {'PNR p50 s':>9} {'submits':>8} {'OCR calls':>9} {'CPU s':>6}")
+    for count in sessions:
+        reports = []
+        for _ in range(races):
+            args = Namespace(log=log, config=config, service=entry['name'], locale=None, auto=True, list=False)
+            reports.append(BookingRace(entry['class'], args, count).run())
+        won = [report for report in reports if report['winner'] is not None]
+        success = sorted(report['time_to_success'] for report in won) or [float('nan')]
+        finish = sorted(report['time_to_finish'] for report in won) or [float('nan')]
+        cpu = [report['cpu_seconds'] for report in reports if report['cpu_seconds'] is not None]
+        print(f"{count:>3} {len(won):>2}/{races:<2} {percentile(success, 0.5):>7.3f} {percentile(success, 0.9):>7.3f} "
+              f"{percentile(finish, 0.5):>9.3f} "
+              f"{sum(report['submits'] for report in reports) / races:>8.1f} "
+              f"{sum(report['ocr_calls'] for report in reports) / races:>9.1f} "
+              f"{sum(cpu) / len(cpu) if cpu else float('nan'):>6.2f}")
+    print(f"server: {server.counts}")
+
+
+def main() -> None:
+    """args command"""
+    parser = argparse.ArgumentParser(description="Local stand-in for the THSRC booking site")
+    parser.add_argument('--latency', type=Latency.parse, default=Latency(80, 0.3),
+                        help="page response MEDIAN_MS[:JITTER] (default 80:0.3)")
+    parser.add_argument('--accept-rate', type=float, default=0.8, help="probability a captcha is accepted")
+    parser.add_argument('--sold-out', type=int, default=0, help="answer the first N searches with sold out")
+    parser.add_argument('--bookable-days', type=int, default=28, help="dates further out are rejected")
+    parser.add_argument('--ocr-latency', type=Latency.parse, default=Latency(150, 0.3),
+                        help="OCR endpoint MEDIAN_MS[:JITTER] (default 150:0.3)")
+    parser.add_argument('--ocr-accuracy', type=float, default=0.9)
+    parser.add_argument('--seed', type=int, default=0)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help="serve until interrupted")
+    serve_parser.add_argument('--port', type=int, default=8090)
+    run_parser = subparsers.add_parser('run', help="book against the mock in-process and report timings")
+    run_parser.add_argument('--service', default='thsrc-http', help="service_map keyword (default thsrc-http)")
+    run_parser.add_argument('-n', '--bookings', type=int, default=5)
+    race_parser = subparsers.add_parser('race', help="race N sessions per booking and report time to success by N")
+    race_parser.add_argument('--service', default='thsrc-http', help="service_map keyword (default thsrc-http)")
+    race_parser.add_argument('--sessions', type=int, nargs='+', default=[1, 2, 4], help="session counts to compare")
+    race_parser.add_argument('-n', '--races', type=int, default=5, help="races per session count")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(message)s', level=logging.WARNING)
+    server = MockTHSRC(getattr(args, 'port', 0), args.latency, args.accept_rate, args.sold_out,
+                       args.bookable_days, args.ocr_latency, args.ocr_accuracy, args.seed)
+    if args.command == 'serve':
+        print(f"Mock THSRC on {server.url}/IMINT/ (OCR: POST {server.url}/ocr)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        if args.command == 'race':
+            race(server, args.service, args.sessions, args.races)
+        else:
+            run(server, args.service, args.bookings)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
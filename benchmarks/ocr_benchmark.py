@@ -0,0 +1,317 @@
+"""
+This module is to benchmark the captcha OCR engines and recognition policies.
+
+Labelled captchas come from a directory (files named after their answer) or
+from the captcha store. Unless --live is given, holey.cc and Gemini are
+replaced by a local stand-in server that answers from the labels with a
+configurable accuracy, error rate and log-normal latency, so policy changes
+can be compared on identical, reproducible traffic:
+
+    python -m benchmarks.ocr_benchmark --data captchas/ -c 4
+    python -m benchmarks.ocr_benchmark --store .cache/captchas.sqlite3 --gemini 600:0.4:0.97
+    python -m benchmarks.ocr_benchmark --data captchas/ --live --policies holey gemini-first
+    python -m benchmarks.ocr_benchmark --data captchas/ --live --preprocess holey=clean,gemini=clean
+
+Every policy runs with a fresh CaptchaOCR (empty cache, engine stats
+starting from the priors). Answers and latencies of the stand-in are a
+deterministic function of engine and image, so each policy sees the same
+engine behaviour. Adaptive policies get the label as the server verdict;
+with concurrency above 1 the attempts credited to a verdict are approximate.
+
+Each policy also runs with the engine inputs of --preprocess (the cleaned
+image for both remote engines by default), and first-try accuracy of both
+settings is printed side by side. The stand-in knows the answer for either
+input, so only --live shows what preprocessing does to accuracy.
+"""
+from __future__ import annotations
+import argparse
+import base64
+import hashlib
+import logging
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import NamedTuple
+import orjson
+from utils.captcha_ocr import CaptchaOCR, ENGINE_LABELS, EngineTracker, PreparedCaptcha
+from utils.captcha_store import iter_labelled
+from utils.local_ocr import CHARSET, load_labelled
+
+# USD per engine call (Gemini 2.0 Flash: ~360 input tokens per captcha)
+DEFAULT_COSTS = {'local': 0.0, 'holey': 0.0, 'gemini': 0.00004}
+
+POLICIES = {
+    'local': lambda ocr, image, args: ocr._run_engine('local', image),   # pylint: disable=protected-access
+    'holey': lambda ocr, image, args: ocr._run_engine('holey', image),   # pylint: disable=protected-access
+    'gemini': lambda ocr, image, args: ocr._run_engine('gemini', image),   # pylint: disable=protected-access
+    'holey-first': lambda ocr, image, args: ocr.recognize(image, use_gemini_first=False),
+    'gemini-first': lambda ocr, image, args: ocr.recognize(image, use_gemini_first=True),
+    'hedged': lambda ocr, image, args: ocr.recognize_hedged(image, use_gemini_first=True),
+    'hedged-delay': lambda ocr, image, args: ocr.recognize_hedged(
+        image, use_gemini_first=False, hedge_delay=args.hedge_delay),
+    'adaptive': lambda ocr, image, args: ocr.recognize(image),
+    'hedged-auto': lambda ocr, image, args: ocr.recognize_hedged(image, hedge_delay=None),
+}
+# Policies whose engine choice learns from verdicts
+ADAPTIVE_POLICIES = ('adaptive', 'hedged-auto')
+
+
+class EngineProfile(NamedTuple):
+    """Stand-in behaviour of one remote engine"""
+    median_ms: float
+    jitter: float       # sigma of the log-normal latency
+    accuracy: float     # probability of the right answer
+    error_rate: float   # probability of an HTTP error (quota, 5xx)
+
+    @classmethod
+    def parse(cls, text: str) -> EngineProfile:
+        """MEDIAN_MS[:JITTER[:ACCURACY[:ERROR_RATE]]]"""
+        values = [float(value) for value in text.split(':')]
+        defaults = [0.0, 0.3, 0.9, 0.0]
+        return cls(*(values + defaults[len(values):]))
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Answers holey.cc and Gemini generateContent requests from the labels"""
+
+    def __init__(self, profiles: dict, seed: int = 0):
+        self.profiles = profiles
+        self.seed = seed
+        self.answers = {}   # sha256 of image bytes -> label
+        self.requests = {name: 0 for name in profiles}
+        self.lock = threading.Lock()
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+
+    @property
+    def url(self) -> str:
+        """Base URL of the server"""
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def register(self, image_data: bytes, label: str) -> None:
+        """Make the server know the answer for these exact bytes"""
+        self.answers[hashlib.sha256(image_data).hexdigest()] = label
+
+    def respond(self, engine: str, image_data: bytes) -> tuple:
+        """Deterministic (latency seconds, answer or None for an HTTP error) for an engine and image"""
+        with self.lock:
+            self.requests[engine] += 1
+        digest = hashlib.sha256(image_data).hexdigest()
+        profile = self.profiles[engine]
+        rng = random.Random(f'{self.seed}:{engine}:{digest}')
+        latency = profile.median_ms / 1000 * math.exp(rng.gauss(0, profile.jitter))
+        if rng.random() < profile.error_rate:
+            return latency, None
+        label = self.answers.get(digest)
+        if label is None:
+            return latency, ''.join(rng.choice(CHARSET) for _ in range(4))
+        if rng.random() < profile.accuracy:
+            return latency, label
+        index = rng.randrange(len(label))
+        wrong = rng.choice([char for char in CHARSET if char != label[index]])
+        return latency, label[:index] + wrong + label[index + 1:]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Stand-in handler"""
+
+    def do_HEAD(self):   # pylint: disable=invalid-name
+        """Connection warm-up"""
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):   # pylint: disable=invalid-name
+        """holey.cc: {'base64_str'} -> {'data'}; Gemini REST: generateContent"""
+        body = orjson.loads(self.rfile.read(int(self.headers['Content-Length'])))   # pylint: disable=maybe-no-member
+        if ':generateContent' in self.path:
+            engine = 'gemini'
+            parts = body['contents'][-1]['parts']
+            inline = next(part.get('inlineData') or part.get('inline_data')
+                          for part in parts if 'inlineData' in part or 'inline_data' in part)
+            image_data = base64.b64decode(inline['data'])
+        else:
+            engine = 'holey'
+            encoded = body['base64_str'].replace('-', '+').replace('_', '/')
+            image_data = base64.b64decode(encoded + '=' * (-len(encoded) % 4))
+
+        latency, answer = self.server.respond(engine, image_data)
+        time.sleep(latency)
+        if answer is None:
+            self._send(429, {'error': {'code': 429, 'message': 'Resource has been exhausted', 'status': 'RESOURCE_EXHAUSTED'}})
+        elif engine == 'gemini':
+            self._send(200, {'candidates': [{'content': {'parts': [{'text': answer}], 'role': 'model'},
+                                             'finishReason': 'STOP', 'index': 0}]})
+        else:
+            self._send(200, {'data': answer})
+
+    def _send(self, status: int, payload: dict) -> None:
+        body = orjson.dumps(payload)   # pylint: disable=maybe-no-member
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):   # pylint: disable=arguments-differ
+        pass
+
+
+def percentile(values: list, fraction: float) -> float:
+    """Nearest-rank percentile"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def run_policy(name: str, samples: list, args, holey_url: str, variants: dict = None) -> dict:
+    """Recognize every sample with one policy (and engine inputs) and summarize it"""
+    tracker = EngineTracker(Path(args.stats_dir) / f'{name}.json')
+    ocr = CaptchaOCR(holey_url, local_weights=args.local_weights, tracker=tracker, variants=variants)
+    policy = POLICIES[name]
+    if name in ENGINE_LABELS and name not in ocr.engines:
+        ocr.close()
+        return None
+    ocr.warm_up()
+
+    def solve(sample: tuple) -> tuple:
+        label, image_data = sample
+        start = time.perf_counter()
+        result = policy(ocr, image_data, args)
+        elapsed = time.perf_counter() - start
+        correct = bool(result) and result.upper() == label
+        if result and name in ADAPTIVE_POLICIES:
+            ocr.report_verdict(list(ocr.last_attempts), result, correct)
+        return elapsed, correct
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            results = list(executor.map(solve, samples))
+        elapsed = time.perf_counter() - start
+        calls = {engine: stat['calls'] for engine, stat in ocr.engine_stats.items()}
+    finally:
+        ocr.close()
+
+    latencies = [latency * 1000 for latency, _ in results]
+    correct = sum(ok for _, ok in results)
+    cost = sum(args.costs.get(engine, 0.0) * count for engine, count in calls.items())
+    return {
+        'policy': name,
+        'accuracy': correct / len(samples),
+        'p50': percentile(latencies, 0.50),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+        'throughput': len(samples) / elapsed,
+        'calls': calls,
+        'cost_per_correct': cost / correct if correct else float('inf'),
+    }
+
+
+def parse_costs(items: list) -> dict:
+    """ENGINE=USD pairs on top of the defaults"""
+    costs = dict(DEFAULT_COSTS)
+    for item in items or []:
+        engine, _, value = item.partition('=')
+        costs[engine] = float(value)
+    return costs
+
+
+def parse_variants(text: str) -> dict:
+    """ENGINE=VARIANT[,ENGINE=VARIANT...], e.g. holey=clean,gemini=clean ('' for none)"""
+    variants = {}
+    for item in filter(None, text.split(',')):
+        engine, _, variant = item.partition('=')
+        if engine not in ('holey', 'gemini') or variant not in ('original', 'clean'):
+            raise argparse.ArgumentTypeError(f"expected holey|gemini=original|clean, got {item!r}")
+        variants[engine] = variant
+    return variants
+
+
+def format_variants(variants: dict) -> str:
+    """Short label for a set of engine inputs"""
+    return ','.join(f'{engine}={variant}' for engine, variant in variants.items()) if variants else 'default'
+
+
+def main() -> None:
+    """args command"""
+    parser = argparse.ArgumentParser(description="Benchmark captcha OCR engines and policies")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--data', type=Path, help="directory of labelled captcha images")
+    source.add_argument('--store', type=Path, help="captcha store database (accepted captchas)")
+    parser.add_argument('-n', '--limit', type=int, help="use at most N captchas")
+    parser.add_argument('-c', '--concurrency', type=int, default=1)
+    parser.add_argument('--policies', nargs='+', choices=list(POLICIES), default=list(POLICIES))
+    parser.add_argument('--hedge-delay', type=float, default=0.3, help="seconds, for the hedged-delay policy")
+    parser.add_argument('--holey', type=EngineProfile.parse, default=EngineProfile(150, 0.3, 0.85, 0.0),
+                        help="stand-in MEDIAN_MS:JITTER:ACCURACY:ERROR_RATE (default 150:0.3:0.85:0)")
+    parser.add_argument('--gemini', type=EngineProfile.parse, default=EngineProfile(900, 0.4, 0.95, 0.0),
+                        help="stand-in MEDIAN_MS:JITTER:ACCURACY:ERROR_RATE (default 900:0.4:0.95:0)")
+    parser.add_argument('--cost', action='append', metavar='ENGINE=USD', help="cost per engine call")
+    parser.add_argument('--local-weights', help="local OCR weights (default .cache/local_ocr.npz)")
+    parser.add_argument('--preprocess', type=parse_variants, default='holey=clean,gemini=clean',
+                        metavar='ENGINE=VARIANT,...',
+                        help="engine inputs compared against the defaults (default holey=clean,gemini=clean; "
+                             "'' runs the defaults only)")
+    parser.add_argument('--live', action='store_true', help="use the real holey.cc and Gemini")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    args.costs = parse_costs(args.cost)
+
+    logging.basicConfig(format='%(message)s', level=logging.WARNING)
+    samples = load_labelled(args.data) if args.data else list(iter_labelled(args.store))
+    samples = samples[:args.limit] if args.limit else samples
+    if not samples:
+        parser.error("no labelled captchas found")
+
+    server = None
+    holey_url = None
+    if not args.live:
+        server = StandInServer({'holey': args.holey, 'gemini': args.gemini}, seed=args.seed)
+        for label, image_data in samples:
+            server.register(image_data, label)
+            server.register(PreparedCaptcha(image_data).get('clean'), label)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        holey_url = f'{server.url}/thsrc'
+        os.environ['GEMINI_API_ENDPOINT'] = server.url
+        os.environ.setdefault('GEMINI_API_KEY', 'benchmark')
+
+    print(f"{len(samples)} captchas, concurrency {args.concurrency}, "
+          f"{'live engines' if args.live else 'stand-in engines'}")
+    settings = [{}] + ([args.preprocess] if args.preprocess else [])
+    print(f"{'policy':<13}{'input':<26}{'accuracy':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'per s':>8}{'$/correct':>11}  calls")
+    accuracy = {}
+    try:
+        for name in args.policies:
+            # The local engine always gets the input its weights were trained on
+            for variants in settings[:1] if name == 'local' else settings:
+                label = format_variants(variants)
+                with tempfile.TemporaryDirectory() as args.stats_dir:
+                    result = run_policy(name, samples, args, holey_url, variants or None)
+                if result is None:
+                    print(f"{name:<13}{label:<26} (engine not available)")
+                    break
+                accuracy.setdefault(name, []).append(result['accuracy'])
+                calls = ', '.join(f'{engine}={count}' for engine, count in result['calls'].items())
+                print(f"{name:<13}{label:<26}{result['accuracy']:>9.1%}{result['p50']:>9.0f}{result['p95']:>9.0f}"
+                      f"{result['p99']:>9.0f}{result['throughput']:>8.1f}{result['cost_per_correct']:>11.6f}  {calls}")
+    finally:
+        if server:
+            server.shutdown()
+
+    compared = {name: values for name, values in accuracy.items() if len(values) == 2}
+    if compared:
+        print(f"\nFirst-try accuracy, default vs {format_variants(args.preprocess)}")
+        for name, (default, preprocessed) in compared.items():
+            print(f"{name:<13}{default:>9.1%}{preprocessed:>9.1%}{(preprocessed - default) * 100:>+8.1f} pt")
+
+
+if __name__ == "__main__":
+    main()
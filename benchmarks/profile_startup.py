@@ -0,0 +1,67 @@
+"""
+This module is to benchmark driver startup and first page load with and
+without the warm Chrome profile template.
+
+Usage: python -m benchmarks.profile_startup [-n 3] [--url URL]
+"""
+from __future__ import annotations
+import argparse
+import logging
+import statistics
+import time
+from configs.config import filenames
+from services.base_service import create_driver, quit_driver
+from services.chrome_profile import ProfileTemplate
+from utils.io import load_toml
+
+
+def measure(logger: logging.Logger, url: str, template) -> tuple:
+    """Return (startup seconds, profile clone seconds within the startup, first page load seconds)"""
+    start = time.perf_counter()
+    driver = create_driver(logger, profile_template=template)
+    started = time.perf_counter()
+    try:
+        driver.get(url)
+        loaded = time.perf_counter()
+    finally:
+        quit_driver(driver)
+    clone = template.clone_timings[-1][1] if template else 0.0
+    return started - start, clone, loaded - started
+
+
+def main() -> None:
+    """args command"""
+    service_config = load_toml(str(filenames.config).format(service='THSRC'))
+    profile = service_config.get('profile', {})
+
+    parser = argparse.ArgumentParser(description="Benchmark the Chrome profile template")
+    parser.add_argument('-n', '--runs', type=int, default=3, help="runs per mode")
+    parser.add_argument('--url', default=service_config['page']['reservation'])
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(message)s', level=logging.WARNING)
+    logger = logging.getLogger(__name__)
+
+    template = ProfileTemplate(
+        warm_urls=[args.url],
+        max_size_mb=profile.get('max-size-mb', 200),
+        max_age_hours=profile.get('max-age-hours', 24),
+        max_copy_size_mb=profile.get('max-copy-size-mb', 32),
+        logger=logger,
+    )
+    # Build once up front so the template run measures clones only
+    template.ensure(lambda path: create_driver(logger, user_data_dir=path))
+
+    print(f"template clones: {template.clone_mode()}")
+    for name, mode in (('empty profile', None), ('template', template)):
+        results = [measure(logger, args.url, mode) for _ in range(args.runs)]
+        startup = [r[0] * 1000 for r in results]
+        clone = [r[1] * 1000 for r in results]
+        page_load = [r[2] * 1000 for r in results]
+        print(f"{name:>13}: startup median {statistics.median(startup):8.1f} ms "
+              f"(clone {statistics.median(clone):6.1f} ms) | "
+              f"first page load median {statistics.median(page_load):8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
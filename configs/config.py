@@ -47,6 +47,7 @@ class Directories:
         self.configuration = self.package_root / 'configs'
         self.cookies = self.package_root / 'cookies'
         self.logs = self.package_root / 'logs'
+        self.cache = self.package_root / '.cache'
 
 
 class Filenames:
@@ -7,11 +7,17 @@ This module is for service initiation mapping
 
 from constants import Service
 from services.thsrc import THSRC
+from services.thsrc_http import THSRCHttp
 
 service_map = [
     {
         'name': Service.THSRC,
         'class': THSRC,
         'keyword': 'thsrc',
-    }
+    },
+    {
+        'name': Service.THSRC,
+        'class': THSRCHttp,
+        'keyword': 'thsrc-http',
+    },
 ]
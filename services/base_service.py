@@ -4,13 +4,188 @@ This module is base service using Selenium for web/Docker deployment
 from __future__ import annotations
 import os
 import logging
+from contextlib import contextmanager
+from typing import Optional
+from urllib.parse import urlsplit
 from configs.config import fields, user_agent
 
 # Selenium imports
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
+from utils.chromedriver import resolve_chromedriver
+from services.chrome_profile import ProfileTemplate, get_profile_template
+
+
+def driver_options(config: dict, lean: bool = False) -> dict:
+    """Keyword arguments for create_driver from a service config"""
+    return {
+        'lean': lean,
+        'blocked_urls': config.get('lean', {}).get('blocked-urls', []),
+        'network_capture': config.get('captcha', {}).get('capture', 'network') == 'network',
+        'profile_template': get_profile_template(config),
+    }
+
+
+def rebase_urls(config: dict, base_url: str) -> dict:
+    """
+    Copy of a service config with the site URLs ([api] and [page] entries on
+    the reservation page's origin) moved to `base_url`, e.g. a local mock
+    """
+    reservation = urlsplit(config['page']['reservation'])
+    origin = f'{reservation.scheme}://{reservation.netloc}'
+    rebased = dict(config)
+    for section in ('api', 'page'):
+        rebased[section] = {
+            key: base_url.rstrip('/') + value[len(origin):] if isinstance(value, str) and value.startswith(origin)
+            else value
+            for key, value in config.get(section, {}).items()
+        }
+    return rebased
+
+
+def create_driver(logger: logging.Logger, lean: bool = False, blocked_urls: Optional[list] = None,
+                  network_capture: bool = False, profile_template: Optional[ProfileTemplate] = None,
+                  user_data_dir: Optional[str] = None):
+    """
+    Initialize Chrome WebDriver with appropriate settings.
+    In lean mode pages load eagerly (DOMContentLoaded) and requests matching
+    `blocked_urls` (images, fonts, CSS, analytics) are blocked via CDP.
+    With `network_capture` network events are kept in the performance log so
+    response bodies (the captcha) can be read back through CDP.
+    With `profile_template` the driver starts from a clone of a warm profile
+    (HTTP/disk caches already populated); quit it with quit_driver().
+    """
+    if profile_template is not None:
+        profile_template.ensure(lambda path: create_driver(logger, user_data_dir=path))
+        user_data_dir = profile_template.clone()
+
+    chrome_options = Options()
+
+    # Headless mode for Docker/server deployment
+    chrome_options.add_argument('--headless=new')
+    chrome_options.add_argument('--no-sandbox')
+    chrome_options.add_argument('--disable-dev-shm-usage')
+    chrome_options.add_argument('--disable-gpu')
+    chrome_options.add_argument('--window-size=1920,1080')
+
+    # Docker-specific settings
+    chrome_options.add_argument('--no-zygote')
+    chrome_options.add_argument('--single-process')
+    chrome_options.add_argument('--disable-setuid-sandbox')
+
+    # User agent
+    chrome_options.add_argument(f'--user-agent={user_agent}')
+
+    if user_data_dir:
+        chrome_options.add_argument(f'--user-data-dir={user_data_dir}')
+
+    # Disable automation detection
+    chrome_options.add_argument('--disable-blink-features=AutomationControlled')
+    chrome_options.add_experimental_option('excludeSwitches', ['enable-automation'])
+    chrome_options.add_experimental_option('useAutomationExtension', False)
+
+    if network_capture:
+        chrome_options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+        chrome_options.add_experimental_option('perfLoggingPrefs', {'enableNetwork': True, 'enablePage': False})
+
+    # Lean mode: return at DOMContentLoaded, callers wait explicitly for what they need
+    if lean:
+        chrome_options.page_load_strategy = 'eager'
+
+    # Check for custom Chrome binary path (for Docker)
+    chrome_binary = os.environ.get('CHROME_BIN')
+    if chrome_binary:
+        chrome_options.binary_location = chrome_binary
+        logger.info(f"Using Chrome binary: {chrome_binary}")
+
+    # Check for custom ChromeDriver path
+    chromedriver_path = os.environ.get('CHROMEDRIVER_PATH')
+
+    try:
+        if chromedriver_path:
+            logger.info(f"Using ChromeDriver: {chromedriver_path}")
+            service = Service(chromedriver_path)
+        else:
+            # Cached, version-pinned lookup; webdriver-manager only on mismatch
+            service = Service(resolve_chromedriver())
+
+        driver = webdriver.Chrome(service=service, options=chrome_options)
+        driver.profile_clone = user_data_dir if profile_template is not None else None
+
+        # Set page load timeout
+        driver.set_page_load_timeout(120)
+        driver.implicitly_wait(10)
+
+        if lean and blocked_urls:
+            driver.execute_cdp_cmd('Network.enable', {})
+            driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': list(blocked_urls)})
+            logger.info(f"Lean mode: blocking {len(blocked_urls)} URL patterns")
+
+        return driver
+
+    except Exception as e:
+        logger.error(f"Failed to initialize Chrome WebDriver: {e}")
+        if profile_template is not None:
+            ProfileTemplate.remove_clone(user_data_dir)
+        raise
+
+
+def quit_driver(driver) -> None:
+    """Quit a driver and delete its cloned profile, if any"""
+    try:
+        driver.quit()
+    finally:
+        clone = getattr(driver, 'profile_clone', None)
+        if clone:
+            ProfileTemplate.remove_clone(clone)
+
+
+class RoundTripCounter:
+    """
+    Counts WebDriver commands; each one is an HTTP round-trip to chromedriver.
+    Installed once per driver by wrapping `driver.execute`, which every
+    driver and element call goes through.
+    """
+
+    def __init__(self, driver):
+        self.total = 0
+        self.stages = {}
+        self._stage = None
+
+        execute = driver.execute
+
+        def counted_execute(driver_command, params=None):
+            self.total += 1
+            if self._stage:
+                self.stages[self._stage] += 1
+            return execute(driver_command, params)
+
+        driver.execute = counted_execute
+
+    @classmethod
+    def attach(cls, driver) -> RoundTripCounter:
+        """Get the counter installed on a driver, installing it on first use"""
+        counter = getattr(driver, 'round_trip_counter', None)
+        if counter is None:
+            counter = cls(driver)
+            driver.round_trip_counter = counter
+        return counter
+
+    def reset(self) -> None:
+        """Start counting from zero (e.g. for a new attempt on a pooled driver)"""
+        self.total = 0
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        """Attribute round-trips made inside the block to a named stage"""
+        previous, self._stage = self._stage, name
+        self.stages[name] = 0
+        try:
+            yield
+        finally:
+            self._stage = previous
 
 
 class BaseService(object):
@@ -18,80 +193,67 @@ class BaseService(object):
     BaseService using Selenium WebDriver
     """
 
+    # Services talking to the site over plain HTTP set this to False
+    uses_driver = True
+
     def __init__(self, args):
         self.logger = args.log
         self.cookies = {}
-        self.config = args.config
         self.service = args.service
-        self.fields = fields[self.service]
+        self.config = args.config
+        # <SERVICE>_BASE_URL points the site URLs elsewhere (benchmarks/mock_thsrc.py)
+        base_url = os.environ.get(f'{self.service}_BASE_URL')
+        if base_url:
+            self.config = rebase_urls(self.config, base_url)
+            self.logger.info(f"Site URLs rebased to {base_url}")
+        # Per-booking fields (web jobs) override user_config.toml
+        self.fields = getattr(args, 'fields', None) or fields[self.service]
 
         self.locale = args.locale
         self.auto = args.auto
         self.list = args.list
+        self.lean = getattr(args, 'lean', False)
 
-        # Initialize Selenium WebDriver
-        self.driver = self._init_driver()
-        self.logger.info("Selenium WebDriver initialized")
-
-    def _init_driver(self):
-        """Initialize Chrome WebDriver with appropriate settings"""
-        chrome_options = Options()
-
-        # Headless mode for Docker/server deployment
-        chrome_options.add_argument('--headless=new')
-        chrome_options.add_argument('--no-sandbox')
-        chrome_options.add_argument('--disable-dev-shm-usage')
-        chrome_options.add_argument('--disable-gpu')
-        chrome_options.add_argument('--window-size=1920,1080')
+        self.driver_pool = None
+        self.driver = None
+        self.round_trips = None
+        if not self.uses_driver:
+            return
 
-        # Docker-specific settings
-        chrome_options.add_argument('--no-zygote')
-        chrome_options.add_argument('--single-process')
-        chrome_options.add_argument('--disable-setuid-sandbox')
+        # Lease a warm driver when a pool is provided (web auto-retry loop)
+        self.driver_pool = getattr(args, 'driver_pool', None)
+        if self.driver_pool:
+            self.driver = self.driver_pool.lease()
+            self.logger.info("Selenium WebDriver leased from pool")
+        else:
+            # Initialize Selenium WebDriver
+            self.driver = self._init_driver()
+            self.logger.info("Selenium WebDriver initialized")
 
-        # User agent
-        chrome_options.add_argument(f'--user-agent={user_agent}')
+        self.round_trips = RoundTripCounter.attach(self.driver)
+        self.round_trips.reset()
 
-        # Disable automation detection
-        chrome_options.add_argument('--disable-blink-features=AutomationControlled')
-        chrome_options.add_experimental_option('excludeSwitches', ['enable-automation'])
-        chrome_options.add_experimental_option('useAutomationExtension', False)
+    def _init_driver(self):
+        """Initialize Chrome WebDriver with appropriate settings"""
+        return create_driver(self.logger, **driver_options(self.config, self.lean))
 
-        # Check for custom Chrome binary path (for Docker)
-        chrome_binary = os.environ.get('CHROME_BIN')
-        if chrome_binary:
-            chrome_options.binary_location = chrome_binary
-            self.logger.info(f"Using Chrome binary: {chrome_binary}")
+    def close(self):
+        """Return the WebDriver to its pool, or quit it when it is not pooled"""
+        driver = getattr(self, 'driver', None)
+        if not driver:
+            return
+        self.driver = None
 
-        # Check for custom ChromeDriver path
-        chromedriver_path = os.environ.get('CHROMEDRIVER_PATH')
+        if getattr(self, 'driver_pool', None):
+            self.driver_pool.release(driver)
+            return
 
         try:
-            if chromedriver_path:
-                self.logger.info(f"Using ChromeDriver: {chromedriver_path}")
-                service = Service(chromedriver_path)
-            else:
-                # Use webdriver-manager to auto-download
-                self.logger.info("Auto-downloading ChromeDriver...")
-                service = Service(ChromeDriverManager().install())
-
-            driver = webdriver.Chrome(service=service, options=chrome_options)
-
-            # Set page load timeout
-            driver.set_page_load_timeout(120)
-            driver.implicitly_wait(10)
-
-            return driver
-
-        except Exception as e:
-            self.logger.error(f"Failed to initialize Chrome WebDriver: {e}")
-            raise
+            quit_driver(driver)
+            self.logger.info("WebDriver closed")
+        except Exception:
+            pass
 
     def __del__(self):
         """Close Selenium WebDriver"""
-        if hasattr(self, 'driver') and self.driver:
-            try:
-                self.driver.quit()
-                self.logger.info("WebDriver closed")
-            except Exception:
-                pass
+        self.close()
@@ -0,0 +1,72 @@
+"""
+This module is for reading captcha image bytes from the browser network layer
+"""
+from __future__ import annotations
+import base64
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class NetworkCaptchaCapture:
+    """
+    Captures the captcha exactly as the server sent it.
+
+    Chrome's performance log (enabled by create_driver(network_capture=True))
+    reports every response; the captcha's request id is matched by URL and
+    its body is read with CDP Network.getResponseBody, so no screenshot,
+    re-encode or canvas pass is needed.
+    """
+
+    def __init__(self, driver, logger: Optional[logging.Logger] = None, max_tracked: int = 200,
+                 timeout: float = 0.15):
+        self.driver = driver
+        self.logger = logger or logging.getLogger(__name__)
+        self.max_tracked = max_tracked
+        self.timeout = timeout
+        # Fetches that found / did not find the image in the log
+        self.hits = 0
+        self.misses = 0
+        self._requests = OrderedDict()   # url -> request id
+        self._finished = set()
+
+    def drain(self) -> None:
+        """Read pending network events from the performance log"""
+        for entry in self.driver.get_log('performance'):
+            message = json.loads(entry['message'])['message']
+            method = message.get('method')
+            params = message.get('params', {})
+            if method == 'Network.responseReceived' and params.get('type') == 'Image':
+                url = params['response']['url']
+                self._requests.pop(url, None)
+                self._requests[url] = params['requestId']
+                while len(self._requests) > self.max_tracked:
+                    self._requests.popitem(last=False)
+            elif method == 'Network.loadingFinished':
+                self._finished.add(params['requestId'])
+
+        if len(self._finished) > self.max_tracked * 4:
+            self._finished &= set(self._requests.values())
+
+    def fetch(self, src: str, timeout: Optional[float] = None) -> Optional[bytes]:
+        """
+        Return the response body for the image at `src`, or None if it was
+        not captured within `timeout` seconds (default self.timeout); call it
+        once the image has loaded, so a miss (cached image, drained log) costs little
+        """
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        while True:
+            self.drain()
+            request_id = self._requests.get(src)
+            if request_id and request_id in self._finished:
+                body = self.driver.execute_cdp_cmd('Network.getResponseBody', {'requestId': request_id})
+                self.hits += 1
+                if body.get('base64Encoded'):
+                    return base64.b64decode(body['body'])
+                return body['body'].encode('latin-1')
+            if time.monotonic() >= deadline:
+                self.misses += 1
+                return None
+            time.sleep(0.02)
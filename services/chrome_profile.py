@@ -0,0 +1,224 @@
+"""
+This module is for a warm Chrome profile template that new drivers are cloned from
+"""
+from __future__ import annotations
+import logging
+import os
+import shutil
+import stat
+import subprocess
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable, Optional
+import orjson
+from configs.config import directories
+from utils.chromedriver import detect_chrome_major
+
+# Chrome's per-instance lock files must never be shared between profiles
+SKIP_NAMES = ('SingletonLock', 'SingletonSocket', 'SingletonCookie', 'lockfile')
+
+_template: Optional[ProfileTemplate] = None
+
+
+class ProfileTemplate:
+    """
+    Chrome user-data-dir pre-populated with THSRC's cacheable assets
+    (HTTP cache, code cache, HSTS/DNS state).
+
+    Every driver starts from a cheap clone: a reflink copy where the
+    filesystem supports copy-on-write, otherwise cache entries are
+    hard-linked read-only (Chrome drops and rewrites an entry it cannot
+    open for writing instead of touching the shared inode) and the small
+    remaining files are copied.
+    Running as root (the Docker image) on a filesystem without reflinks
+    (overlayfs), neither is possible and every clone is a full copy, so
+    the template is then pruned to `max_copy_size_mb` instead.
+    The template is rebuilt when it is older than `max_age_hours` or was
+    built by another Chrome major version, and pruned to `max_size_mb`.
+    """
+
+    def __init__(self, warm_urls: list, root: Optional[Path] = None, max_size_mb: int = 200,
+                 max_age_hours: float = 24, max_copy_size_mb: int = 32,
+                 logger: Optional[logging.Logger] = None):
+        self.warm_urls = warm_urls
+        self.root = Path(root or directories.cache / 'chrome-profile')
+        self.template_dir = self.root / 'template'
+        self.clones_dir = self.root / 'clones'
+        self.marker = self.root / 'template.json'
+        self.max_size = max_size_mb * 1024 * 1024
+        self.max_copy_size = max_copy_size_mb * 1024 * 1024
+        self.max_age = max_age_hours * 3600
+        self.logger = logger or logging.getLogger(__name__)
+        # (clone mode, seconds) per clone, for benchmarks
+        self.clone_timings = []
+        self._lock = threading.Lock()
+        self._reflink = None
+
+    @classmethod
+    def from_config(cls, config: dict, logger: Optional[logging.Logger] = None) -> Optional[ProfileTemplate]:
+        """Build from the [profile] section of a service config (None when disabled)"""
+        profile = config.get('profile', {})
+        if not profile.get('enabled'):
+            return None
+        return cls(
+            warm_urls=[config['page']['reservation']],
+            max_size_mb=profile.get('max-size-mb', 200),
+            max_age_hours=profile.get('max-age-hours', 24),
+            max_copy_size_mb=profile.get('max-copy-size-mb', 32),
+            logger=logger,
+        )
+
+    def is_stale(self) -> bool:
+        """True when the template is missing, too old or from another Chrome version"""
+        try:
+            info = orjson.loads(self.marker.read_bytes())   # pylint: disable=maybe-no-member
+        except (OSError, ValueError):
+            return True
+        return (time.time() - info.get('built_at', 0) > self.max_age
+                or info.get('chrome_major') != detect_chrome_major(os.environ.get('CHROME_BIN')))
+
+    def ensure(self, launch: Callable[[str], object]) -> None:
+        """
+        Build the template if needed.
+        `launch(user_data_dir)` must return a WebDriver using that profile.
+        """
+        with self._lock:
+            if not self.is_stale():
+                return
+            start = time.perf_counter()
+            self.logger.info("Building Chrome profile template...")
+
+            # Clones belong to drivers that may still be running; quit_driver() removes each one
+            shutil.rmtree(self.template_dir, ignore_errors=True)
+            self.template_dir.mkdir(parents=True)
+
+            driver = launch(str(self.template_dir))
+            try:
+                for url in self.warm_urls:
+                    driver.get(url)
+            finally:
+                driver.quit()
+
+            mode = self.clone_mode()
+            if mode == 'copy':
+                self.logger.warning(
+                    "No copy-on-write or hard-linked clones here (root or no reflink support); "
+                    f"every driver copies the template, capped at {self.max_copy_size / 1024 / 1024:.0f} MiB")
+            size = self._prune(min(self.max_size, self.max_copy_size) if mode == 'copy' else self.max_size)
+            self._protect_cache()
+            self.marker.write_bytes(orjson.dumps({   # pylint: disable=maybe-no-member
+                'built_at': time.time(),
+                'chrome_major': detect_chrome_major(os.environ.get('CHROME_BIN')),
+                'size': size,
+            }))
+            self.logger.info(
+                f"Profile template built in {time.perf_counter() - start:.1f}s ({size / 1024 / 1024:.1f} MiB)")
+
+    def clone(self) -> str:
+        """Create a private copy of the template and return its path"""
+        start = time.perf_counter()
+        target = self.clones_dir / uuid.uuid4().hex
+        self.clones_dir.mkdir(parents=True, exist_ok=True)
+
+        # Not while another thread is rebuilding the template
+        with self._lock:
+            mode = 'reflink' if self._clone_reflink(target) else self.clone_mode()
+            if mode != 'reflink':
+                shutil.copytree(self.template_dir, target, copy_function=self._link_or_copy,
+                                ignore=shutil.ignore_patterns(*SKIP_NAMES))
+
+        elapsed = time.perf_counter() - start
+        self.clone_timings.append((mode, elapsed))
+        self.logger.info(f"Profile cloned ({mode}) in {elapsed * 1000:.0f} ms")
+        return str(target)
+
+    def clone_mode(self) -> str:
+        """How clones are made here: 'reflink', 'hardlink' (cache entries) or 'copy'"""
+        if self._reflink is None:
+            self._probe_reflink()
+        if self._reflink:
+            return 'reflink'
+        return 'copy' if os.geteuid() == 0 else 'hardlink'
+
+    def _probe_reflink(self) -> None:
+        """Find out once whether this filesystem can reflink, using a small file"""
+        self.root.mkdir(parents=True, exist_ok=True)
+        probe = self.root / f'.reflink-{uuid.uuid4().hex}'
+        probe.write_bytes(b'\0')
+        try:
+            self._reflink = self._cp_reflink(probe, probe.with_suffix('.copy'))
+        finally:
+            probe.unlink(missing_ok=True)
+            probe.with_suffix('.copy').unlink(missing_ok=True)
+
+    @staticmethod
+    def remove_clone(path: str) -> None:
+        """Delete a clone once its driver has quit"""
+        shutil.rmtree(path, ignore_errors=True)
+
+    def _clone_reflink(self, target: Path) -> bool:
+        """Copy-on-write clone (btrfs, XFS, APFS); remembers if the filesystem can't"""
+        if self._reflink is False:
+            return False
+        self._reflink = self._cp_reflink(self.template_dir, target)
+        if not self._reflink:
+            shutil.rmtree(target, ignore_errors=True)
+            return False
+        for name in SKIP_NAMES:
+            (target / name).unlink(missing_ok=True)
+        return True
+
+    @staticmethod
+    def _cp_reflink(src: Path, dst: Path) -> bool:
+        flag = '-c' if os.uname().sysname == 'Darwin' else '--reflink=always'
+        result = subprocess.run(['cp', '-R', flag, str(src), str(dst)], capture_output=True, check=False)
+        return result.returncode == 0
+
+    @staticmethod
+    def _link_or_copy(src: str, dst: str) -> None:
+        """
+        Hard-link read-only cache entries, copy everything else.
+        Root ignores file permissions, so it always gets real copies.
+        """
+        if os.geteuid() != 0 and not os.stat(src).st_mode & stat.S_IWUSR:
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                pass
+        shutil.copy2(src, dst)
+
+    def _cache_files(self) -> list:
+        files = []
+        for dirpath, _, filenames in os.walk(self.template_dir):
+            parts = Path(dirpath).relative_to(self.template_dir).parts
+            # HTTP cache entries and V8 code cache; their index files stay writable copies
+            if ('Cache' not in parts and 'Code Cache' not in parts) or 'index-dir' in parts:
+                continue
+            files.extend(Path(dirpath) / filename for filename in filenames if filename != 'index')
+        return files
+
+    def _prune(self, max_size: int) -> int:
+        """Drop the largest cache entries until the template fits in max_size bytes, return its size"""
+        size = sum(path.stat().st_size for path in self.template_dir.rglob('*') if path.is_file())
+        for path in sorted(self._cache_files(), key=lambda p: p.stat().st_size, reverse=True):
+            if size <= max_size:
+                break
+            size -= path.stat().st_size
+            path.unlink()
+        return size
+
+    def _protect_cache(self) -> None:
+        """Make cache entries read-only so hard-linked clones can't modify the template"""
+        for path in self._cache_files():
+            path.chmod(stat.S_IRUSR | stat.S_IRGRP)
+
+
+def get_profile_template(config: dict) -> Optional[ProfileTemplate]:
+    """Process-wide template for a service config (None when disabled)"""
+    global _template   # pylint: disable=global-statement
+    if _template is None:
+        _template = ProfileTemplate.from_config(config)
+    return _template
@@ -0,0 +1,177 @@
+"""
+This module is for keeping warm Selenium WebDriver sessions between booking attempts
+"""
+from __future__ import annotations
+import logging
+import queue
+import threading
+import time
+from typing import Optional
+from services.base_service import create_driver, quit_driver
+
+
+class DriverPool:
+    """
+    Pool of pre-launched headless Chrome sessions.
+
+    Drivers are leased to a service for one booking attempt and reset
+    (cookies, storage, current page) on release instead of being quit,
+    so retries skip Chrome and ChromeDriver cold start.
+    """
+
+    def __init__(self, size: int = 1, max_uses: int = 20, lease_timeout: float = 120,
+                 logger: Optional[logging.Logger] = None, **driver_options):
+        self.size = max(1, size)
+        self.max_uses = max_uses
+        self.lease_timeout = lease_timeout
+        self.logger = logger or logging.getLogger(__name__)
+        self.driver_options = driver_options
+
+        self._idle = queue.LifoQueue()
+        self._uses = {}
+        # Drivers being launched, counted against `size` before they exist
+        self._creating = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self.lease_times = []
+        self.reset_times = []
+        self.created = 0
+
+    def prewarm(self) -> None:
+        """Launch drivers until the pool is full"""
+        while not self._closed and self._reserve():
+            self._idle.put(self._create_reserved())
+
+    def lease(self, timeout: Optional[float] = None):
+        """
+        Get an idle driver, launching one if the pool is not full yet.
+        Raises TimeoutError when none is free within `timeout` seconds
+        (default: lease_timeout).
+        """
+        start = time.perf_counter()
+        if self._closed:
+            raise RuntimeError("Driver pool is closed")
+        timeout = self.lease_timeout if timeout is None else timeout
+
+        try:
+            driver = self._idle.get_nowait()
+        except queue.Empty:
+            if self._reserve():
+                driver = self._create_reserved()
+            else:
+                try:
+                    driver = self._idle.get(timeout=timeout)
+                except queue.Empty:
+                    raise TimeoutError(f"No idle driver within {timeout:g}s (pool size {self.size})") from None
+
+        # close() may have run meanwhile and taken the driver out of _uses
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._uses[driver] += 1
+        if closed:
+            # Quit it unless close() already did (e.g. one launched while closing)
+            if driver in self._uses:
+                self._discard(driver)
+            raise RuntimeError("Driver pool is closed")
+
+        elapsed = time.perf_counter() - start
+        self.lease_times.append(elapsed)
+        self.logger.info(f"Driver leased in {elapsed * 1000:.0f} ms")
+        return driver
+
+    def release(self, driver) -> None:
+        """Reset a leased driver and put it back, or retire it when worn out or broken"""
+        with self._lock:
+            uses = self._uses.get(driver)
+        if uses is None:
+            return
+
+        if self._closed or uses >= self.max_uses:
+            self._discard(driver)
+            return
+
+        start = time.perf_counter()
+        try:
+            self._reset(driver)
+        except Exception as e:
+            self.logger.warning(f"Driver reset failed, discarding: {e}")
+            self._discard(driver)
+            return
+
+        elapsed = time.perf_counter() - start
+        self.reset_times.append(elapsed)
+        self.logger.info(f"Driver reset in {elapsed * 1000:.0f} ms")
+        self._idle.put(driver)
+
+    def close(self) -> None:
+        """Quit every driver owned by the pool"""
+        with self._lock:
+            self._closed = True
+            drivers = list(self._uses)
+        for driver in drivers:
+            self._discard(driver)
+
+    def stats(self) -> dict:
+        """Lease and reset timing summary"""
+        return {
+            'created': self.created,
+            'leases': len(self.lease_times),
+            'resets': len(self.reset_times),
+            'lease_avg_ms': _avg_ms(self.lease_times),
+            'lease_max_ms': _max_ms(self.lease_times),
+            'reset_avg_ms': _avg_ms(self.reset_times),
+            'reset_max_ms': _max_ms(self.reset_times),
+        }
+
+    def _reserve(self) -> bool:
+        """Claim room for one more driver; concurrent leases can't overshoot `size`"""
+        with self._lock:
+            if len(self._uses) + self._creating >= self.size:
+                return False
+            self._creating += 1
+            return True
+
+    def _create_reserved(self):
+        """Launch a driver into a slot taken by _reserve()"""
+        try:
+            driver = create_driver(self.logger, **self.driver_options)
+        except Exception:
+            with self._lock:
+                self._creating -= 1
+            raise
+        with self._lock:
+            self._creating -= 1
+            self._uses[driver] = 0
+            self.created += 1
+        return driver
+
+    def _reset(self, driver) -> None:
+        """Clear session state so the next attempt starts like a fresh browser"""
+        try:
+            driver.execute_script(
+                "try { window.localStorage.clear(); window.sessionStorage.clear(); } catch (e) {}")
+        except Exception:
+            pass
+        try:
+            driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+        except Exception:
+            driver.delete_all_cookies()
+        driver.get('about:blank')
+
+    def _discard(self, driver) -> None:
+        with self._lock:
+            self._uses.pop(driver, None)
+        try:
+            quit_driver(driver)
+        except Exception:
+            pass
+
+
+def _avg_ms(values: list) -> float:
+    return round(sum(values) / len(values) * 1000, 1) if values else 0.0
+
+
+def _max_ms(values: list) -> float:
+    return round(max(values) * 1000, 1) if values else 0.0
@@ -0,0 +1,100 @@
+"""
+This module is for filling a whole form stage in a single WebDriver round-trip
+"""
+from __future__ import annotations
+from typing import Any, NamedTuple, Optional, Sequence
+
+FILL_FORM_SCRIPT = """
+var fields = arguments[0], options = arguments[1];
+var missing = [], missingRequired = [], changed = [];
+
+options.hide.forEach(function (selector) {
+    document.querySelectorAll(selector).forEach(function (el) {
+        el.style.display = 'none';
+        el.style.visibility = 'hidden';
+    });
+});
+options.close.forEach(function (selector) {
+    var el = document.querySelector(selector);
+    if (el && el.offsetParent !== null) { el.click(); }
+});
+
+function fire(el) {
+    el.dispatchEvent(new Event('input', {bubbles: true}));
+    el.dispatchEvent(new Event('change', {bubbles: true}));
+}
+
+fields.forEach(function (field) {
+    var name = field[0], kind = field[1], value = field[2], required = field[3];
+    var els = document.getElementsByName(name);
+    var el = null;
+    if (kind === 'radio') {
+        // value: index (number), exact value (string) or first non-empty value (null)
+        for (var i = 0; i < els.length; i++) {
+            var match = typeof value === 'number' ? i === value
+                : (value === null ? els[i].value !== '' : els[i].value === value);
+            if (match) { el = els[i]; break; }
+        }
+        if (el && !el.checked) { el.click(); changed.push(name); }
+    } else if (kind === 'check') {
+        el = els[0] || null;
+        if (el && el.checked !== value) { el.click(); changed.push(name); }
+    } else {
+        el = els[0] || null;
+        if (el && el.value !== String(value)) { el.value = value; fire(el); changed.push(name); }
+    }
+    if (!el) {
+        missing.push(name);
+        if (required) { missingRequired.push(name); }
+    }
+});
+
+var submitted = false;
+// Never submit a form with a required field missing
+if (options.submit && missingRequired.length === 0) {
+    var button = document.getElementsByName(options.submit)[0];
+    if (button) {
+        window.__ticketBotMark = true;
+        button.click();
+        submitted = true;
+    } else {
+        missing.push(options.submit);
+        missingRequired.push(options.submit);
+    }
+}
+return {missing: missing, missingRequired: missingRequired, changed: changed, submitted: submitted};
+"""
+
+
+class FormField(NamedTuple):
+    """
+    One form control to set.
+    kind: 'value' (input/select), 'radio' (index, value or None) or 'check' (bool)
+    """
+    name: str
+    kind: str
+    value: Any
+    required: bool = True
+
+
+def fill_form(driver, fields: Sequence[FormField], submit: Optional[str] = None,
+              hide: Sequence[str] = (), close: Sequence[str] = ()) -> dict:
+    """
+    Set every field, dispatch change events and optionally click the submit
+    button, all in one execute_script call. Fields that already hold their
+    value are left alone (no events), so refilling a form only touches what
+    changed; their names are returned in 'changed'. The form is only
+    submitted when every required field was found; clicking submit also
+    sets the PageWaiter navigation marker.
+    """
+    result = driver.execute_script(
+        FILL_FORM_SCRIPT,
+        [[field.name, field.kind, field.value, field.required] for field in fields],
+        {'submit': submit, 'hide': list(hide), 'close': list(close)},
+    )
+    return {
+        'missing': result.get('missing', []),
+        'missing_required': result.get('missingRequired', []),
+        'changed': result.get('changed', []),
+        'submitted': bool(result.get('submitted')),
+    }
@@ -0,0 +1,264 @@
+"""
+This module is for queueing booking jobs onto a bounded pool of workers.
+
+Pending jobs are picked by priority, then round-robin across users so one
+user's batch can't hold back everyone else; waiting jobs slowly gain
+priority so low-priority work is never starved. Every job keeps its own
+status, logs and cancellation event.
+"""
+
+from __future__ import annotations
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Callable, Optional
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+
+class QueueFull(Exception):
+    """Raised by JobQueue.submit when max_pending jobs are already waiting"""
+
+
+class Job:
+    """One booking request: its parameters, state, logs and cancellation"""
+
+    def __init__(self, data: dict, user: str, priority: int = 0, max_logs: int = 2000):
+        self.id = uuid.uuid4().hex[:12]
+        self.data = data
+        self.user = user
+        self.priority = priority
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        # Runner-specific progress (e.g. attempt / max_attempts)
+        self.info = {}
+        self.logs = deque(maxlen=max_logs)
+        self.log_offset = 0
+        self.created = time.time()
+        self.queued_at = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.cancel_event = threading.Event()
+        self._cancel_callback = None
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        """True once cancellation was requested"""
+        return self.cancel_event.is_set()
+
+    def cancel(self) -> None:
+        """Request cancellation; the runner stops at its next checkpoint"""
+        with self._lock:
+            self.cancel_event.set()
+            callback, self._cancel_callback = self._cancel_callback, None
+        if callback is not None:
+            callback()
+
+    def on_cancel(self, callback: Callable[[], None]) -> None:
+        """
+        Call `callback` on cancellation (right away if already cancelled);
+        replaces the previous callback, e.g. the last attempt's
+        """
+        with self._lock:
+            if not self.cancel_event.is_set():
+                self._cancel_callback = callback
+                return
+        callback()
+
+    def log(self, message: str) -> None:
+        """Append a log line (the oldest lines are dropped past max_logs)"""
+        with self._lock:
+            if len(self.logs) == self.logs.maxlen:
+                self.log_offset += 1
+            self.logs.append(message)
+
+    def read_logs(self, offset: int = 0) -> tuple:
+        """Log lines from absolute line `offset` on, and the offset to continue from"""
+        with self._lock:
+            start = max(0, offset - self.log_offset)
+            lines = list(self.logs)[start:]
+            return lines, self.log_offset + len(self.logs)
+
+    def to_dict(self, logs: int = 0) -> dict:
+        """JSON-ready status, with the last `logs` log lines"""
+        status = {
+            'id': self.id,
+            'user': self.user,
+            'priority': self.priority,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'info': dict(self.info),
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'cancel_requested': self.cancelled,
+        }
+        if logs:
+            with self._lock:
+                status['logs'] = list(self.logs)[-logs:]
+        return status
+
+
+class JobQueue:
+    """
+    Bounded worker pool running `runner(job)` for submitted jobs.
+
+    The runner returns the job's result (truthy on success) or raises;
+    it should check `job.cancelled` (or use `job.on_cancel`) to stop early.
+    """
+
+    def __init__(self, runner: Callable[[Job], object], workers: int = 2, max_pending: int = 100,
+                 aging: float = 60.0, keep_finished: int = 200, logger: Optional[logging.Logger] = None):
+        self.runner = runner
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        # Seconds of waiting worth one priority level
+        self.aging = aging
+        self.keep_finished = keep_finished
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.jobs = {}
+        self.latest = None
+        self._pending = {}
+        self._last_served = {}
+        self._dispatched = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._threads = [threading.Thread(target=self._work, name=f'job-worker-{index}', daemon=True)
+                         for index in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, data: dict, user: str = 'anonymous', priority: int = 0) -> Job:
+        """Queue a job; raises QueueFull when too many jobs are waiting"""
+        job = Job(data, user, priority)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Job queue is closed")
+            if self.pending_count() >= self.max_pending:
+                raise QueueFull(f"{self.max_pending} jobs already waiting")
+            self.jobs[job.id] = job
+            self.latest = job
+            self._pending.setdefault(user, deque()).append(job)
+            self._prune()
+            self._cond.notify()
+        self.logger.info(f"Job {job.id} queued for {user} (priority {priority})")
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """Look up a job by ID"""
+        return self.jobs.get(job_id)
+
+    def list_jobs(self, user: Optional[str] = None) -> list:
+        """Jobs (optionally of one user), newest first"""
+        with self._cond:
+            jobs = [job for job in self.jobs.values() if user is None or job.user == user]
+        return sorted(jobs, key=lambda job: job.created, reverse=True)
+
+    def cancel(self, job_id: str) -> bool:
+        """Cancel a queued or running job; False when unknown or already finished"""
+        with self._cond:
+            job = self.jobs.get(job_id)
+            if job is None or job.status in FINISHED:
+                return False
+            if job.status == QUEUED:
+                self._pending[job.user].remove(job)
+                if not self._pending[job.user]:
+                    del self._pending[job.user]
+                job.status = CANCELLED
+                job.finished = time.time()
+        job.cancel()
+        self.logger.info(f"Job {job_id} cancelled")
+        return True
+
+    def pending_count(self) -> int:
+        """Jobs waiting for a worker"""
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    def position(self, job: Job) -> Optional[int]:
+        """Estimated number of jobs ahead of a queued job (None when not queued)"""
+        with self._cond:
+            if job.status != QUEUED:
+                return None
+            now = time.monotonic()
+            order = sorted((queued for jobs in self._pending.values() for queued in jobs),
+                           key=lambda queued: self._rank(queued, now), reverse=True)
+            return order.index(job)
+
+    def stats(self) -> dict:
+        """Worker count and jobs per state"""
+        with self._cond:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return {'workers': self.workers, 'pending': self.pending_count(), 'jobs': counts}
+
+    def close(self) -> None:
+        """Cancel every job and stop the workers"""
+        with self._cond:
+            self._closed = True
+            jobs = [job for job in self.jobs.values() if job.status not in FINISHED]
+            self._cond.notify_all()
+        for job in jobs:
+            self.cancel(job.id)
+
+    def _rank(self, job: Job, now: float) -> tuple:
+        """Higher ranks first: aged priority, then the user served longest ago, then FIFO"""
+        # Whole levels only, so users still take turns within a level
+        aged = int((now - job.queued_at) // self.aging) if self.aging > 0 else 0
+        return (job.priority + aged, -self._last_served.get(job.user, 0), -job.queued_at)
+
+    def _next(self) -> Job:
+        """Pop the best-ranked head job across users (called with the lock held)"""
+        now = time.monotonic()
+        heads = [max(jobs, key=lambda job: self._rank(job, now)) for jobs in self._pending.values()]
+        job = max(heads, key=lambda job: self._rank(job, now))
+        self._pending[job.user].remove(job)
+        if not self._pending[job.user]:
+            del self._pending[job.user]
+        self._dispatched += 1
+        self._last_served[job.user] = self._dispatched
+        job.status = RUNNING
+        job.started = time.time()
+        return job
+
+    def _work(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                job = self._next()
+
+            self.logger.info(f"Job {job.id} started")
+            try:
+                result = self.runner(job)
+                status = SUCCEEDED if result else CANCELLED if job.cancelled else FAILED
+            except Exception as e:
+                self.logger.error(f"Job {job.id} failed: {e}")
+                result = None
+                job.error = str(e)
+                status = FAILED
+            with self._cond:
+                job.result = result
+                job.status = status
+                job.finished = time.time()
+            self.logger.info(f"Job {job.id} {status}")
+
+    def _prune(self) -> None:
+        """Forget the oldest finished jobs past keep_finished (called with the lock held)"""
+        finished = sorted((job for job in self.jobs.values() if job.status in FINISHED), key=lambda job: job.created)
+        for job in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self.jobs[job.id]
@@ -0,0 +1,46 @@
+"""
+This module is for sharing one fetched and parsed copy of the current page
+"""
+from __future__ import annotations
+from typing import Optional
+from bs4 import BeautifulSoup
+
+
+class PageSnapshot:
+    """
+    Per-navigation snapshot of `driver.page_source`.
+
+    The source crosses the WebDriver wire at most once per page and is
+    parsed lazily, at most once. Call `invalidate()` when the page changes
+    or a stage is done with it; that also frees the parsed tree.
+    """
+
+    def __init__(self, driver):
+        self.driver = driver
+        self._source: Optional[str] = None
+        self._page: Optional[BeautifulSoup] = None
+        self.fetches = 0
+        self.parses = 0
+
+    @property
+    def source(self) -> str:
+        """Page HTML, fetched on first use"""
+        if self._source is None:
+            self._source = self.driver.page_source
+            self.fetches += 1
+        return self._source
+
+    @property
+    def page(self) -> BeautifulSoup:
+        """Parsed page, built on first use"""
+        if self._page is None:
+            self._page = BeautifulSoup(self.source, 'html.parser')
+            self.parses += 1
+        return self._page
+
+    def invalidate(self) -> None:
+        """Drop the captured source and free the parsed tree"""
+        if self._page is not None:
+            self._page.decompose()
+        self._page = None
+        self._source = None
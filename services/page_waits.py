@@ -0,0 +1,92 @@
+"""
+This module is for event-driven waits on THSRC page states (instead of fixed sleeps)
+"""
+from __future__ import annotations
+import logging
+import time
+from typing import Callable, Optional
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import TimeoutException
+
+# Known page states and the element that proves the page reached them
+PAGE_STATES = {
+    'booking': 'img.captcha-img',
+    'trains': 'input[name="TrainQueryDataViewPanel:TrainGroup"]',
+    'error': '.feedbackPanelERROR',
+    'passenger': 'input[name="dummyId"]',
+    'pnr': 'p.pnr-code',
+}
+
+# Returns the first matching state name, or null while the old document
+# (still carrying the navigation marker) or a loading document is shown
+STATE_SCRIPT = """
+if (window.__ticketBotMark || document.readyState === 'loading') { return null; }
+var states = arguments[0];
+for (var i = 0; i < states.length; i++) {
+    if (document.querySelector(states[i][1])) { return states[i][0]; }
+}
+return null;
+"""
+
+CAPTCHA_SCRIPT = """
+var img = document.querySelector('img.captcha-img');
+if (!img || img.getAttribute('src') === arguments[0]) { return null; }
+return (img.complete && img.naturalWidth > 0) ? 'captcha' : null;
+"""
+
+
+class PageWaiter:
+    """
+    Waits that return as soon as the page reaches a known state.
+    Conditions run as a single script per poll, so the driver's implicit
+    wait never delays them, and every wait records how long it took.
+    """
+
+    def __init__(self, driver, logger: Optional[logging.Logger] = None, poll_frequency: float = 0.05,
+                 on_change: Optional[Callable[[], None]] = None):
+        self.driver = driver
+        self.logger = logger or logging.getLogger(__name__)
+        self.poll_frequency = poll_frequency
+        # Called whenever the page is about to change (e.g. PageSnapshot.invalidate)
+        self.on_change = on_change
+        self.timings = []
+
+    def mark(self) -> None:
+        """Tag the current document so a wait can tell when it has been replaced"""
+        self.driver.execute_script("window.__ticketBotMark = true;")
+
+    def wait_for(self, *states: str, timeout: float = 20) -> Optional[str]:
+        """Wait until the (new) page shows one of the given states, return its name"""
+        selectors = [[state, PAGE_STATES[state]] for state in states]
+        return self._until(
+            '|'.join(states), lambda d: d.execute_script(STATE_SCRIPT, selectors), timeout)
+
+    def captcha_refreshed(self, old_src: Optional[str], timeout: float = 10) -> bool:
+        """Wait until the captcha image has a new src and has finished loading"""
+        return bool(self._until(
+            'captcha', lambda d: d.execute_script(CAPTCHA_SCRIPT, old_src), timeout))
+
+    def captcha_loaded(self, timeout: float = 30) -> bool:
+        """Wait until the captcha image has finished loading (eager page loads)"""
+        return self.captcha_refreshed(None, timeout)
+
+    def total(self) -> float:
+        """Total seconds spent waiting"""
+        return sum(timing['seconds'] for timing in self.timings)
+
+    def _until(self, name: str, condition, timeout: float):
+        if self.on_change:
+            self.on_change()
+        start = time.perf_counter()
+        try:
+            result = WebDriverWait(self.driver, timeout, poll_frequency=self.poll_frequency).until(condition)
+        except TimeoutException:
+            result = None
+
+        elapsed = time.perf_counter() - start
+        self.timings.append({'wait': name, 'result': result, 'seconds': elapsed})
+        if result:
+            self.logger.info(f"Page state '{result}' reached after {elapsed * 1000:.0f} ms")
+        else:
+            self.logger.warning(f"Timed out after {elapsed:.1f}s waiting for {name}")
+        return result
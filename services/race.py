@@ -0,0 +1,192 @@
+"""
+This module is for racing several booking sessions for the same trip.
+
+Each session (browser or HTTP) runs its own captcha loop. The first one to
+reach the train list (or, for a train-number booking, the passenger form)
+claims the race and is the only one to go on booking; the others stop at
+their next checkpoint and release their driver or HTTP session, so only
+one booking is ever made.
+"""
+
+from __future__ import annotations
+import logging
+import threading
+import time
+from argparse import Namespace
+from concurrent.futures import Future
+from typing import Optional
+from configs.config import fields
+from utils.ocr_service import get_ocr_service
+
+# CPU time of the driver process tree (ChromeDriver, Chrome) needs the optional `psutil` package
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
+# Fields that would otherwise be prompted for, once per session
+TRIP_FIELDS = ('start-station', 'dest-station', 'outbound-date', 'outbound-time')
+
+
+def session_logger(log, index: int):
+    """Child logger for a racing session, keeping a LoggerAdapter's extra (e.g. a web job ID)"""
+    if isinstance(log, logging.LoggerAdapter):
+        return logging.LoggerAdapter(log.logger.getChild(f'race{index}'), log.extra)
+    return log.getChild(f'race{index}')
+
+
+class RaceCancelled(Exception):
+    """Raised inside a racing session once another session has won"""
+
+
+class Race:
+    """Cancellation event and the single winner shared by racing sessions"""
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.winner = None
+        self.won_at = None
+        self._lock = threading.Lock()
+
+    def claim(self, session) -> bool:
+        """Take the win for `session`; False when another session was first or the race was cancelled"""
+        with self._lock:
+            if self.winner is None and not self.cancelled.is_set():
+                self.winner = session
+                self.won_at = time.perf_counter()
+                self.cancelled.set()
+            return self.winner is session
+
+    def cancel(self) -> None:
+        """Stop every session that has not won yet (e.g. the web job was cancelled)"""
+        with self._lock:
+            self.cancelled.set()
+
+    def check(self, session=None) -> None:
+        """Checkpoint: raise RaceCancelled when another session has won"""
+        if self.cancelled.is_set() and self.winner is not session:
+            raise RaceCancelled()
+
+    def sleep(self, seconds: float, session=None) -> None:
+        """Sleep that ends early (with RaceCancelled) when another session wins"""
+        if self.cancelled.wait(seconds):
+            self.check(session)
+
+    def wait(self, future: Future, timeout: float, session=None) -> None:
+        """Wait for a future, checking for cancellation every 50 ms"""
+        end = time.monotonic() + timeout
+        while not future.done() and time.monotonic() < end:
+            if self.cancelled.wait(0.05):
+                self.check(session)
+
+
+class BookingRace:
+    """
+    Run `sessions` instances of a booking service for the same trip and
+    let the first one to reach the train list finish the booking.
+
+    The trip has to be fully set in user_config.toml (no prompts), since
+    every session is built on its own thread.
+    """
+
+    def __init__(self, service_class, args, sessions: int = 2, logger: Optional[logging.Logger] = None,
+                 race: Optional[Race] = None):
+        self.service_class = service_class
+        self.args = args
+        self.sessions = max(1, sessions)
+        self.logger = logger or args.log
+        self.race = race or Race()
+        self.results = [None] * self.sessions
+
+    def _run_session(self, index: int, started: float) -> None:
+        args = Namespace(**vars(self.args))
+        args.race = self.race
+        args.log = session_logger(self.args.log, index)
+        service = None
+        outcome = 'failed'
+        try:
+            service = self.service_class(args)
+            service.main()
+            outcome = 'won' if self.race.winner is service else 'failed'
+        except RaceCancelled:
+            outcome = 'cancelled'
+        except SystemExit as e:
+            # main() exits with 0 after a booking
+            outcome = 'won' if not e.code and self.race.winner is service else 'failed'
+        except Exception as e:
+            if self.race.cancelled.is_set() and self.race.winner is not service:
+                outcome = 'cancelled'
+            else:
+                self.logger.error(f"Session {index} failed: {e}")
+        finally:
+            submits = len(getattr(service, 'stage_timings', []))
+            if service is not None:
+                service.close()
+        self.results[index] = {
+            'outcome': outcome,
+            'submits': submits,
+            'seconds': round(time.perf_counter() - started, 3),
+        }
+        self.logger.info(f"Session {index}: {outcome} after {submits} captcha submit(s)")
+
+    def run(self) -> dict:
+        """Race the sessions and report time to success and what it cost"""
+        trip = getattr(self.args, 'fields', None) or fields[self.args.service]
+        missing = [key for key in TRIP_FIELDS if not trip.get(key)]
+        if missing:
+            raise ValueError(f"Racing needs the trip set in user_config.toml, missing: {', '.join(missing)}")
+
+        ocr = get_ocr_service(self.args.config).ocr
+        calls_before = sum(stat['calls'] for stat in ocr.stats().values())
+        cpu_before = self._cpu_seconds()
+        if cpu_before is None:
+            self.logger.info("psutil is not installed, the race report leaves out CPU time")
+
+        self.logger.info(f"Racing {self.sessions} booking sessions")
+        started = time.perf_counter()
+        threads = [threading.Thread(target=self._run_session, args=(index, started), name=f'race-{index}')
+                   for index in range(self.sessions)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        cpu_after = self._cpu_seconds()
+        outcomes = [result['outcome'] for result in self.results]
+        winner = outcomes.index('won') if 'won' in outcomes else None
+        report = {
+            'sessions': self.sessions,
+            'winner': winner,
+            'time_to_success': round(self.race.won_at - started, 3) if self.race.won_at else None,
+            'time_to_finish': round(self.results[winner]['seconds'], 3) if winner is not None else None,
+            'elapsed': round(elapsed, 3),
+            'outcomes': outcomes,
+            'submits': sum(result['submits'] for result in self.results),
+            'ocr_calls': sum(stat['calls'] for stat in ocr.stats().values()) - calls_before,
+            'cpu_seconds': round(cpu_after - cpu_before, 3) if cpu_before is not None else None,
+        }
+        self.logger.info(f"Race report: {report}")
+        return report
+
+    @staticmethod
+    def _cpu_seconds() -> Optional[float]:
+        """
+        CPU time of this process and every live descendant (ChromeDriver and
+        its Chrome processes, pooled or not), each including its reaped
+        children, so a process that exits mid-race stays counted by its
+        parent. None without psutil.
+        """
+        if not PSUTIL_AVAILABLE:
+            return None
+        root = psutil.Process()
+        total = 0.0
+        for process in [root] + root.children(recursive=True):
+            try:
+                times = process.cpu_times()
+            except psutil.Error:
+                continue   # exited while walking the tree
+            total += (times.user + times.system
+                      + getattr(times, 'children_user', 0.0) + getattr(times, 'children_system', 0.0))
+        return total
@@ -13,17 +13,27 @@ from datetime import date, datetime, timedelta
 from bs4 import BeautifulSoup
 import pyperclip
 from services.base_service import BaseService
+from services.page_waits import PageWaiter
+from services.page_snapshot import PageSnapshot
+from services.captcha_capture import NetworkCaptchaCapture
+from services.form_fill import FormField, fill_form
+from services.race import RaceCancelled
 from configs.config import user_agent
 from utils.validate import check_roc_id, check_tax_id
-from utils.captcha_ocr import CaptchaOCR
+from utils.captcha_store import get_captcha_store
+from utils.ocr_service import get_ocr_service
 
 # Selenium imports
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait, Select
 from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException, NoSuchElementException
+from selenium.common.exceptions import TimeoutException
 import httpx
 
+# Overlays that can intercept clicks (THSRC "mTop" banner, cookie consent, modals)
+OVERLAY_SELECTORS = ['.mTop', '.cookie-banner', '.modal-backdrop', '.overlay', '#mask']
+CLOSE_SELECTORS = ['.close', '.btn-close', '[aria-label="Close"]', '.modal-close', '.dismiss', '.cookie-close']
+
 
 class THSRC(BaseService):
     """
@@ -42,8 +52,47 @@ class THSRC(BaseService):
         self.car_type = self.select_car_type()
         self.preferred_seat = self.select_preferred_seat()
 
-        # Initialize dual OCR system (holey.cc + Gemini Vision)
-        self.captcha_ocr = CaptchaOCR(self.config['api'].get('captcha_ocr'))
+        # Dual OCR system (holey.cc + Gemini Vision, local engine first when trained),
+        # shared by every booking in the process
+        captcha_config = self.config.get('captcha', {})
+        self.ocr_service = get_ocr_service(self.config)
+        self.captcha_ocr = self.ocr_service.ocr
+
+        # Captcha bytes straight from the network layer when the driver logs network events
+        self.captcha_capture = None
+        if captcha_config.get('capture', 'network') == 'network':
+            self.captcha_capture = NetworkCaptchaCapture(
+                self.driver, self.logger, timeout=captcha_config.get('capture-timeout', 0.15))
+        self.captcha_timings = []
+
+        # Opt-in corpus of captchas, engine answers and the server's verdict
+        self.captcha_store = None
+        if captcha_config.get('record'):
+            self.captcha_store = get_captcha_store(captcha_config.get('record-path') or None)
+        self.pending_captcha = None
+
+        # Refresh instead of submitting a code the OCR is unsure about
+        self.min_confidence = captcha_config.get('min-confidence', 0.5)
+        self.max_refreshes = captcha_config.get('max-refreshes', 3)
+        self.captcha_confidence = None
+        self.captcha_doubt = False
+        self.saved_submits = 0
+
+        # Per captcha: OCR, the prefill overlapping it, the wait left after it and the submit
+        self.stage = {}
+        self.stage_timings = []
+
+        # Shared with the other sessions when racing (services.race); only the winner books
+        self.race = getattr(args, 'race', None)
+
+        # Scheduled T0 (epoch seconds) once prearm() has the form ready to submit
+        self.prearmed_at = None
+
+        # One fetched/parsed copy of the current page, shared by every check
+        self.snapshot = PageSnapshot(self.driver)
+
+        # Event-driven page waits (replace fixed sleeps on the hot path)
+        self.waiter = PageWaiter(self.driver, self.logger, on_change=self.snapshot.invalidate)
 
     def print_error_message(self, html_page):
         """Print error message"""
@@ -212,17 +261,34 @@ class THSRC(BaseService):
             preferred_seat = default_value
         return preferred_seat
 
-    def get_security_code(self, captcha_img_element):
-        """OCR captcha using dual system (holey.cc + Gemini Vision)"""
-        try:
-            # Method 1: Try to get image directly from Selenium screenshot (most reliable)
+    def capture_captcha(self, captcha_img_element) -> bytes:
+        """Get captcha image bytes, preferring the original bytes from the network layer"""
+        start = time.perf_counter()
+        image_data = None
+        method = 'network'
+
+        # Method 1: Original response body via CDP (no render pass, byte-identical)
+        if self.captcha_capture:
+            try:
+                image_data = self.captcha_capture.fetch(captcha_img_element.get_attribute('src'))
+                if not image_data:
+                    self.logger.warning(
+                        f"Captcha not found in network log after {(time.perf_counter() - start) * 1000:.0f} ms "
+                        f"({self.captcha_capture.misses} miss(es)), falling back to screenshot")
+            except Exception as network_err:
+                self.logger.warning(f"Network capture failed: {network_err}, falling back to screenshot")
+
+        if not image_data:
+            # A network miss stays visible in the timings: its wait is part of the elapsed time
+            method = 'network-miss+screenshot' if self.captcha_capture else 'screenshot'
+            # Method 2: Try to get image directly from Selenium screenshot
             try:
                 image_data = captcha_img_element.screenshot_as_png
-                self.logger.info("Got captcha via Selenium screenshot")
             except Exception as screenshot_err:
                 self.logger.warning(f"Screenshot failed: {screenshot_err}, trying src attribute...")
+                method = 'canvas'
 
-                # Method 2: Fallback to src attribute
+                # Method 3: Fallback to src attribute
                 captcha_src = captcha_img_element.get_attribute('src')
 
                 if captcha_src.startswith('data:'):
@@ -244,19 +310,115 @@ class THSRC(BaseService):
                     base64_str = self.driver.execute_script(script, captcha_img_element)
                     image_data = base64.b64decode(base64_str)
 
-            # Use dual OCR system (Gemini Vision first, holey.cc fallback)
-            security_code = self.captcha_ocr.recognize(image_data, use_gemini_first=True)
-
-            if security_code:
-                self.logger.info("+ Security code: %s", security_code)
-                return security_code
-            else:
-                self.logger.warning("All OCR methods failed")
-                return None
+        elapsed = time.perf_counter() - start
+        self.captcha_timings.append((method, elapsed))
+        self.logger.info(f"Got captcha via {method} in {elapsed * 1000:.0f} ms ({len(image_data)} bytes)")
+        return image_data
+
+    def start_security_code(self, captcha_img_element):
+        """
+        Capture the captcha and start OCR in the background (dual system:
+        holey.cc + Gemini Vision). Returns a future of the code, or None if
+        the captcha could not be captured.
+        """
+        try:
+            image_data = self.capture_captcha(captcha_img_element)
+        except Exception as e:
+            self.logger.warning(f"Captcha capture error: {e}")
+            return None
 
+        # Engine order from live stats unless forced
+        captcha_config = self.config.get('captcha', {})
+        use_gemini_first = {'gemini-first': True, 'holey-first': False}.get(
+            captcha_config.get('engine-order', 'adaptive'))
+        hedge_delay = None
+        if captcha_config.get('ocr-mode') == 'hedged':
+            hedge_delay = captcha_config.get('hedge-delay', 0.0)
+
+        if captcha_config.get('ocr-api') == 'async':
+            if hedge_delay == 'auto':
+                remote = [name for name in self.captcha_ocr.engine_order(use_gemini_first) if name != 'local']
+                hedge_delay = self.captcha_ocr.tracker.hedge_delay(remote[0]) if remote else None
+            recognition = self.captcha_ocr.recognize_future(
+                image_data, use_gemini_first=use_gemini_first, hedge_delay=hedge_delay)
+        else:
+            recognition = self.ocr_service.submit(
+                image_data, use_gemini_first=use_gemini_first, hedge_delay=hedge_delay,
+                agreement_wait=captcha_config.get('agreement-wait', 0.0))
+        recognition.image_data = image_data
+        recognition.started = self.stage['started'] = time.perf_counter()
+        recognition.add_done_callback(lambda future: setattr(future, 'finished', time.perf_counter()))
+        return recognition
+
+    def start_captcha_stage(self, captcha_img_element):
+        """
+        Start OCR on a new captcha and fill every other booking field while
+        it runs; returns the recognition for collect_security_code
+        """
+        self.stage = {}
+        recognition = self.start_security_code(captcha_img_element)
+        if recognition is not None:
+            self.prepare_booking_form()
+        return recognition
+
+    def collect_security_code(self, recognition):
+        """
+        Wait for a recognition started by start_security_code and return the
+        most likely code (normalized into the captcha charset); its
+        confidence is kept in captcha_confidence
+        """
+        self.captcha_confidence = None
+        if recognition is None:
+            return None
+        wait_start = time.perf_counter()
+        if self.race:
+            self.race.wait(recognition, 60, self)
+        try:
+            security_code = recognition.result(timeout=60)
         except Exception as e:
             self.logger.warning(f"Captcha OCR error: {e}")
             return None
+        self.stage['ocr_wait'] = time.perf_counter() - wait_start
+        self.stage['ocr'] = getattr(recognition, 'finished', time.perf_counter()) - recognition.started
+
+        attempts = list(recognition.attempts)
+        candidates = self.captcha_ocr.candidates(attempts)
+        self.captcha_confidence = candidates[0].confidence if candidates else 0.0
+        self.captcha_doubt = candidates[0].doubt if candidates else True
+        if candidates:
+            security_code = candidates[0].text
+        self.pending_captcha = (recognition.image_data, security_code, attempts)
+        if security_code:
+            self.logger.info("+ Security code: %s (confidence %.2f, %s)", security_code, self.captcha_confidence,
+                             ', '.join(f'{c.text}={c.confidence:.2f}' for c in candidates) or 'no candidates')
+            return security_code
+        self.logger.warning("All OCR methods failed")
+        return None
+
+    def skip_low_confidence(self, refreshes: int) -> bool:
+        """
+        True when the code just solved is below min-confidence, this captcha
+        gave a reason to doubt it (Candidate.doubt) and another refresh is
+        allowed: a captcha refresh is far cheaper than a submit that comes
+        back with a captcha error. Counted in saved_submits.
+        """
+        if self.captcha_confidence is None or self.captcha_confidence >= self.min_confidence:
+            return False
+        if not self.captcha_doubt:
+            # Low only because of the engine's track record: another captcha won't score better
+            return False
+        if refreshes >= self.max_refreshes:
+            self.logger.info(f"Captcha confidence {self.captcha_confidence:.2f} still low, submitting anyway")
+            return False
+        self.saved_submits += 1
+        self.pending_captcha = None
+        self.logger.info(f"Captcha confidence {self.captcha_confidence:.2f} < {self.min_confidence}, "
+                         f"refreshing instead of submitting ({refreshes + 1}/{self.max_refreshes})")
+        return True
+
+    def get_security_code(self, captcha_img_element):
+        """OCR captcha using dual system (holey.cc + Gemini Vision)"""
+        return self.collect_security_code(self.start_security_code(captcha_img_element))
 
     def load_booking_page(self, max_retries=3):
         """Load the booking page and return captcha element"""
@@ -265,6 +427,7 @@ class THSRC(BaseService):
         for attempt in range(1, max_retries + 1):
             try:
                 self.logger.info(f"Connecting to THSRC website... (attempt {attempt}/{max_retries})")
+                self.snapshot.invalidate()
                 self.driver.get(self.config['page']['reservation'])
 
                 # Wait for captcha image to load
@@ -272,6 +435,9 @@ class THSRC(BaseService):
                 captcha_img = wait.until(
                     EC.presence_of_element_located((By.CSS_SELECTOR, 'img.captcha-img'))
                 )
+                # Eager page loads return before images finish; wait for the captcha itself
+                if self.lean and not self.waiter.captcha_loaded():
+                    raise TimeoutException("Captcha image did not load")
                 self.logger.info("Page loaded successfully")
                 return captcha_img
 
@@ -313,15 +479,17 @@ class THSRC(BaseService):
                 except:
                     continue
 
+            old_src = self.driver.find_element(By.CSS_SELECTOR, 'img.captcha-img').get_attribute('src')
             if refresh_link:
                 self.driver.execute_script("arguments[0].click();", refresh_link)
-                time.sleep(1.5)  # Wait for new captcha to load
             else:
                 # If no refresh link found, try clicking on the captcha image itself
                 self.logger.info("No refresh link found, trying to click captcha image...")
                 captcha_img = self.driver.find_element(By.CSS_SELECTOR, 'img.captcha-img')
                 self.driver.execute_script("arguments[0].click();", captcha_img)
-                time.sleep(1.5)
+
+            # Wait for new captcha to load
+            self.waiter.captcha_refreshed(old_src)
 
             # Get new captcha image
             captcha_img = self.driver.find_element(By.CSS_SELECTOR, 'img.captcha-img')
@@ -330,112 +498,83 @@ class THSRC(BaseService):
             self.logger.error(f"Failed to update captcha: {e}")
             return None
 
+    def booking_form_fields(self, security_code=None) -> list:
+        """Fields of the S1 booking form (without the captcha when no code is given)"""
+        fields = []
+        # Select booking method (time search or train number search)
+        # Local version uses: radio31 (time search), radio33 (train number search)
+        if self.fields['train-no']:
+            fields.append(FormField('bookingMethod', 'radio', 'radio33'))
+            fields.append(FormField('toTrainIDInputField', 'value', self.fields['train-no'].strip()))
+        else:
+            fields.append(FormField('bookingMethod', 'radio', 'radio31'))
+
+        fields.append(FormField('selectStartStation', 'value', str(self.start_station)))
+        fields.append(FormField('selectDestinationStation', 'value', str(self.dest_station)))
+        fields.append(FormField('toTimeInputField', 'value', self.outbound_date))
+        if not self.fields['train-no']:
+            fields.append(FormField('toTimeTable', 'value', self.outbound_time))
+
+        # Car type and preferred seat radios are picked by index
+        fields.append(FormField('trainCon:trainRadioGroup', 'radio', self.car_type, required=False))
+        fields.append(FormField('seatCon:seatRadioGroup', 'radio', self.preferred_seat, required=False))
+
+        # Ticket quantities: adult, child, disabled, elder, college, teenager
+        # (some ticket types may not exist)
+        for row, value in enumerate(self.ticket_num):
+            fields.append(FormField(f'ticketPanel:rows:{row}:ticketAmount', 'value', value, required=False))
+
+        if security_code is not None:
+            fields.append(FormField('homeCaptcha:securityCode', 'value', security_code))
+        return fields
+
+    def prepare_booking_form(self) -> bool:
+        """
+        Fill every booking field except the captcha (run while OCR is in
+        flight). Fields that already hold their value are not touched, so
+        after a captcha error only what the server reset is filled again.
+        """
+        start = time.perf_counter()
+        try:
+            with self.round_trips.stage('prefill'):
+                result = fill_form(self.driver, self.booking_form_fields(),
+                                   hide=OVERLAY_SELECTORS, close=CLOSE_SELECTORS)
+        except Exception as e:
+            self.logger.warning(f"Failed to prefill booking form: {e}")
+            return False
+        self.stage['prefill'] = time.perf_counter() - start
+        if result['changed']:
+            self.logger.info(f"Prefilled while OCR runs: {', '.join(result['changed'])}")
+        return not result['missing_required']
+
     def fill_booking_form(self, security_code):
-        """Fill the booking form using Selenium"""
+        """Fill and submit the booking form in a single WebDriver round-trip"""
         try:
             self.logger.info("Filling booking form...")
+            self.logger.info(
+                f"{self.start_station} -> {self.dest_station}, {self.outbound_date} {self.outbound_time}")
+
+            # Overlays (e.g. THSRC "mTop" div) are hidden by the same script; fields
+            # prefilled during OCR are left alone, normally only the captcha is typed
+            start = time.perf_counter()
+            with self.round_trips.stage('booking_form'):
+                result = fill_form(self.driver, self.booking_form_fields(security_code),
+                                   submit='SubmitButton', hide=OVERLAY_SELECTORS, close=CLOSE_SELECTORS)
+            self.logger.info(
+                f"Booking form sent in {self.round_trips.stages['booking_form']} round-trip(s), "
+                f"touched: {', '.join(result['changed']) or 'nothing'}")
 
-            # First, dismiss any overlay/popup that might block interactions
-            # THSRC website has a "mTop" div that can intercept clicks
-            self._dismiss_overlays()
-
-            # Scroll to the form area to ensure visibility
-            try:
-                form_element = self.driver.find_element(By.CSS_SELECTOR, 'form')
-                self.driver.execute_script("arguments[0].scrollIntoView({block: 'start'});", form_element)
-                time.sleep(0.3)
-            except Exception as scroll_err:
-                self.logger.warning(f"Could not scroll to form: {scroll_err}")
-
-            # Select booking method (time search or train number search)
-            # Local version uses: radio31 (time search), radio33 (train number search)
-            self.logger.info("Selecting booking method...")
-            if self.fields['train-no']:
-                # Train number search - find radio by value 'radio33'
-                train_no_radio = self.driver.find_element(By.CSS_SELECTOR, 'input[name="bookingMethod"][value="radio33"]')
-                self.driver.execute_script("arguments[0].click();", train_no_radio)
-                train_no_input = self.driver.find_element(By.NAME, 'toTrainIDInputField')
-                train_no_input.clear()
-                train_no_input.send_keys(self.fields['train-no'].strip())
-            else:
-                # Time search (default) - find radio by value 'radio31'
-                time_radio = self.driver.find_element(By.CSS_SELECTOR, 'input[name="bookingMethod"][value="radio31"]')
-                self.driver.execute_script("arguments[0].click();", time_radio)
-
-            # Select start station (use JavaScript to set value directly)
-            self.logger.info(f"Setting start station: {self.start_station}")
-            start_station_select = self.driver.find_element(By.NAME, 'selectStartStation')
-            self.driver.execute_script(
-                "arguments[0].value = arguments[1]; arguments[0].dispatchEvent(new Event('change'));",
-                start_station_select, str(self.start_station)
-            )
-
-            # Select destination station
-            self.logger.info(f"Setting destination station: {self.dest_station}")
-            dest_station_select = self.driver.find_element(By.NAME, 'selectDestinationStation')
-            self.driver.execute_script(
-                "arguments[0].value = arguments[1]; arguments[0].dispatchEvent(new Event('change'));",
-                dest_station_select, str(self.dest_station)
-            )
-
-            # Set outbound date
-            self.logger.info(f"Setting outbound date: {self.outbound_date}")
-            date_input = self.driver.find_element(By.NAME, 'toTimeInputField')
-            self.driver.execute_script("arguments[0].value = arguments[1]", date_input, self.outbound_date)
-
-            # Select outbound time (if not using train number)
-            if not self.fields['train-no']:
-                self.logger.info(f"Setting outbound time: {self.outbound_time}")
-                time_select = self.driver.find_element(By.NAME, 'toTimeTable')
-                self.driver.execute_script(
-                    "arguments[0].value = arguments[1]; arguments[0].dispatchEvent(new Event('change'));",
-                    time_select, self.outbound_time
-                )
-
-            # Select car type (use JavaScript click)
-            car_type_radios = self.driver.find_elements(By.NAME, 'trainCon:trainRadioGroup')
-            if len(car_type_radios) > self.car_type:
-                self.driver.execute_script("arguments[0].click();", car_type_radios[self.car_type])
-
-            # Select preferred seat (use JavaScript click)
-            seat_radios = self.driver.find_elements(By.NAME, 'seatCon:seatRadioGroup')
-            if len(seat_radios) > self.preferred_seat:
-                self.driver.execute_script("arguments[0].click();", seat_radios[self.preferred_seat])
-
-            # Set ticket quantities
-            ticket_selects = [
-                ('ticketPanel:rows:0:ticketAmount', self.ticket_num[0]),  # Adult
-                ('ticketPanel:rows:1:ticketAmount', self.ticket_num[1]),  # Child
-                ('ticketPanel:rows:2:ticketAmount', self.ticket_num[2]),  # Disabled
-                ('ticketPanel:rows:3:ticketAmount', self.ticket_num[3]),  # Elder
-                ('ticketPanel:rows:4:ticketAmount', self.ticket_num[4]),  # College
-                ('ticketPanel:rows:5:ticketAmount', self.ticket_num[5]),  # Teenager
-            ]
-
-            for select_name, value in ticket_selects:
-                try:
-                    ticket_select = self.driver.find_element(By.NAME, select_name)
-                    self.driver.execute_script(
-                        "arguments[0].value = arguments[1]; arguments[0].dispatchEvent(new Event('change'));",
-                        ticket_select, value
-                    )
-                except NoSuchElementException:
-                    pass  # Some ticket types may not exist
-
-            # Enter security code
-            self.logger.info("Entering security code...")
-            security_input = self.driver.find_element(By.NAME, 'homeCaptcha:securityCode')
-            security_input.clear()
-            security_input.send_keys(security_code)
-
-            # Click submit button using JavaScript
-            self.logger.info("Clicking submit button...")
-            submit_btn = self.driver.find_element(By.NAME, 'SubmitButton')
-            self.driver.execute_script("arguments[0].click();", submit_btn)
+            if result['missing']:
+                self.logger.warning(f"Form fields not found: {', '.join(result['missing'])}")
+            if result['missing_required'] or not result['submitted']:
+                self.logger.error("Booking form is incomplete, not submitted")
+                return False
 
             # Wait for page to load
             self.logger.info("Waiting for response...")
-            time.sleep(2)
+            self.waiter.wait_for('trains', 'passenger', 'error', 'booking')
+            self.stage['submit'] = time.perf_counter() - start
+            self.log_stage()
 
             self.logger.info("Form submitted successfully")
             return True
@@ -446,70 +585,120 @@ class THSRC(BaseService):
             self.logger.error(traceback.format_exc())
             return False
 
-    def _dismiss_overlays(self):
-        """Dismiss any overlay/popup elements that might block interactions"""
-        try:
-            # Hide or remove common overlay elements
-            overlay_selectors = [
-                '.mTop',           # THSRC top banner
-                '.cookie-banner',  # Cookie consent
-                '.modal-backdrop', # Bootstrap modal
-                '.overlay',        # Generic overlay
-                '#mask',           # Common mask element
-            ]
-
-            for selector in overlay_selectors:
-                try:
-                    elements = self.driver.find_elements(By.CSS_SELECTOR, selector)
-                    for el in elements:
-                        # Try to hide the overlay using JavaScript
-                        self.driver.execute_script(
-                            "arguments[0].style.display = 'none'; arguments[0].style.visibility = 'hidden';",
-                            el
-                        )
-                        self.logger.info(f"Dismissed overlay: {selector}")
-                except:
-                    pass
+    def prearm(self, submit_at: float, captcha_lead: float = 8, keepalive: float = 120):
+        """
+        Get the session ready before a scheduled booking time (epoch seconds):
+        load the page early, keep the server session alive, then refresh and
+        solve the captcha and prefill the form shortly before T0, so that only
+        the submit is left at T0.
+        """
+        self.logger.info("Pre-arming booking session...")
+        captcha_img = self.load_booking_page()
+
+        # Refreshing the captcha touches the server session and keeps it alive
+        solve_at = submit_at - captcha_lead
+        while time.time() + keepalive < solve_at:
+            time.sleep(keepalive)
+            if not self.update_captcha():
+                captcha_img = self.load_booking_page()
+
+        time.sleep(max(0, solve_at - time.time()))
+        captcha_img = self.update_captcha() or captcha_img
+        security_code = self.get_security_code(captcha_img)
+        refreshes = 0
+        while security_code and self.skip_low_confidence(refreshes):
+            refreshes += 1
+            captcha_img = self.update_captcha()
+            security_code = captcha_img and self.get_security_code(captcha_img)
+        if not security_code or not self.prefill_booking_form(security_code):
+            # Searching before T0 can be rejected as out of the bookable range (and exit)
+            self.logger.warning("Pre-arm: captcha not solved or form not filled, normal flow starts at T0")
+            self.wait_until(submit_at)
+            return
+
+        self.logger.info(f"Pre-armed {submit_at - time.time():.1f}s before T0, waiting...")
+        self.wait_until(submit_at)
+        self.prearmed_at = submit_at
+
+    @staticmethod
+    def wait_until(submit_at: float) -> None:
+        """Sleep until an epoch time: coarse sleeps, then a short spin for the last few milliseconds"""
+        while time.time() < submit_at - 0.02:
+            time.sleep(max(0, min(0.5, submit_at - 0.02 - time.time())))
+        while time.time() < submit_at:
+            pass
+
+    def prefill_booking_form(self, security_code) -> bool:
+        """Fill the booking form without submitting it (pre-arm)"""
+        result = fill_form(self.driver, self.booking_form_fields(security_code),
+                           hide=OVERLAY_SELECTORS, close=CLOSE_SELECTORS)
+        if result['missing_required']:
+            self.logger.warning(f"Pre-arm: form fields not found: {', '.join(result['missing_required'])}")
+            return False
+        return True
 
-            # Also try to click any close buttons
-            close_selectors = [
-                '.close', '.btn-close', '[aria-label="Close"]',
-                '.modal-close', '.dismiss', '.cookie-close'
-            ]
+    def submit_prefilled(self) -> bool:
+        """Submit the form filled by prefill_booking_form() and wait for the next page"""
+        result = fill_form(self.driver, [], submit='SubmitButton')
+        if not result['submitted']:
+            return False
+        self.waiter.wait_for('trains', 'passenger', 'error', 'booking')
+        return True
 
-            for selector in close_selectors:
-                try:
-                    close_btn = self.driver.find_element(By.CSS_SELECTOR, selector)
-                    if close_btn.is_displayed():
-                        self.driver.execute_script("arguments[0].click();", close_btn)
-                        self.logger.info(f"Clicked close button: {selector}")
-                        time.sleep(0.3)
-                except:
-                    pass
+    def submit_prearmed(self) -> bool:
+        """Submit the form prepared by prearm(); returns True if it was submitted"""
+        submit_at, self.prearmed_at = self.prearmed_at, None
+        if not submit_at:
+            return False
 
-        except Exception as e:
-            self.logger.debug(f"Error dismissing overlays: {e}")
+        submitted = self.submit_prefilled()
+        self.logger.info(f"T0 -> submission: {(time.time() - submit_at) * 1000:.0f} ms")
+        if not submitted:
+            self.logger.warning("Pre-armed form could not be submitted, reloading")
+        return submitted
 
     def check_booking_result(self):
         """Check if booking form submission was successful"""
-        page_source = self.driver.page_source
-        page = BeautifulSoup(page_source, 'html.parser')
-
         # Check for errors
-        errors = self.print_error_message(page)
+        errors = self.print_error_message(self.snapshot.page)
         if errors:
-            return False, errors, page
+            return False, errors
 
         # Check if we're on the train selection page
-        if 'TrainQueryDataViewPanel' in page_source:
-            return True, None, page
-
-        return False, ['Unknown error'], page
+        if 'TrainQueryDataViewPanel' in self.snapshot.source:
+            return True, None
+
+        # A booking by train number skips the train list and lands on the passenger form
+        if self.fields['train-no'] and self.snapshot.page.find('input', attrs={'name': 'dummyId'}):
+            return True, None
+
+        return False, ['Unknown error']
+
+    def record_captcha(self, success: bool, errors) -> None:
+        """
+        Report the server's verdict on the last submitted captcha to the OCR
+        engine stats and the captcha store: accepted when the train list (or,
+        booking by train number, the passenger form) shows, rejected on a
+        captcha error, unknown otherwise
+        """
+        pending, self.pending_captcha = self.pending_captcha, None
+        if not pending:
+            return
+        if success:
+            accepted = True
+        elif any('檢測碼' in error for error in errors or []):
+            accepted = False
+        else:
+            accepted = None
+        image_data, security_code, attempts = pending
+        if accepted is not None and security_code:
+            self.captcha_ocr.report_verdict(attempts, security_code, accepted)
+        if self.captcha_store:
+            self.captcha_store.record(image_data, attempts, security_code, accepted)
 
     def confirm_train(self, default_value: int = 1):
         """2. Confirm train selection"""
-        page_source = self.driver.page_source
-        page = BeautifulSoup(page_source, 'html.parser')
+        page = self.snapshot.page
 
         trains = []
         has_discount = False
@@ -567,66 +756,63 @@ class THSRC(BaseService):
             selected_opt = int(
                 input(f'train (default: {default_value}): ') or default_value) - 1
 
-        # Select the train using Selenium
-        try:
-            train_radios = self.driver.find_elements(By.NAME, 'TrainQueryDataViewPanel:TrainGroup')
-            if train_radios and len(train_radios) > selected_opt:
-                train_radios[selected_opt].click()
+        return self.submit_train(selected_opt)
 
-            # Click confirm button
-            submit_btn = self.driver.find_element(By.NAME, 'SubmitButton')
-            submit_btn.click()
-            time.sleep(2)
+    def submit_train(self, selected_opt: int) -> bool:
+        """Select the train (index of its radio) and click confirm"""
+        try:
+            with self.round_trips.stage('confirm_train'):
+                result = fill_form(self.driver, [
+                    FormField('TrainQueryDataViewPanel:TrainGroup', 'radio', selected_opt, required=False),
+                ], submit='SubmitButton')
+            if not result['submitted']:
+                self.logger.error("Confirm button not found")
+                return False
+            self.waiter.wait_for('passenger', 'error')
 
             return True
         except Exception as e:
             self.logger.error(f"Failed to confirm train: {e}")
             return False
 
-    def confirm_ticket(self):
-        """3. Confirm ticket and fill passenger info"""
+    def passenger_form_fields(self) -> list:
+        """Fields of the S3 passenger form"""
         dummy_id = self.fields['id']
         if not dummy_id:
             dummy_id = input("\nInput id: ")
 
-        try:
-            # Fill ID number
-            id_input = self.driver.find_element(By.NAME, 'dummyId')
-            id_input.clear()
-            id_input.send_keys(dummy_id)
-
-            # Fill phone number
-            phone_input = self.driver.find_element(By.NAME, 'dummyPhone')
-            phone_input.clear()
-            phone_input.send_keys(self.fields['phone'])
-
-            # Fill email
-            email_input = self.driver.find_element(By.NAME, 'email')
-            email_input.clear()
-            email_input.send_keys(self.fields['email'])
-
-            # Handle TGO membership
-            if self.fields['tgo-id']:
-                try:
-                    tgo_radio = self.driver.find_element(
-                        By.XPATH, "//input[@name='TicketMemberSystemInputPanel:TakerMemberSystemDataView:memberSystemRadioGroup' and @value!='']")
-                    tgo_radio.click()
-                    tgo_input = self.driver.find_element(
-                        By.NAME, 'TicketMemberSystemInputPanel:TakerMemberSystemDataView:memberSystemRadioGroup:memberShipNumber')
-                    tgo_input.clear()
-                    tgo_input.send_keys(self.fields['tgo-id'])
-                except NoSuchElementException:
-                    pass
+        fields = [
+            FormField('dummyId', 'value', dummy_id),
+            FormField('dummyPhone', 'value', self.fields['phone']),
+            FormField('email', 'value', self.fields['email']),
+        ]
+        # Handle TGO membership (first member-system radio with a value)
+        if self.fields['tgo-id']:
+            fields.append(FormField(
+                'TicketMemberSystemInputPanel:TakerMemberSystemDataView:memberSystemRadioGroup',
+                'radio', None, required=False))
+            fields.append(FormField(
+                'TicketMemberSystemInputPanel:TakerMemberSystemDataView:memberSystemRadioGroup:memberShipNumber',
+                'value', self.fields['tgo-id'], required=False))
+        # Check agree checkbox
+        fields.append(FormField('agree', 'check', True))
+        return fields
 
-            # Check agree checkbox
-            agree_checkbox = self.driver.find_element(By.NAME, 'agree')
-            if not agree_checkbox.is_selected():
-                agree_checkbox.click()
+    def confirm_ticket(self):
+        """3. Confirm ticket and fill passenger info"""
+        fields = self.passenger_form_fields()
+        try:
+            with self.round_trips.stage('confirm_ticket'):
+                result = fill_form(self.driver, fields, submit='SubmitButton')
+            self.logger.info(
+                f"Passenger form sent in {self.round_trips.stages['confirm_ticket']} round-trip(s)")
 
-            # Click submit button
-            submit_btn = self.driver.find_element(By.NAME, 'SubmitButton')
-            submit_btn.click()
-            time.sleep(2)
+            if result['missing']:
+                self.logger.warning(f"Form fields not found: {', '.join(result['missing'])}")
+            if result['missing_required'] or not result['submitted']:
+                self.logger.error("Passenger form is incomplete, not submitted")
+                return False
+            self.waiter.wait_for('pnr', 'error')
 
             return True
         except Exception as e:
@@ -635,8 +821,7 @@ class THSRC(BaseService):
 
     def print_result(self):
         """4. Print result"""
-        page_source = self.driver.page_source
-        page = BeautifulSoup(page_source, 'html.parser')
+        page = self.snapshot.page
 
         try:
             reservation_no = page.find('p', class_='pnr-code').get_text(strip=True)
@@ -684,55 +869,116 @@ class THSRC(BaseService):
             self.logger.error(f"Failed to parse result: {e}")
             return None
 
+    def log_stage(self) -> None:
+        """Log the timings of the captcha stage just submitted"""
+        stage = {key: value for key, value in self.stage.items() if key != 'started'}
+        if 'ocr' not in stage:
+            return
+        self.stage_timings.append(stage)
+        self.logger.info(
+            f"Captcha stage: OCR {stage['ocr'] * 1000:.0f} ms, prefill {stage.get('prefill', 0) * 1000:.0f} ms "
+            f"alongside it, waited {stage.get('ocr_wait', 0) * 1000:.0f} ms for the code, "
+            f"submit {stage.get('submit', 0) * 1000:.0f} ms")
+
+    def checkpoint(self) -> None:
+        """Stop a racing session (RaceCancelled) once another session has won"""
+        if self.race:
+            self.race.check(self)
+
+    def pause(self, seconds: float) -> None:
+        """time.sleep that a racing session leaves as soon as another session wins"""
+        if self.race:
+            self.race.sleep(seconds, self)
+        else:
+            time.sleep(seconds)
+
+    def claim_race(self) -> None:
+        """Past the captcha: only the first racing session goes on to book"""
+        if self.race and not self.race.claim(self):
+            raise RaceCancelled()
+        if self.race:
+            self.logger.info("Won the race, other sessions cancelled")
+
+    def log_stats(self) -> None:
+        """Log where the booking spent its time"""
+        self.logger.info(f"Page waits: {len(self.waiter.timings)} totalling {self.waiter.total():.2f}s")
+        self.logger.info(f"WebDriver round-trips: {self.round_trips.total} {self.round_trips.stages}")
+        self.logger.info(f"Page source fetches: {self.snapshot.fetches}, parses: {self.snapshot.parses}")
+        self.logger.info(f"OCR service stats: {self.ocr_service.stats()}")
+        self.logger.info(f"Low-confidence captchas refreshed instead of submitted: {self.saved_submits}")
+        overlap = sum(min(stage['ocr'], stage.get('prefill', 0)) for stage in self.stage_timings)
+        self.logger.info(f"Form prefill hidden behind OCR: {overlap:.2f}s over {len(self.stage_timings)} captcha(s)")
+
     def main(self):
         """Buy ticket process"""
         search_attempt = 0
 
         while True:  # Keep searching until ticket is booked
+            self.checkpoint()
             search_attempt += 1
             self.logger.info(f"\n{'='*50}")
             self.logger.info(f"Search attempt #{search_attempt}...")
             self.logger.info(f"{'='*50}")
 
-            # Load booking page
-            captcha_img = self.load_booking_page()
+            # Load booking page (a pre-armed session only has to submit)
+            submitted = self.submit_prearmed()
+            captcha_img = None if submitted else self.load_booking_page()
+            # OCR runs while every other booking field is being filled
+            recognition = None if submitted else self.start_captcha_stage(captcha_img)
 
             retry_count = 0
             max_retries = 20
+            refreshes = 0
             found_train = False
             no_ticket_error = False
 
             while retry_count < max_retries:
-                # Get security code from captcha
-                security_code = self.get_security_code(captcha_img)
+                self.checkpoint()
+                if submitted:
+                    submitted = False
+                else:
+                    # Get security code from captcha
+                    security_code = self.collect_security_code(recognition)
 
-                if security_code is None:
-                    self.logger.warning("Failed to get security code, restarting...")
-                    time.sleep(5)
-                    break
+                    if security_code is None:
+                        self.logger.warning("Failed to get security code, restarting...")
+                        self.pause(5)
+                        break
 
-                # Fill and submit booking form
-                if not self.fill_booking_form(security_code):
-                    retry_count += 1
-                    captcha_img = self.update_captcha()
-                    continue
+                    if self.skip_low_confidence(refreshes):
+                        refreshes += 1
+                        captcha_img = self.update_captcha()
+                        if captcha_img is None:
+                            break
+                        recognition = self.start_captcha_stage(captcha_img)
+                        continue
+                    refreshes = 0
+
+                    # Fill and submit booking form
+                    if not self.fill_booking_form(security_code):
+                        retry_count += 1
+                        captcha_img = self.update_captcha()
+                        recognition = self.start_captcha_stage(captcha_img)
+                        continue
 
                 # Check result
-                success, errors, page = self.check_booking_result()
+                success, errors = self.check_booking_result()
+                self.record_captcha(success, errors)
 
                 if success:
                     found_train = True
-                    self.logger.info("Captcha correct! Found train list")
+                    self.logger.info("Captcha correct! Found "
+                                     f"{'passenger form' if self.fields['train-no'] else 'train list'}")
                     break
                 else:
                     retry_count += 1
 
                     # Check for "no tickets" error
-                    page_source = self.driver.page_source
+                    page_source = self.snapshot.source
                     if '查無可售車次' in page_source or '已售完' in page_source:
                         self.logger.warning("No available trains or sold out, retrying in 30s...")
                         no_ticket_error = True
-                        time.sleep(30)
+                        self.pause(30)
                         break
 
                     if retry_count >= max_retries:
@@ -743,8 +989,10 @@ class THSRC(BaseService):
                     captcha_img = self.update_captcha()
                     if captcha_img is None:
                         break
+                    recognition = self.start_captcha_stage(captcha_img)
 
             if found_train:
+                self.claim_race()
                 break
 
             if no_ticket_error:
@@ -770,6 +1018,8 @@ class THSRC(BaseService):
 
         # Print result
         reservation_no = self.print_result()
+        self.snapshot.invalidate()
+        self.log_stats()
 
         if reservation_no:
             self.logger.info("\nBooking success! Program will now exit.")
@@ -0,0 +1,346 @@
+"""
+This module is to buy tickets from THSRC over plain HTTP (no browser).
+
+The booking flow of services.thsrc.THSRC runs unchanged; only the page
+stages are replaced: pages are fetched with a pooled httpx session, forms
+are parsed with lxml and posted with their hidden Wicket fields, the
+captcha is downloaded as raw bytes and refreshed through the Wicket ajax
+endpoint. The session id (`jsessionid`) and the Wicket page counter
+(`wicket:interface=:N:`) are tracked from the responses, with the
+`[api]` URLs of configs/THSRC.toml as fallback.
+"""
+
+from __future__ import annotations
+import random
+import re
+import sys
+import time
+from typing import Optional
+from urllib.parse import urljoin
+import httpx
+from bs4 import BeautifulSoup
+from lxml import etree, html
+from configs.config import user_agent
+from services.form_fill import FormField
+from services.thsrc import THSRC
+from utils.captcha_ocr import HTTP2_AVAILABLE
+
+CAPTCHA_XPATH = "descendant-or-self::img[contains(concat(' ', normalize-space(@class), ' '), ' captcha-img ')]"
+JSESSIONID_PATTERN = re.compile(r';jsessionid=([^?;#/"\']+)', re.IGNORECASE)
+INTERFACE_PATTERN = re.compile(r'wicket:interface=:(\d+):')
+REFRESH_PATTERN = re.compile(r'[^\'"\s]*reCodeLink[^\'"\s]*IBehaviorListener[^\'"\s]*')
+
+
+def encode_form(form: html.FormElement, fields: list, submit: Optional[str] = None) -> tuple:
+    """
+    POST data for a form: its current values (hidden fields, checked radios,
+    selected options) with `fields` applied the way form_fill.fill_form
+    applies them in the browser. Returns (data, missing, missing_required).
+    """
+    values = dict(form.form_values())
+    missing, missing_required = [], []
+    for field in fields:
+        value = None
+        if field.name in form.inputs:
+            element = form.inputs[field.name]
+            if field.kind == 'radio':
+                options = list(getattr(element, 'value_options', None) or [element.get('value', 'on')])
+                if isinstance(field.value, int):
+                    value = options[field.value] if field.value < len(options) else None
+                elif field.value is None:
+                    value = next((option for option in options if option), None)
+                else:
+                    value = field.value if field.value in options else None
+            elif field.kind == 'check':
+                value = element.get('value', 'on')
+                if not field.value:
+                    values.pop(field.name, None)
+                    continue
+            else:
+                value = str(field.value)
+        if value is None:
+            missing.append(field.name)
+            if field.required:
+                missing_required.append(field.name)
+            continue
+        values[field.name] = value
+
+    if submit:
+        button = form.xpath('.//*[@name=$name]', name=submit)
+        values[submit] = button[0].get('value', '') if button else ''
+    return values, missing, missing_required
+
+
+class ResponseSnapshot:
+    """
+    PageSnapshot over the latest HTML response: the same `source`/`page`
+    interface for THSRC's checks, plus the lxml tree for the forms.
+    The source can't be fetched again, so `invalidate()` only frees the
+    parsed trees.
+    """
+
+    def __init__(self):
+        self.url = ''
+        self._source: Optional[str] = None
+        self._page: Optional[BeautifulSoup] = None
+        self._tree = None
+        self.fetches = 0
+        self.parses = 0
+
+    def update(self, response: httpx.Response) -> None:
+        """Replace the snapshot with a new page"""
+        self.invalidate()
+        self.url = str(response.url)
+        self._source = response.text
+        self.fetches += 1
+
+    @property
+    def source(self) -> str:
+        """Page HTML"""
+        return self._source or ''
+
+    @property
+    def page(self) -> BeautifulSoup:
+        """Parsed page (BeautifulSoup, as PageSnapshot)"""
+        if self._page is None:
+            self._page = BeautifulSoup(self.source, 'html.parser')
+            self.parses += 1
+        return self._page
+
+    @property
+    def tree(self) -> html.HtmlElement:
+        """Parsed page (lxml), with links resolved against the page URL"""
+        if self._tree is None:
+            self._tree = html.document_fromstring(self.source or '<html></html>', base_url=self.url)
+        return self._tree
+
+    def invalidate(self) -> None:
+        """Free the parsed trees"""
+        if self._page is not None:
+            self._page.decompose()
+        self._page = None
+        self._tree = None
+
+
+class THSRCHttp(THSRC):
+    """
+    Service code for THSRC (https://irs.thsrc.com.tw/IMINT/) over HTTP, without a browser
+    """
+
+    uses_driver = False
+
+    def __init__(self, args):
+        super().__init__(args)
+        # Page stages go over HTTP: no CDP capture, no page waits
+        self.captcha_capture = None
+        self.waiter = None
+        self.snapshot = ResponseSnapshot()
+
+        http_config = self.config.get('http', {})
+        self.client = httpx.Client(
+            timeout=http_config.get('timeout', 20),
+            http2=HTTP2_AVAILABLE,
+            follow_redirects=True,
+            headers={'User-Agent': user_agent, 'Accept-Language': 'zh-TW,zh;q=0.9'},
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=4, keepalive_expiry=120),
+        )
+        self.jsessionid = ''
+        self.interface = 0
+        self.prefilled = None
+        # Seconds per request, by stage
+        self.timings = {}
+
+    def close(self):
+        """Close the HTTP session"""
+        client = getattr(self, 'client', None)
+        if client is not None:
+            client.close()
+            self.client = None
+        super().close()
+
+    def request(self, stage: str, method: str, url: str, **kwargs) -> httpx.Response:
+        """Send a request, time it under `stage` and track the session"""
+        start = time.perf_counter()
+        response = self.client.request(method, url, **kwargs)
+        self.timings.setdefault(stage, []).append(time.perf_counter() - start)
+        response.raise_for_status()
+
+        match = JSESSIONID_PATTERN.search(str(response.url))
+        self.jsessionid = (match.group(1) if match else None) or response.cookies.get('JSESSIONID') \
+            or self.client.cookies.get('JSESSIONID') or self.jsessionid
+        return response
+
+    def navigate(self, stage: str, method: str, url: str, **kwargs) -> httpx.Response:
+        """Request a page and make it the current snapshot"""
+        response = self.request(stage, method, url, **kwargs)
+        self.snapshot.update(response)
+        for form in self.snapshot.tree.forms:
+            match = INTERFACE_PATTERN.search(form.get('action') or '')
+            if match:
+                self.interface = int(match.group(1))
+                break
+        match = JSESSIONID_PATTERN.search(self.snapshot.source)
+        if match:
+            self.jsessionid = match.group(1)
+        return response
+
+    def api_url(self, key: str, **values) -> str:
+        """An [api] URL with the tracked session id and page counter"""
+        return self.config['api'][key].format(jsessionid=self.jsessionid, interface=self.interface, **values)
+
+    def find_form(self, fields: list) -> Optional[html.FormElement]:
+        """The form on the current page holding most of the fields"""
+        names = {field.name for field in fields}
+        forms = self.snapshot.tree.forms
+        if not forms:
+            return None
+        form = max(forms, key=lambda form: len(names.intersection(form.inputs.keys())))
+        return form if names.intersection(form.inputs.keys()) or not names else None
+
+    def submit_form(self, stage: str, fields: list, fallback: str) -> bool:
+        """
+        Post a form of the current page with `fields` applied and make the
+        response the current page. The action comes from the form itself;
+        the [api] URL `fallback` is used when it has none.
+        """
+        form = self.find_form(fields)
+        if form is None:
+            self.logger.error(f"No form for {stage} on the current page")
+            return False
+        data, missing, missing_required = encode_form(form, fields, submit='SubmitButton')
+        if missing:
+            self.logger.warning(f"Form fields not found: {', '.join(missing)}")
+        if missing_required:
+            self.logger.error(f"Form for {stage} is incomplete, not submitted")
+            return False
+
+        url = form.action or self.api_url(fallback)
+        try:
+            self.navigate(stage, 'POST', url, data=data)
+        except httpx.HTTPError as e:
+            self.logger.error(f"Failed to submit {stage}: {e}")
+            return False
+        self.logger.info(f"{stage} sent in {self.timings[stage][-1] * 1000:.0f} ms")
+        return True
+
+    def captcha_src(self, element: html.HtmlElement, base_url: str) -> Optional[str]:
+        """Absolute URL of the captcha image below `element`"""
+        images = element.xpath(CAPTCHA_XPATH)
+        if not images or not images[0].get('src'):
+            return None
+        return urljoin(base_url, images[0].get('src'))
+
+    def load_booking_page(self, max_retries=3):
+        """Load the booking page in a new session and return the captcha URL"""
+        self.logger.info("\nLoading...")
+
+        for attempt in range(1, max_retries + 1):
+            try:
+                self.logger.info(f"Connecting to THSRC website... (attempt {attempt}/{max_retries})")
+                self.client.cookies.clear()
+                self.jsessionid = ''
+                self.navigate('load', 'GET', self.config['page']['reservation'])
+                captcha_src = self.captcha_src(self.snapshot.tree, self.snapshot.url)
+                if not captcha_src:
+                    raise ValueError("captcha image not found")
+                self.logger.info(f"Page loaded in {self.timings['load'][-1] * 1000:.0f} ms")
+                return captcha_src
+            except (httpx.HTTPError, ValueError) as e:
+                self.logger.warning(f"Connection failed: {e}")
+                if attempt < max_retries:
+                    wait_time = attempt * 3
+                    self.logger.info(f"Waiting {wait_time} seconds before retry...")
+                    time.sleep(wait_time)
+
+        self.logger.error("Failed to connect after multiple retries")
+        sys.exit(1)
+
+    def capture_captcha(self, captcha_img_element) -> bytes:
+        """Download the captcha image (`captcha_img_element` is its URL)"""
+        response = self.request('captcha', 'GET', captcha_img_element)
+        self.logger.info(
+            f"Got captcha via http in {self.timings['captcha'][-1] * 1000:.0f} ms ({len(response.content)} bytes)")
+        return response.content
+
+    def update_captcha(self):
+        """Refresh the captcha through the Wicket ajax link and return the new captcha URL"""
+        self.logger.info("Updating captcha")
+        match = REFRESH_PATTERN.search(self.snapshot.source)
+        if match:
+            url = urljoin(self.snapshot.url, match.group(0).replace('&amp;', '&'))
+            url += f'&random={random.random()}'
+        else:
+            url = self.api_url('update_captcha', random_value=random.random())
+        try:
+            response = self.request('update_captcha', 'GET', url, headers={
+                'Wicket-Ajax': 'true', 'X-Requested-With': 'XMLHttpRequest', 'Referer': self.snapshot.url})
+            # Wicket answers <ajax-response><component><![CDATA[...]]></component></ajax-response>
+            try:
+                markup = ''.join(component.text or '' for component in etree.fromstring(response.content).iter('component'))
+            except etree.XMLSyntaxError:
+                markup = response.text
+            captcha_src = self.captcha_src(html.fromstring(markup or '<div></div>'), self.snapshot.url)
+            if not captcha_src:
+                raise ValueError("no captcha in refresh response")
+            return captcha_src
+        except (httpx.HTTPError, ValueError, etree.ParserError) as e:
+            self.logger.error(f"Failed to update captcha: {e}")
+            return None
+
+    def fill_booking_form(self, security_code):
+        """Post the booking form"""
+        self.logger.info("Filling booking form...")
+        self.logger.info(
+            f"{self.start_station} -> {self.dest_station}, {self.outbound_date} {self.outbound_time}")
+        start = time.perf_counter()
+        if not self.submit_form('booking_form', self.booking_form_fields(security_code), 'confirm_train'):
+            return False
+        self.stage['submit'] = time.perf_counter() - start
+        self.log_stage()
+        return True
+
+    def prepare_booking_form(self) -> bool:
+        """Nothing to prefill: the form data is built from the latest page at submit"""
+        return True
+
+    def prefill_booking_form(self, security_code) -> bool:
+        """Keep the booking form fields for submit_prefilled()"""
+        fields = self.booking_form_fields(security_code)
+        form = self.find_form(fields)
+        if form is None or encode_form(form, fields)[2]:
+            self.logger.warning("Pre-arm: booking form not found")
+            return False
+        self.prefilled = fields
+        return True
+
+    def submit_prefilled(self) -> bool:
+        """Post the booking form kept by prefill_booking_form()"""
+        fields, self.prefilled = self.prefilled, None
+        return bool(fields) and self.submit_form('booking_form', fields, 'confirm_train')
+
+    def submit_train(self, selected_opt: int) -> bool:
+        """Post the train selection (index of its radio)"""
+        return self.submit_form('confirm_train', [
+            FormField('TrainQueryDataViewPanel:TrainGroup', 'radio', selected_opt, required=False),
+        ], 'confirm_ticket')
+
+    def confirm_ticket(self):
+        """3. Confirm ticket and fill passenger info"""
+        fields = self.passenger_form_fields()
+        # The browser copies the buyer's ID into empty passenger ID fields
+        dummy_id = next(field.value for field in fields if field.name == 'dummyId')
+        form = self.find_form(fields)
+        if form is not None:
+            fields += [FormField(name, 'value', dummy_id, required=False) for name, element in form.inputs.items()
+                       if name.endswith('passengerDataIdNumber') and not element.value]
+        return self.submit_form('confirm_ticket', fields, 'submit')
+
+    def log_stats(self) -> None:
+        """Log where the booking spent its time"""
+        total = sum(sum(timings) for timings in self.timings.values())
+        self.logger.info(f"HTTP requests: {sum(len(timings) for timings in self.timings.values())} "
+                         f"totalling {total:.2f}s "
+                         f"{ {stage: round(sum(timings), 3) for stage, timings in self.timings.items()} }")
+        self.logger.info(f"Pages: {self.snapshot.fetches}, parses: {self.snapshot.parses}")
+        self.logger.info(f"OCR service stats: {self.ocr_service.stats()}")
+        self.logger.info(f"Low-confidence captchas refreshed instead of submitted: {self.saved_submits}")
@@ -0,0 +1,74 @@
+"""normalize_captcha and EngineTracker persistence"""
+import threading
+import time
+import orjson
+from utils.captcha_ocr import EngineTracker, normalize_captcha
+
+
+def test_normalize_maps_lookalikes_into_charset():
+    assert normalize_captcha('a7c9') == ('A7C9', 0, 0)
+    assert normalize_captcha('O1SZ') == ('Q75Z', 3, 0)
+    assert normalize_captcha('AJ2#') == ('AJ2#', 0, 2)
+    # Look-alikes normalize to the same answer
+    assert normalize_captcha('QO17')[0] == normalize_captcha('OQI7')[0]
+
+
+def test_tracker_save_and_load(tmp_path):
+    path = tmp_path / 'engines.json'
+    tracker = EngineTracker(path)
+    tracker.observe('holey', 0.2, True)
+    tracker.verdict('holey', False)
+    tracker.save()
+
+    loaded = EngineTracker(path)
+    assert loaded.engines == tracker.engines
+    assert loaded.engines['holey']['samples'] == 1
+    assert loaded.engines['holey']['verdicts'] == 1
+
+
+def test_tracker_concurrent_saves_stay_valid(tmp_path):
+    path = tmp_path / 'engines.json'
+    tracker = EngineTracker(path)
+
+    def work(index: int) -> None:
+        for _ in range(20):
+            tracker.observe('holey', 0.1 * index, True)
+            tracker.save()
+
+    threads = [threading.Thread(target=work, args=(index,)) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert orjson.loads(path.read_bytes())['holey']['samples'] == 160   # pylint: disable=maybe-no-member
+    assert [file.name for file in tmp_path.iterdir()] == ['engines.json']
+
+
+def test_tracker_save_soon_batches_writes(tmp_path):
+    path = tmp_path / 'engines.json'
+    tracker = EngineTracker(path, save_interval=0.1)
+    tracker.verdict('gemini', True)
+    tracker.save_soon()
+    tracker.verdict('gemini', True)
+    tracker.save_soon()
+    assert not path.exists()
+
+    time.sleep(0.3)
+    assert EngineTracker(path).engines['gemini']['verdicts'] == 2
+
+
+def test_tracker_corrupt_file_falls_back_to_priors(tmp_path):
+    path = tmp_path / 'engines.json'
+    path.write_bytes(b'{"holey": ')
+    tracker = EngineTracker(path, epsilon=0)
+    assert tracker.engines == {}
+    assert tracker.accuracy('gemini') == EngineTracker.PRIORS['gemini']['accuracy']
+
+
+def test_tracker_orders_by_expected_time(tmp_path):
+    tracker = EngineTracker(tmp_path / 'engines.json', epsilon=0)
+    for _ in range(30):
+        tracker.observe('holey', 2.0, False)
+        tracker.observe('gemini', 0.3, True)
+    assert tracker.order(['holey', 'gemini']) == ['gemini', 'holey']
@@ -0,0 +1,78 @@
+"""
+Round-trip budget of a booking: the browser form fill is one WebDriver
+command, and an HTTP booking against the mock site takes one request per stage
+"""
+import logging
+import threading
+from argparse import Namespace
+import pytest
+from benchmarks.mock_thsrc import Latency, MockTHSRC, prepare
+from configs.config import directories, fields as user_fields
+from services.base_service import RoundTripCounter
+from services.form_fill import FormField, fill_form
+
+
+class FakeDriver:
+    """Just enough of a WebDriver: every call goes through execute()"""
+
+    def __init__(self, result: dict):
+        self.result = result
+        self.commands = []
+
+    def execute(self, driver_command, params=None):
+        self.commands.append(driver_command)
+        return {'value': self.result}
+
+    def execute_script(self, script, *args):
+        return self.execute('executeScript', {'script': script, 'args': list(args)})['value']
+
+
+def test_fill_form_is_one_round_trip():
+    driver = FakeDriver({'missing': [], 'missingRequired': [], 'changed': ['a', 'b'], 'submitted': True})
+    counter = RoundTripCounter.attach(driver)
+    fields = [FormField('a', 'value', 'x'), FormField('b', 'radio', 1), FormField('c', 'check', True)]
+
+    with counter.stage('booking_form'):
+        result = fill_form(driver, fields, submit='SubmitButton', hide=['.overlay'], close=['.close'])
+
+    assert counter.stages == {'booking_form': 1}
+    assert counter.total == 1
+    assert result == {'missing': [], 'missing_required': [], 'changed': ['a', 'b'], 'submitted': True}
+
+
+def test_fill_form_reports_missing_required():
+    driver = FakeDriver({'missing': ['a'], 'missingRequired': ['a'], 'changed': [], 'submitted': False})
+    result = fill_form(driver, [FormField('a', 'value', 'x')], submit='SubmitButton')
+    assert result['missing_required'] == ['a']
+    assert not result['submitted']
+
+
+@pytest.fixture
+def mock_site(tmp_path, monkeypatch):
+    """Mock THSRC that accepts every captcha, with OCR stats kept out of .cache"""
+    monkeypatch.setattr(directories, 'cache', tmp_path)
+    monkeypatch.delenv('GEMINI_API_KEY', raising=False)
+    server = MockTHSRC(latency=Latency(1, 0.1), accept_rate=1.0, ocr_latency=Latency(1, 0.1), ocr_accuracy=1.0)
+    monkeypatch.setenv('THSRC_BASE_URL', server.url)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_http_booking_round_trip_budget(mock_site, monkeypatch):
+    monkeypatch.setitem(user_fields, 'THSRC', {**user_fields['THSRC'], 'train-no': ''})
+    entry, config = prepare(mock_site, 'thsrc-http')
+    args = Namespace(log=logging.getLogger(__name__), config=config, service=entry['name'],
+                     locale=None, auto=True, list=False)
+    bot = entry['class'](args)
+    try:
+        with pytest.raises(SystemExit) as exit_info:
+            bot.main()
+    finally:
+        bot.close()
+
+    assert exit_info.value.code == 0
+    requests = {stage: len(timings) for stage, timings in bot.timings.items()}
+    assert requests == {'load': 1, 'captcha': 1, 'booking_form': 1, 'confirm_train': 1, 'confirm_ticket': 1}
+    assert mock_site.counts['bookings'] == 1
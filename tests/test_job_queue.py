@@ -0,0 +1,74 @@
+"""JobQueue ordering: priority, then round-robin across users, then FIFO"""
+import threading
+import time
+import pytest
+from services.job_queue import CANCELLED, SUCCEEDED, Job, JobQueue, QueueFull
+
+
+def wait_for(condition, timeout: float = 5.0) -> None:
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def blocked_queue():
+    """One-worker queue whose first job ('block') holds the worker until `gate` is set"""
+    gate = threading.Event()
+    ran = []
+
+    def runner(job):
+        if job.data['name'] == 'block':
+            gate.wait(5)
+        ran.append(job.data['name'])
+        return True
+
+    jobs = JobQueue(runner, workers=1, aging=0, max_pending=4)
+    blocker = jobs.submit({'name': 'block'}, user='z')
+    wait_for(lambda: blocker.started is not None)
+    yield jobs, gate, ran
+    gate.set()
+    jobs.close()
+
+
+def test_priority_then_users_take_turns(blocked_queue):
+    jobs, gate, ran = blocked_queue
+    submitted = [jobs.submit({'name': 'a1'}, user='a'), jobs.submit({'name': 'a2'}, user='a'),
+                 jobs.submit({'name': 'b1'}, user='b'), jobs.submit({'name': 'c1'}, user='c', priority=1)]
+    assert jobs.position(submitted[3]) == 0
+
+    gate.set()
+    wait_for(lambda: all(job.status == SUCCEEDED for job in submitted))
+    assert ran == ['block', 'c1', 'a1', 'b1', 'a2']
+
+
+def test_cancelled_job_never_runs(blocked_queue):
+    jobs, gate, ran = blocked_queue
+    cancelled = jobs.submit({'name': 'cancelled'}, user='a')
+    kept = jobs.submit({'name': 'kept'}, user='a')
+    assert jobs.cancel(cancelled.id)
+    assert cancelled.status == CANCELLED and cancelled.cancelled
+
+    gate.set()
+    wait_for(lambda: kept.status == SUCCEEDED)
+    assert ran == ['block', 'kept']
+    assert not jobs.cancel(kept.id)
+
+
+def test_queue_full(blocked_queue):
+    jobs, _, _ = blocked_queue
+    for index in range(4):
+        jobs.submit({'name': f'job{index}'}, user='a')
+    with pytest.raises(QueueFull):
+        jobs.submit({'name': 'one too many'}, user='b')
+
+
+def test_aging_lifts_waiting_jobs():
+    jobs = JobQueue(lambda job: True, workers=1, aging=10)
+    jobs.close()
+    old, new = Job({}, 'a'), Job({}, 'b', priority=1)
+    now = time.monotonic()
+    old.queued_at, new.queued_at = now - 25, now - 5
+    # Two levels of waiting beat one level of priority
+    assert jobs._rank(old, now) > jobs._rank(new, now)   # pylint: disable=protected-access
@@ -6,7 +6,7 @@ import sys
 import argparse
 import logging
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
 import time
 from zoneinfo import ZoneInfo
 from logging import INFO, DEBUG
@@ -19,15 +19,26 @@ except ImportError:
     pass
 
 from services import service_map
+from services.race import BookingRace
 from configs.config import config, app_name, filenames, schedules, __version__
 from utils.io import load_toml
 
 
+def wait_until(target: datetime) -> None:
+    """Sleep until target, printing the current time"""
+    current_time = datetime.now(target.tzinfo)
+    while current_time < target:
+        print(
+            f"\rCurrent time: {current_time.strftime('%Y-%m-%d %H:%M:%S')}", end='')
+        time.sleep(min(1, (target - current_time).total_seconds()))
+        current_time = datetime.now(target.tzinfo)
+
+
 def main() -> None:
     """args command"""
 
     support_services = ', '.join(
-        sorted((service['name'] for service in service_map), key=str.lower))
+        sorted((service['keyword'] for service in service_map), key=str.lower))
 
     parser = argparse.ArgumentParser(
         description="Support auto buy tickets from THSR ticket",
@@ -51,6 +62,17 @@ def main() -> None:
         dest='locale',
         help="interface language",
     )
+    parser.add_argument('--lean',
+                        dest='lean',
+                        action='store_true',
+                        help="lean page loads (block images, fonts, CSS and analytics)")
+    parser.add_argument('-r',
+                        '--race',
+                        dest='race_sessions',
+                        type=int,
+                        default=1,
+                        metavar='N',
+                        help="race N sessions for the trip, the first past the captcha books")
     parser.add_argument('-p',
                         '--proxy',
                         dest='proxy',
@@ -118,8 +140,11 @@ def main() -> None:
         args.config = service_config
         args.service = service['name']
 
-        if schedules[service['name']].get('datetime'):
-            schedule_time = schedules[service['name']]['datetime']
+        schedule = schedules[service['name']]
+        schedule_time = None
+        prearm = 0
+        if schedule.get('datetime'):
+            schedule_time = schedule['datetime']
             timezone = ZoneInfo('Asia/Taipei')
             current_time = datetime.now(timezone)
             if re.search(r'^\d+:\d+$', schedule_time):
@@ -127,15 +152,29 @@ def main() -> None:
 
             schedule_time = datetime.strptime(
                 schedule_time, '%Y-%m-%d %H:%M').astimezone(timezone)
+            prearm = float(schedule.get('prearm') or 0)
             logging.info("The bot will auto buy tickets on %s", schedule_time)
-            while current_time.time() <= schedule_time.time():
-                current_time = datetime.now(ZoneInfo('Asia/Taipei'))
-                print(
-                    f"\rCurrent time: {current_time.strftime('%Y-%m-%d %H:%M:%S')}", end='')
-                time.sleep(1)
+            if prearm:
+                logging.info("Session will be pre-armed %.0f seconds before", prearm)
+            wait_until(schedule_time - timedelta(seconds=prearm))
 
         start = datetime.now()
-        service['class'](args).main()
+        if args.race_sessions > 1:
+            if prearm:
+                # Searching before T0 can be rejected as out of the bookable range
+                logging.warning("Pre-arming is not supported when racing, sessions start at %s", schedule_time)
+                wait_until(schedule_time)
+            report = BookingRace(service['class'], args, args.race_sessions).run()
+            logging.info("\n%s took %.3f seconds", app_name, float(
+                (datetime.now() - start).total_seconds()))
+            sys.exit(0 if report['winner'] is not None else 1)
+
+        bot = service['class'](args)
+        if prearm and hasattr(bot, 'prearm'):
+            bot.prearm(schedule_time.timestamp(),
+                       captcha_lead=float(schedule.get('captcha-lead') or 8))
+            start = datetime.now()
+        bot.main()
         logging.info("\n%s took %.3f seconds", app_name, float(
             (datetime.now() - start).total_seconds()))
 
@@ -2,141 +2,1120 @@
 Dual Captcha OCR System: holey.cc + Gemini Vision
 Combines multiple OCR methods to achieve higher accuracy
 """
+from __future__ import annotations
 import os
+import asyncio
 import base64
+import hashlib
+import io
+import itertools
 import logging
+import random
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import NamedTuple
 import httpx
+import orjson
+from configs.config import directories
+from utils.local_ocr import CAPTCHA_LENGTH, CHARSET, LocalOCR
 
 logger = logging.getLogger('CaptchaOCR')
 
+ENGINE_LABELS = {'local': 'Local', 'holey': 'Holey.cc', 'gemini': 'Gemini'}
+
+# HTTP/2 needs the optional `h2` package (httpx[http2])
+try:
+    import h2  # noqa: F401  pylint: disable=unused-import
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Image preprocessing and perceptual hashing need NumPy and Pillow
+try:
+    import numpy as np
+    from PIL import Image
+    from utils.local_ocr import otsu_threshold, remove_specks
+    IMAGING_AVAILABLE = True
+except ImportError:
+    IMAGING_AVAILABLE = False
+
+GEMINI_PROMPT = """Look at this CAPTCHA image and extract the text/characters shown.
+Rules:
+- The CAPTCHA contains alphanumeric characters (letters and numbers)
+- Return ONLY the characters you see, nothing else
+- No spaces, no explanation, just the raw characters
+- Case sensitive - preserve uppercase/lowercase as shown
+- Common confusions: 0 vs O, 1 vs l vs I, 5 vs S
+- If unsure between similar characters, make your best guess
+
+Output the captcha text only:"""
+
+# Input each engine gets by default: the raw captcha for the remote engines
+# ('clean' is opt-in via [captcha] preprocess until `benchmarks.ocr_benchmark
+# --live --preprocess` shows a gain). The local engine always gets what its
+# weights were trained on.
+DEFAULT_VARIANTS = {'holey': 'original', 'gemini': 'original'}
+
+# Look-alikes engines answer with, mapped into THSRC's captcha charset
+LOOKALIKES = {
+    '0': 'Q', 'O': 'Q', 'D': 'Q', '1': '7', 'I': '7', 'L': '7', 'S': '5',
+    '8': '3', 'B': '3', 'G': 'C', 'E': 'F', 'P': 'R', 'X': 'K', 'V': 'Y', 'W': 'M',
+}
+# Confidence factor per look-alike substitution / per character outside the charset
+SUBSTITUTION_PENALTY = 0.6
+UNKNOWN_PENALTY = 0.1
+
+
+class Candidate(NamedTuple):
+    """One possible answer for a captcha"""
+    text: str
+    confidence: float   # 0..1, shared with the competing candidates
+    engines: tuple      # engines whose answer normalizes to `text`
+    # This captcha gave a reason to doubt the answer (look-alikes, characters outside
+    # the charset, engines disagreeing, an unsure local guess), not just engine priors
+    doubt: bool = False
+
+
+def normalize_captcha(text: str) -> tuple:
+    """
+    Map an engine answer into THSRC's charset (uppercase, look-alikes replaced).
+    Returns (text, substitutions, characters still outside the charset).
+    """
+    chars = []
+    substitutions = unknown = 0
+    for char in text.upper():
+        if char not in CHARSET and char in LOOKALIKES:
+            char = LOOKALIKES[char]
+            substitutions += 1
+        elif char not in CHARSET:
+            unknown += 1
+        chars.append(char)
+    return ''.join(chars), substitutions, unknown
+
+
+def image_mime_type(image_data: bytes) -> str:
+    """Sniff the image format (network-captured captchas are not always PNG)"""
+    if image_data.startswith(b'\xff\xd8'):
+        return "image/jpeg"
+    if image_data.startswith((b'GIF87a', b'GIF89a')):
+        return "image/gif"
+    return "image/png"
+
+
+def perceptual_hash(image_data: bytes) -> int:
+    """64-bit difference hash; re-encoded or rescaled copies of an image hash alike"""
+    with Image.open(io.BytesIO(image_data)) as image:
+        small = image.convert('L').resize((9, 8), Image.BILINEAR)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = np.packbits((pixels[:, 1:] > pixels[:, :-1]).ravel())
+    return int.from_bytes(bits.tobytes(), 'big')
+
+
+def adaptive_threshold(gray: np.ndarray, block: int = 15, offset: float = 0.05) -> np.ndarray:
+    """Ink where a pixel is darker than its block x block neighbourhood mean by `offset` (integral image)"""
+    radius = block // 2
+    padded = np.pad(gray, radius, mode='edge')
+    integral = np.pad(padded.cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+    total = (integral[block:, block:] - integral[:-block, block:]
+             - integral[block:, :-block] + integral[:-block, :-block])
+    return gray < total / (block * block) - offset
+
+
+def remove_arc(ink: np.ndarray, max_thickness: int = 4, degree: int = 2) -> np.ndarray:
+    """
+    Erase the curve THSRC draws across the captcha.
+    Columns holding only a few ink pixels are assumed to be arc-only; a
+    polynomial through their centres (refitted without outliers) gives the
+    arc, and a band of its measured thickness is cleared along it.
+    """
+    height, width = ink.shape
+    counts = ink.sum(axis=0)
+    rows = np.arange(height)[:, None]
+    xs = np.flatnonzero((counts > 0) & (counts <= max_thickness))
+    if xs.size < max(width // 4, degree + 2):
+        return ink
+    ys = (ink[:, xs] * rows).sum(axis=0) / counts[xs]
+    coeffs = np.polyfit(xs, ys, degree)
+    keep = np.abs(np.polyval(coeffs, xs) - ys) <= 2
+    if keep.sum() > degree + 1:
+        coeffs = np.polyfit(xs[keep], ys[keep], degree)
+    thickness = float(np.median(counts[xs[keep]])) if keep.any() else 2.0
+    curve = np.polyval(coeffs, np.arange(width))
+    return ink & ~(np.abs(rows - curve[None, :]) <= thickness / 2 + 1)
+
+
+def clean_captcha(image_data: bytes, max_height: int = 48) -> np.ndarray:
+    """
+    Ink mask of the captcha glyphs: grayscale, downscale to `max_height`,
+    adaptive threshold, speck and arc removal, tight crop. Pure NumPy
+    array operations, about 1-2 ms for a THSRC captcha.
+    """
+    with Image.open(io.BytesIO(image_data)) as image:
+        image = image.convert('L')
+        if image.height > max_height:
+            image = image.resize((round(image.width * max_height / image.height), max_height), Image.BOX)
+        gray = np.asarray(image, dtype=np.float32) / 255.0
+
+    ink = adaptive_threshold(gray) & (gray < otsu_threshold(gray) + 0.1)
+    ink = remove_specks(remove_arc(remove_specks(ink)))
+
+    # Crop to the glyphs, ignoring columns with a single stray pixel
+    rows = np.flatnonzero(ink.any(axis=1))
+    cols = np.flatnonzero(ink.sum(axis=0) > 1)
+    if rows.size and cols.size:
+        ink = ink[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    return ink
+
+
+def encode_mask(ink: np.ndarray, border: int = 4) -> bytes:
+    """PNG of an ink mask, black on white with a small border"""
+    pixels = np.pad(np.where(ink, 0, 255).astype(np.uint8), border, constant_values=255)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='PNG', optimize=False)
+    return buffer.getvalue()
+
+
+class PreparedCaptcha:
+    """
+    Engine inputs for one captcha, computed on first use and shared by
+    every engine of a recognition:
+    'original' (raw bytes), 'mask' (cleaned ink array), 'clean' (PNG of the mask).
+    Variants fall back to the original bytes when NumPy/Pillow are missing
+    or the image can't be decoded.
+    """
+
+    def __init__(self, image_data: bytes):
+        self.original = image_data
+        self._variants = {'original': image_data}
+        self._lock = threading.Lock()
+        self.elapsed = 0.0
+
+    def get(self, variant: str):
+        """Engine input for a variant name"""
+        with self._lock:
+            if variant not in self._variants:
+                start = time.perf_counter()
+                self._variants[variant] = self._build(variant)
+                self.elapsed += time.perf_counter() - start
+            return self._variants[variant]
+
+    def _build(self, variant: str):
+        if not IMAGING_AVAILABLE or variant not in ('mask', 'clean'):
+            return self.original
+        try:
+            if 'mask' not in self._variants:
+                self._variants['mask'] = clean_captcha(self.original)
+            mask = self._variants['mask']
+            return mask if variant == 'mask' else encode_mask(mask)
+        except Exception as e:
+            logger.warning(f"Captcha preprocessing failed: {e}")
+            return self.original
+
+
+class RecognitionCache:
+    """
+    LRU memo of engine answers keyed by the SHA-256 of the image bytes.
+
+    Each image keeps one slot per engine holding its answer, or None for a
+    known failure, so the same bytes are never sent to the same engine
+    twice. Entries expire after `ttl` seconds. With `perceptual=True` an
+    image whose difference hash is within `max_distance` bits of a cached
+    one shares that entry (e.g. a screenshot of a network-captured image).
+    """
+
+    def __init__(self, max_size: int = 256, ttl: float = 600, perceptual: bool = False, max_distance: int = 4):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.perceptual = perceptual and IMAGING_AVAILABLE
+        self.max_distance = max_distance
+        self._entries = OrderedDict()   # sha256 -> {'created', 'phash', 'results'}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.near_hits = 0
+
+    def get(self, image_data: bytes, engine: str) -> tuple:
+        """Return (found, result) for an engine's earlier answer on this image"""
+        entry = self._entry(image_data)
+        with self._lock:
+            found = engine in entry['results']
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return found, entry['results'].get(engine)
+
+    def put(self, image_data: bytes, engine: str, result) -> None:
+        """Remember an engine's answer (None for a failure)"""
+        entry = self._entry(image_data)
+        with self._lock:
+            entry['results'][engine] = result
+
+    def tried(self, image_data: bytes) -> set:
+        """Engines that already answered or failed on this image"""
+        entry = self._entry(image_data)
+        with self._lock:
+            return set(entry['results'])
+
+    def stats(self) -> dict:
+        """Lookups, hit rate and size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'lookups': lookups,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'near_hits': self.near_hits,
+            }
+
+    def _entry(self, image_data: bytes) -> dict:
+        """Find or create the entry for an image, evicting expired and least recent ones"""
+        key = hashlib.sha256(image_data).hexdigest()
+        now = time.monotonic()
+        with self._lock:
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if now - oldest['created'] <= self.ttl:
+                    break
+                self._entries.popitem(last=False)
+
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+
+        phash = self._phash(image_data)
+        with self._lock:
+            entry = self._entries.get(key) or self._near_duplicate(phash)
+            if entry is None:
+                entry = {'created': now, 'phash': phash, 'results': {}}
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return entry
+
+    def _phash(self, image_data: bytes):
+        if not self.perceptual:
+            return None
+        try:
+            return perceptual_hash(image_data)
+        except Exception as e:
+            logger.debug(f"Perceptual hash failed: {e}")
+            return None
+
+    def _near_duplicate(self, phash):
+        if phash is None:
+            return None
+        for entry in self._entries.values():
+            if entry['phash'] is not None and bin(entry['phash'] ^ phash).count('1') <= self.max_distance:
+                self.near_hits += 1
+                return entry
+        return None
+
+
+class EngineTracker:
+    """
+    Decaying per-engine latency, validation pass rate and server-confirmed
+    accuracy, used to pick the engine order.
+
+    An order is scored by its expected time to a correct answer: engines
+    are tried until one returns a valid answer, and a wrong answer costs a
+    full submit/refresh cycle (`retry_cost` seconds) before trying again.
+    With probability `epsilon` a random order is used, so an engine that
+    fell behind is re-measured once it recovers. Stats persist to JSON
+    across restarts; `save_soon` batches writes onto a timer thread so a
+    verdict never waits for the disk.
+    """
+
+    # Starting point for engines without history
+    PRIORS = {
+        'local': {'latency': 0.01, 'pass_rate': 0.5, 'accuracy': 0.9},
+        'holey': {'latency': 0.5, 'pass_rate': 0.9, 'accuracy': 0.7},
+        'gemini': {'latency': 1.5, 'pass_rate': 0.9, 'accuracy': 0.9},
+    }
+
+    def __init__(self, path=None, alpha: float = 0.2, epsilon: float = 0.05, retry_cost: float = 4.0,
+                 save_interval: float = 30.0):
+        self.path = path or directories.cache / 'ocr_engines.json'
+        self.alpha = alpha
+        self.epsilon = epsilon
+        self.retry_cost = retry_cost
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        # Serializes writers (timer, close, other threads) so saves never interleave
+        self._save_lock = threading.Lock()
+        self._save_timer = None
+        self.engines = {}
+        try:
+            self.engines = orjson.loads(self.path.read_bytes())   # pylint: disable=maybe-no-member
+        except (OSError, ValueError):
+            pass
+
+    def _stat(self, name: str) -> dict:
+        if name not in self.engines:
+            prior = self.PRIORS.get(name, {'latency': 1.0, 'pass_rate': 0.9, 'accuracy': 0.8})
+            self.engines[name] = {**prior, 'deviation': prior['latency'] / 2, 'samples': 0, 'verdicts': 0}
+        return self.engines[name]
+
+    def _decay(self, stat: dict, key: str, value: float) -> None:
+        stat[key] += self.alpha * (value - stat[key])
+
+    def observe(self, name: str, latency: float, valid: bool) -> None:
+        """Record one engine call"""
+        with self._lock:
+            stat = self._stat(name)
+            self._decay(stat, 'deviation', abs(latency - stat['latency']))
+            self._decay(stat, 'latency', latency)
+            self._decay(stat, 'pass_rate', float(valid))
+            stat['samples'] += 1
+
+    def verdict(self, name: str, correct: bool) -> None:
+        """Record whether an engine's answer was right according to the server"""
+        with self._lock:
+            stat = self._stat(name)
+            self._decay(stat, 'accuracy', float(correct))
+            stat['verdicts'] += 1
+
+    def expected_time(self, order: list) -> float:
+        """Expected seconds until a correct answer when engines are tried in `order`"""
+        with self._lock:
+            stats = [self._stat(name) for name in order]
+        elapsed = correct = 0.0
+        reach = 1.0   # probability that every earlier engine failed validation
+        for stat in stats:
+            elapsed += reach * stat['latency']
+            correct += reach * stat['pass_rate'] * stat['accuracy']
+            reach *= 1 - stat['pass_rate']
+        if correct <= 0:
+            return float('inf')
+        return (elapsed + (1 - correct) * self.retry_cost) / correct
+
+    def order(self, names: list) -> list:
+        """Best order of the available engines, or a random one when exploring"""
+        if len(names) < 2:
+            return list(names)
+        if random.random() < self.epsilon:
+            return random.sample(names, len(names))
+        return list(min(itertools.permutations(names), key=self.expected_time))
+
+    def accuracy(self, name: str) -> float:
+        """How often the engine's valid answers were accepted by the server"""
+        with self._lock:
+            return self._stat(name)['accuracy']
+
+    def hedge_delay(self, name: str) -> float:
+        """How long to give an engine before hedging: its typical latency plus two deviations"""
+        with self._lock:
+            stat = self._stat(name)
+            return stat['latency'] + 2 * stat['deviation']
+
+    def save_soon(self) -> None:
+        """Save within save_interval seconds on a background thread (one write per interval)"""
+        with self._lock:
+            if self._save_timer is not None:
+                return
+            self._save_timer = threading.Timer(self.save_interval, self.save)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def save(self) -> None:
+        """Persist the stats now (atomic replace), superseding a pending save_soon"""
+        with self._save_lock:
+            with self._lock:
+                timer, self._save_timer = self._save_timer, None
+                data = orjson.dumps(self.engines)   # pylint: disable=maybe-no-member
+            if timer is not None:
+                timer.cancel()
+            temp = None
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with tempfile.NamedTemporaryFile(dir=self.path.parent, prefix=f'.{self.path.name}.',
+                                                 suffix='.tmp', delete=False) as temp:
+                    temp.write(data)
+                os.replace(temp.name, self.path)
+            except OSError as e:
+                logger.warning(f"Failed to save OCR engine stats: {e}")
+                if temp is not None and os.path.exists(temp.name):
+                    os.unlink(temp.name)
+
 
 class CaptchaOCR:
     """
     Dual captcha recognition system using:
     1. holey.cc API (primary, fast)
     2. Gemini Vision API (fallback, more accurate)
+    Both are preceded by the offline engine in utils.local_ocr once
+    trained weights exist; it answers only when confident.
     """
 
-    def __init__(self, holey_api_url: str = None):
+    def __init__(self, holey_api_url: str = None, timeout: float = 10,
+                 local_weights: str = None, local_min_confidence: float = 0.9,
+                 cache_size: int = 256, cache_ttl: float = 600, perceptual_cache: bool = False,
+                 tracker: EngineTracker = None, variants: dict = None, max_hedged: int = 8):
         self.holey_api_url = holey_api_url or "https://ocr.holey.cc/thsrc"
         self.gemini_api_key = os.environ.get('GEMINI_API_KEY')
         self.gemini_model = None
+        self.local_ocr = None
+        if LocalOCR.is_available(local_weights):
+            try:
+                self.local_ocr = LocalOCR(local_weights, local_min_confidence)
+                logger.info("Local OCR engine loaded")
+            except Exception as e:
+                logger.warning(f"Failed to load local OCR weights: {e}")
+
+        # Long-lived keep-alive client for holey.cc (created on first use)
+        self.timeout = timeout  # Reduced timeout for faster fallback
+        self._client = None
+        self._client_lock = threading.Lock()
+        self.last_timings = {}
+
+        # asyncio API: AsyncClient and the background loop behind recognize_future
+        self._async_client = None
+        self._async_client_loop = None
+        self._loop = None
+        self._gemini_rest = False
+
+        # Per-engine stats and hedging; a losing request can't be interrupted, so
+        # every hedged recognition in flight (web jobs, race sessions) may hold two workers
+        self.max_hedged = max_hedged
+        self._executor = None
+        self._stats_lock = threading.Lock()
+        self.engine_stats = {}
+        self.recognitions = 0
+        self.last_agreement = None
+        # Every engine call of the latest recognition (for the captcha store)
+        self.last_attempts = []
+        # Called with the engine name on HTTP 429 / quota errors
+        self.quota_listeners = []
+
+        # Engine answers per image, so retries never resend identical bytes
+        self.cache = RecognitionCache(cache_size, cache_ttl, perceptual_cache)
+
+        # Live engine stats that decide the order when none is forced
+        self.tracker = tracker or EngineTracker()
+
+        # Preprocessed image variant per engine (see PreparedCaptcha)
+        self.variants = {**DEFAULT_VARIANTS, **(variants or {})}
+        if self.local_ocr:
+            self.variants['local'] = self.local_ocr.model.variant
 
         # Initialize Gemini if API key is available
         if self.gemini_api_key:
-            try:
-                import google.generativeai as genai
-                genai.configure(api_key=self.gemini_api_key)
-                # Use gemini-2.0-flash-exp for vision capabilities
-                self.gemini_model = genai.GenerativeModel('gemini-2.0-flash-exp')
-                logger.info("Gemini Vision API initialized (gemini-2.0-flash-exp)")
-            except Exception as e:
-                logger.warning(f"Failed to initialize Gemini: {e}")
-                self.gemini_model = None
+            self.configure_gemini(self.gemini_api_key)
+
+    def configure_gemini(self, api_key: str) -> bool:
+        """(Re)build the Gemini client for an API key; the other engines are untouched"""
+        self.gemini_api_key = api_key
+        try:
+            import google.generativeai as genai
+            # GEMINI_API_ENDPOINT points the REST transport elsewhere (e.g. a benchmark stand-in)
+            endpoint = os.environ.get('GEMINI_API_ENDPOINT')
+            if endpoint:
+                genai.configure(api_key=api_key, transport='rest',
+                                client_options={'api_endpoint': endpoint})
+                self._gemini_rest = True
+            else:
+                genai.configure(api_key=api_key)
+            # Use gemini-2.0-flash-exp for vision capabilities
+            self.gemini_model = genai.GenerativeModel('gemini-2.0-flash-exp')
+            logger.info("Gemini Vision API initialized (gemini-2.0-flash-exp)")
+            return True
+        except Exception as e:
+            logger.warning(f"Failed to initialize Gemini: {e}")
+            self.gemini_model = None
+            return False
+
+    @classmethod
+    def from_config(cls, config: dict) -> CaptchaOCR:
+        """Build from a service config ([api] captcha_ocr and the [captcha] section)"""
+        captcha_config = config.get('captcha', {})
+        return cls(
+            config.get('api', {}).get('captcha_ocr'),
+            local_weights=captcha_config.get('local-weights') or None,
+            local_min_confidence=captcha_config.get('local-min-confidence', 0.9),
+            cache_size=captcha_config.get('cache-size', 256),
+            cache_ttl=captcha_config.get('cache-ttl', 600),
+            perceptual_cache=captcha_config.get('perceptual-cache', False),
+            variants=captcha_config.get('preprocess'),
+        )
+
+    @property
+    def engines(self) -> dict:
+        """Available OCR engines by name"""
+        engines = {'local': self._ocr_local} if self.local_ocr else {}
+        engines['holey'] = self._ocr_holey
+        if self.gemini_model:
+            engines['gemini'] = self._ocr_gemini
+        return engines
 
-    def recognize(self, image_data: bytes, use_gemini_first: bool = False) -> str:
+    def engine_order(self, use_gemini_first: bool = None) -> list:
+        """Engine names in the order they should be tried (adaptive when use_gemini_first is None)"""
+        if use_gemini_first is None:
+            return self.tracker.order(list(self.engines))
+        order = ['local'] + (['gemini', 'holey'] if use_gemini_first else ['holey', 'gemini'])
+        return [name for name in order if name in self.engines]
+
+    def recognize(self, image_data: bytes, use_gemini_first: bool = None) -> str:
         """
         Recognize captcha using dual OCR system
 
         Args:
             image_data: Raw image bytes
-            use_gemini_first: If True, try Gemini first then holey.cc
+            use_gemini_first: If True, try Gemini first then holey.cc;
+                None picks the order from live engine stats
 
         Returns:
             Recognized captcha text or None
         """
-        if use_gemini_first and self.gemini_model:
-            # Try Gemini first
-            result = self._ocr_gemini(image_data)
-            if result and self._validate_captcha(result):
-                logger.info(f"[Gemini] Captcha: {result}")
+        self._count_recognition()
+        prepared = PreparedCaptcha(image_data)
+        for name in self.engine_order(use_gemini_first):
+            result = self._run_engine(name, image_data, prepared)
+            if result:
+                self._record_win(name)
+                logger.info(f"[{ENGINE_LABELS[name]}] Captcha: {result}")
                 return result
 
-            # Fallback to holey.cc
-            result = self._ocr_holey(image_data)
-            if result and self._validate_captcha(result):
-                logger.info(f"[Holey.cc] Captcha: {result}")
+        logger.warning("Both OCR methods failed")
+        return None
+
+    def recognize_hedged(self, image_data: bytes, use_gemini_first: bool = None,
+                         hedge_delay: float = 0.0, agreement_wait: float = 0.0) -> str:
+        """
+        Recognize captcha by racing both engines
+
+        Args:
+            image_data: Raw image bytes
+            use_gemini_first: Which engine starts first (None: from live engine stats)
+            hedge_delay: Seconds to give the first engine before starting the
+                second one (0 sends both at once, None derives it from the
+                first engine's latency)
+            agreement_wait: Seconds to wait for the losing engine after a
+                winner so agreement can be used as a confidence signal
+
+        Returns:
+            First result that passes validation, or None
+        """
+        order = [name for name in self.engine_order(use_gemini_first) if name != 'local']
+        if len(order) < 2:
+            return self.recognize(image_data, use_gemini_first)
+
+        if hedge_delay is None:
+            hedge_delay = self.tracker.hedge_delay(order[0])
+
+        self._count_recognition()
+        self.last_agreement = None
+        prepared = PreparedCaptcha(image_data)
+        # The local engine takes about a millisecond, so it is not worth racing
+        if self.local_ocr:
+            result = self._run_engine('local', image_data, prepared)
+            if result:
+                self._record_win('local')
+                logger.info(f"[{ENGINE_LABELS['local']}] Captcha: {result}")
                 return result
+
+        futures = {self.executor.submit(self._run_engine, order[0], image_data, prepared): order[0]}
+        done = set()
+        if hedge_delay > 0:
+            done, _ = wait(futures, timeout=hedge_delay)
+        winner = self._first_valid(done, futures)
+
+        if winner is None:
+            futures[self.executor.submit(self._run_engine, order[1], image_data, prepared)] = order[1]
+            pending = set(futures) - done
+            while pending and winner is None:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                winner = self._first_valid(done, futures)
+
+        if winner is None:
+            logger.warning("Both OCR methods failed")
+            return None
+
+        name, result = winner
+        losers = [future for future in futures if futures[future] != name]
+        if agreement_wait > 0 and losers:
+            finished, _ = wait(losers, timeout=agreement_wait)
+            answers = [future.result() for future in finished if future.result()]
+            if answers:
+                self.last_agreement = normalize_captcha(answers[0])[0] == normalize_captcha(result)[0]
+                logger.info(f"OCR engines {'agree' if self.last_agreement else 'disagree'}")
+
+        # A request already in flight can't be interrupted; its result is ignored
+        for future in losers:
+            future.cancel()
+
+        self._record_win(name)
+        logger.info(f"[{ENGINE_LABELS[name]}] Captcha: {result} (hedged)")
+        return result
+
+    async def recognize_async(self, image_data: bytes, use_gemini_first: bool = None,
+                              hedge_delay: float = None, attempts: list = None) -> str:
+        """
+        Recognize captcha without blocking the event loop
+
+        Args:
+            image_data: Raw image bytes
+            use_gemini_first: Engine order (None: from live engine stats)
+            hedge_delay: None tries engines one after the other; a number
+                starts the next engine after that many seconds (0 = all
+                at once). Losing requests are cancelled in flight.
+            attempts: List the engine calls are logged to (default: last_attempts)
+
+        Returns:
+            Recognized captcha text or None
+        """
+        self._count_recognition()
+        prepared = PreparedCaptcha(image_data)
+        order = self.engine_order(use_gemini_first)
+        # The local engine takes about a millisecond, so it runs inline
+        if 'local' in order:
+            order.remove('local')
+            result = await self._run_engine_async('local', image_data, prepared, attempts)
+            if result:
+                return self._win('local', result)
+
+        if hedge_delay is None:
+            for name in order:
+                result = await self._run_engine_async(name, image_data, prepared, attempts)
+                if result:
+                    return self._win(name, result)
+            logger.warning("Both OCR methods failed")
+            return None
+
+        tasks = {}
+        try:
+            while order or tasks:
+                if order:
+                    name = order.pop(0)
+                    tasks[asyncio.ensure_future(self._run_engine_async(name, image_data, prepared, attempts))] = name
+                done, _ = await asyncio.wait(tasks, timeout=hedge_delay if order else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = tasks.pop(task)
+                    if task.result():
+                        return self._win(name, task.result())
+            logger.warning("Both OCR methods failed")
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def recognize_future(self, image_data: bytes, **kwargs) -> Future:
+        """
+        Start recognize_async on this instance's background event loop and
+        return a concurrent.futures.Future, so synchronous code (the Selenium
+        flow) can start OCR as soon as it has the bytes and collect the
+        result when it needs it. `future.attempts` lists the engine calls.
+        """
+        attempts = []
+        future = asyncio.run_coroutine_threadsafe(
+            self.recognize_async(image_data, attempts=attempts, **kwargs), self.loop)
+        future.attempts = attempts
+        return future
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        """Background event loop for recognize_future (started on first use)"""
+        with self._client_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='ocr-loop', daemon=True).start()
+            return self._loop
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        """Pooled keep-alive asyncio HTTP client; use it from one event loop only"""
+        if self._async_client is None:
+            # The loop whose connections the client holds; close() shuts it down there
+            self._async_client_loop = asyncio.get_running_loop()
+            self._async_client = httpx.AsyncClient(
+                timeout=self.timeout,
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_connections=8, max_keepalive_connections=8, keepalive_expiry=120),
+            )
+        return self._async_client
+
+    def _win(self, name: str, result: str) -> str:
+        self._record_win(name)
+        logger.info(f"[{ENGINE_LABELS[name]}] Captcha: {result}")
+        return result
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """Worker threads for hedged requests: two per hedged recognition in flight (max_hedged)"""
+        with self._client_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=2 * self.max_hedged, thread_name_prefix='ocr')
+            return self._executor
+
+    def stats(self) -> dict:
+        """Per-engine latency, validation pass rate and win rate"""
+        with self._stats_lock:
+            return {
+                name: {
+                    'calls': stat['calls'],
+                    'avg_latency_ms': round(stat['latency'] / stat['calls'] * 1000, 1) if stat['calls'] else 0.0,
+                    'pass_rate': round(stat['valid'] / stat['calls'], 3) if stat['calls'] else 0.0,
+                    'win_rate': round(stat['wins'] / self.recognitions, 3) if self.recognitions else 0.0,
+                }
+                for name, stat in self.engine_stats.items()
+            }
+
+    def _run_engine(self, name: str, image_data: bytes, prepared: PreparedCaptcha = None, attempts: list = None):
+        """
+        Run one engine on its preferred image variant, record its latency, return its result if valid.
+        The call is logged to `attempts` (default: last_attempts).
+        """
+        if attempts is None:
+            attempts = self.last_attempts
+        found, cached = self._lookup(name, image_data, attempts)
+        if found:
+            return cached
+
+        engine_input = (prepared or PreparedCaptcha(image_data)).get(self.variants.get(name, 'original'))
+        timings = {}
+        start = time.perf_counter()
+        if name == 'holey':
+            result = self._ocr_holey(engine_input, timings)
         else:
-            # Try holey.cc first (default, faster)
-            result = self._ocr_holey(image_data)
-            if result and self._validate_captcha(result):
-                logger.info(f"[Holey.cc] Captcha: {result}")
-                return result
+            result = self.engines[name](engine_input)
+        # Engine stats track inference: a (re)connect says nothing about the engine
+        latency = time.perf_counter() - start - timings.get('connect', 0.0)
+        return self._record(name, image_data, result, latency, attempts)
 
-            # Fallback to Gemini
-            if self.gemini_model:
-                result = self._ocr_gemini(image_data)
-                if result and self._validate_captcha(result):
-                    logger.info(f"[Gemini] Captcha: {result}")
-                    return result
+    async def _run_engine_async(self, name: str, image_data: bytes, prepared: PreparedCaptcha = None,
+                                attempts: list = None):
+        """_run_engine for the asyncio API"""
+        if attempts is None:
+            attempts = self.last_attempts
+        found, cached = self._lookup(name, image_data, attempts)
+        if found:
+            return cached
 
-        logger.warning("Both OCR methods failed")
+        engine_input = (prepared or PreparedCaptcha(image_data)).get(self.variants.get(name, 'original'))
+        timings = {}
+        start = time.perf_counter()
+        if name == 'holey':
+            result = await self._ocr_holey_async(engine_input, timings)
+        elif name == 'gemini':
+            result = await self._ocr_gemini_async(engine_input)
+        else:
+            result = self.engines[name](engine_input)
+        latency = time.perf_counter() - start - timings.get('connect', 0.0)
+        return self._record(name, image_data, result, latency, attempts)
+
+    def _lookup(self, name: str, image_data: bytes, attempts: list) -> tuple:
+        """Cached (found, result) for an engine and image, logged as an attempt when found"""
+        found, cached = self.cache.get(image_data, name)
+        if found:
+            with self._stats_lock:
+                attempts.append(
+                    {'engine': name, 'answer': cached, 'valid': bool(cached), 'cached': True, 'latency_ms': 0.0})
+        return found, cached
+
+    def _record(self, name: str, image_data: bytes, result, latency: float, attempts: list):
+        """
+        Validate an engine answer, update stats and cache, return it if valid.
+        The local engine answers (guess, confidence); a guess below its
+        min-confidence is not a result but stays in the attempt as a (weak) candidate.
+        """
+        guess, confidence = result if name == 'local' else (result, None)
+        if name == 'local':
+            result = guess if confidence >= self.local_ocr.min_confidence else None
+            if guess and result is None:
+                logger.info(f"[Local] Low confidence {confidence:.2f} for {guess}")
+        valid = bool(result) and self._validate_captcha(result)
+        self.tracker.observe(name, latency, valid)
+        attempt = {'engine': name, 'answer': result, 'valid': valid, 'cached': False, 'latency_ms': latency * 1000}
+        if name == 'local':
+            attempt['answer'] = guess
+            attempt['confidence'] = confidence
+        with self._stats_lock:
+            stat = self.engine_stats.setdefault(name, {'calls': 0, 'valid': 0, 'wins': 0, 'latency': 0.0})
+            stat['calls'] += 1
+            stat['valid'] += valid
+            stat['latency'] += latency
+            attempts.append(attempt)
+        self.cache.put(image_data, name, result if valid else None)
+        return result if valid else None
+
+    def report_verdict(self, attempts: list, answer: str, accepted: bool) -> None:
+        """
+        Feed the server's verdict on a submitted answer back into the engine stats.
+        `attempts` are the last_attempts of the recognition that produced `answer`.
+        """
+        for attempt in attempts:
+            if attempt['cached'] or not attempt['valid']:
+                continue
+            same = normalize_captcha(attempt['answer'])[0] == normalize_captcha(answer)[0]
+            if accepted or same:
+                # A rejected answer says nothing about engines that answered differently
+                self.tracker.verdict(attempt['engine'], accepted and same)
+        self.tracker.save_soon()
+
+    def candidates(self, attempts: list = None) -> list:
+        """
+        Possible answers from a recognition's engine calls (default:
+        last_attempts), most likely first.
+
+        Each answer is normalized into THSRC's charset and scored by its
+        engine's server-confirmed accuracy (the local engine: its lowest
+        character probability), discounted per look-alike substitution and
+        per character outside the charset. Engines agreeing on a text
+        combine as independent evidence; competing texts share the
+        confidence, so a disagreement lowers both. `doubt` marks answers
+        this captcha itself makes questionable.
+        """
+        if attempts is None:
+            attempts = self.last_attempts
+        answers = {}
+        for attempt in attempts:
+            if attempt['answer']:
+                # The latest call per engine (a cache hit repeats an earlier one)
+                answers[attempt['engine']] = attempt
+
+        scores = {}
+        doubts = set()
+        for name, attempt in answers.items():
+            text, substitutions, unknown = normalize_captcha(attempt['answer'])
+            if len(text) != CAPTCHA_LENGTH:
+                continue
+            score = attempt.get('confidence') or self.tracker.accuracy(name)
+            score *= SUBSTITUTION_PENALTY ** substitutions * UNKNOWN_PENALTY ** unknown
+            miss, engines = scores.get(text, (1.0, ()))
+            scores[text] = (miss * (1 - score), engines + (name,))
+            unsure_local = attempt.get('confidence') is not None and not attempt['valid']
+            if substitutions or unknown or unsure_local:
+                doubts.add(text)
+
+        evidence = {text: 1 - miss for text, (miss, _) in scores.items()}
+        total = max(1.0, sum(evidence.values()))
+        disagree = len(scores) > 1
+        return sorted(
+            (Candidate(text, round(evidence[text] / total, 3), engines, disagree or text in doubts)
+             for text, (_, engines) in scores.items()),
+            key=lambda candidate: candidate.confidence, reverse=True)
+
+    @staticmethod
+    def _first_valid(done: set, futures: dict):
+        for future in done:
+            if future.result():
+                return futures[future], future.result()
         return None
 
-    def _ocr_holey(self, image_data: bytes) -> str:
-        """Use holey.cc API for OCR"""
-        try:
-            base64_str = base64.b64encode(image_data).decode("utf-8")
-            base64_url_safe = base64_str.replace('+', '-').replace('/', '_').replace('=', '')
+    def _count_recognition(self) -> None:
+        with self._stats_lock:
+            self.recognitions += 1
+            self.last_attempts = []
+
+    def _record_win(self, name: str) -> None:
+        with self._stats_lock:
+            self.engine_stats[name]['wins'] += 1
 
-            with httpx.Client(timeout=10) as client:  # Reduced timeout for faster fallback
-                res = client.post(
-                    self.holey_api_url,
-                    json={'base64_str': base64_url_safe}
+    @property
+    def client(self) -> httpx.Client:
+        """Pooled keep-alive HTTP client (HTTP/2 when available)"""
+        with self._client_lock:
+            if self._client is None:
+                self._client = httpx.Client(
+                    timeout=self.timeout,
+                    http2=HTTP2_AVAILABLE,
+                    limits=httpx.Limits(max_connections=max(4, self.max_hedged),
+                                        max_keepalive_connections=max(4, self.max_hedged), keepalive_expiry=120),
                 )
+            return self._client
 
-            if res.status_code == 200:
-                data = res.json()
-                return data.get('data', '').strip()
+    def warm_up(self) -> float:
+        """
+        Pre-establish the connection to holey.cc (DNS, TCP, TLS) so the first
+        captcha only pays for inference. Returns the connect time in seconds.
+        """
+        timings = {}
+        try:
+            self.client.head(self.holey_api_url, extensions={'trace': self._tracer(timings)})
+        except Exception as e:
+            logger.warning(f"Holey.cc warm-up failed: {e}")
+            return 0.0
+        connect = timings.get('connect', 0.0)
+        logger.info(f"Holey.cc connection warmed up ({connect * 1000:.0f} ms connect)")
+        return connect
+
+    def close(self) -> None:
+        """Close pooled connections and persist engine stats"""
+        self.tracker.save()
+        with self._client_lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+            loop, self._loop = self._loop, None
+            client, self._async_client = self._async_client, None
+            client_loop, self._async_client_loop = self._async_client_loop, None
+        if client is not None:
+            self._close_async_client(client, client_loop)
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+
+    @staticmethod
+    def _close_async_client(client: httpx.AsyncClient, loop: asyncio.AbstractEventLoop) -> None:
+        """Close the AsyncClient on the loop that owns it: the background loop or a caller's own"""
+        try:
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is loop:
+                # close() called from a coroutine on that loop: it can't block on itself
+                loop.create_task(client.aclose())
+            elif loop.is_running():
+                asyncio.run_coroutine_threadsafe(client.aclose(), loop).result(timeout=5)
+            elif not loop.is_closed():
+                loop.run_until_complete(client.aclose())
             else:
-                logger.warning(f"Holey.cc API error: HTTP {res.status_code}")
-                return None
+                # Its loop is gone (e.g. asyncio.run() returned); its transports went with it
+                asyncio.run(client.aclose())
+        except Exception as e:
+            logger.warning(f"Failed to close the async HTTP client: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
+    @staticmethod
+    def _tracer(timings: dict, asynchronous: bool = False):
+        """httpx trace hook splitting a request into connect and inference time (async hook for AsyncClient)"""
+        marks = {}
+
+        def trace(event_name: str, _info: dict) -> None:
+            now = time.perf_counter()
+            if event_name == 'connection.connect_tcp.started':
+                marks['connect'] = now
+            elif event_name in ('connection.connect_tcp.complete', 'connection.start_tls.complete'):
+                timings['connect'] = now - marks.get('connect', now)
+            elif event_name.endswith('send_request_headers.started'):
+                marks['request'] = now
+            elif event_name.endswith('receive_response_headers.complete'):
+                timings['inference'] = now - marks.get('request', now)
+
+        async def atrace(event_name: str, info: dict) -> None:
+            trace(event_name, info)
+
+        return atrace if asynchronous else trace
+
+    def _ocr_local(self, image) -> tuple:
+        """Use the offline NumPy engine for OCR (image bytes or a cleaned ink mask): (guess, confidence)"""
+        try:
+            return self.local_ocr.recognize(image)
         except Exception as e:
-            logger.warning(f"Holey.cc OCR failed: {e}")
-            return None
+            logger.warning(f"Local OCR failed: {e}")
+            return None, 0.0
 
-    def _ocr_gemini(self, image_data: bytes) -> str:
-        """Use Gemini Vision API for OCR"""
-        if not self.gemini_model:
+    @staticmethod
+    def _holey_payload(image_data: bytes) -> dict:
+        base64_str = base64.b64encode(image_data).decode("utf-8")
+        return {'base64_str': base64_str.replace('+', '-').replace('/', '_').replace('=', '')}
+
+    def _holey_result(self, res: httpx.Response) -> str:
+        if res.status_code == 200:
+            data = res.json()
+            return data.get('data', '').strip()
+        logger.warning(f"Holey.cc API error: HTTP {res.status_code}")
+        if res.status_code == 429:
+            self._quota_exceeded('holey')
+        return None
+
+    def _ocr_holey(self, image_data: bytes, timings: dict = None) -> str:
+        """Use holey.cc API for OCR; connect/inference seconds go to `timings`"""
+        timings = {} if timings is None else timings
+        timings['connect'] = 0.0
+        try:
+            res = self.client.post(
+                self.holey_api_url,
+                json=self._holey_payload(image_data),
+                extensions={'trace': self._tracer(timings)},
+            )
+            self._log_holey_timings(timings)
+            return self._holey_result(res)
+
+        except Exception as e:
+            logger.warning(f"Holey.cc OCR failed: {e}")
             return None
 
+    async def _ocr_holey_async(self, image_data: bytes, timings: dict = None) -> str:
+        """Use holey.cc API for OCR (asyncio); connect/inference seconds go to `timings`"""
+        timings = {} if timings is None else timings
+        timings['connect'] = 0.0
         try:
-            import google.generativeai as genai
+            res = await self.async_client.post(
+                self.holey_api_url,
+                json=self._holey_payload(image_data),
+                extensions={'trace': self._tracer(timings, asynchronous=True)},
+            )
+            self._log_holey_timings(timings)
+            return self._holey_result(res)
+        except Exception as e:
+            logger.warning(f"Holey.cc OCR failed: {e}")
+            return None
 
-            # Create image part for Gemini
-            image_part = {
-                "mime_type": "image/png",
-                "data": image_data
-            }
+    def _log_holey_timings(self, timings: dict) -> None:
+        self.last_timings = timings
+        logger.info(
+            f"[Holey.cc] connect {timings['connect'] * 1000:.0f} ms, "
+            f"inference {timings.get('inference', 0.0) * 1000:.0f} ms")
 
-            prompt = """Look at this CAPTCHA image and extract the text/characters shown.
-Rules:
-- The CAPTCHA contains alphanumeric characters (letters and numbers)
-- Return ONLY the characters you see, nothing else
-- No spaces, no explanation, just the raw characters
-- Case sensitive - preserve uppercase/lowercase as shown
-- Common confusions: 0 vs O, 1 vs l vs I, 5 vs S
-- If unsure between similar characters, make your best guess
+    @staticmethod
+    def _gemini_text(response) -> str:
+        if response and response.text:
+            # Remove any quotes or extra characters
+            return response.text.strip().replace('"', '').replace("'", '').strip()
+        return None
 
-Output the captcha text only:"""
+    def _gemini_failed(self, error: Exception) -> None:
+        logger.warning(f"Gemini OCR failed: {error}")
+        if getattr(error, 'code', None) == 429 or 'quota' in str(error).lower():
+            self._quota_exceeded('gemini')
 
-            response = self.gemini_model.generate_content([prompt, image_part])
+    def _ocr_gemini(self, image_data: bytes) -> str:
+        """Use Gemini Vision API for OCR"""
+        if not self.gemini_model:
+            return None
 
-            if response and response.text:
-                # Clean up the response
-                result = response.text.strip()
-                # Remove any quotes or extra characters
-                result = result.replace('"', '').replace("'", '').strip()
-                return result
+        try:
+            image_part = {"mime_type": image_mime_type(image_data), "data": image_data}
+            response = self.gemini_model.generate_content([GEMINI_PROMPT, image_part])
+            return self._gemini_text(response)
+        except Exception as e:
+            self._gemini_failed(e)
+            return None
 
+    async def _ocr_gemini_async(self, image_data: bytes) -> str:
+        """Use Gemini Vision API for OCR (asyncio)"""
+        if not self.gemini_model:
             return None
+        if self._gemini_rest:
+            # The SDK's REST transport has no async client
+            return await asyncio.to_thread(self._ocr_gemini, image_data)
 
+        try:
+            image_part = {"mime_type": image_mime_type(image_data), "data": image_data}
+            response = await self.gemini_model.generate_content_async([GEMINI_PROMPT, image_part])
+            return self._gemini_text(response)
         except Exception as e:
-            logger.warning(f"Gemini OCR failed: {e}")
+            self._gemini_failed(e)
             return None
 
+    def _quota_exceeded(self, name: str) -> None:
+        for listener in self.quota_listeners:
+            listener(name)
+
     def _validate_captcha(self, text: str) -> bool:
         """Validate captcha format (THSRC uses 4 alphanumeric characters)"""
         if not text:
@@ -152,14 +1131,17 @@ Output the captcha text only:"""
     def recognize_with_retry(self, image_data: bytes, max_retries: int = 3) -> str:
         """
         Try to recognize captcha with multiple attempts
-        Alternates between OCR methods for better accuracy
+        Engines are ordered by live stats; engines that already answered
+        this image are served from the cache, so a retry only queries the
+        ones that have not tried it yet
         """
         for attempt in range(max_retries):
-            # Alternate between methods
-            use_gemini_first = (attempt % 2 == 1)
-            result = self.recognize(image_data, use_gemini_first=use_gemini_first)
+            result = self.recognize(image_data)
             if result:
                 return result
+            if self.cache.tried(image_data) >= set(self.engines):
+                logger.info("Every OCR engine has already failed on this captcha")
+                break
             logger.info(f"OCR attempt {attempt + 1}/{max_retries} failed, retrying...")
 
         return None
@@ -177,5 +1159,5 @@ def recognize_captcha(image_data: bytes, holey_api_url: str = None) -> str:
     Returns:
         Recognized captcha text or None
     """
-    ocr = CaptchaOCR(holey_api_url)
-    return ocr.recognize(image_data)
+    with CaptchaOCR(holey_api_url) as ocr:
+        return ocr.recognize(image_data)
@@ -0,0 +1,216 @@
+"""
+This module is for recording captchas and the server's verdict on their answers.
+
+Each submitted captcha is stored with its raw bytes, every engine's answer
+and latency, the submitted answer and whether THSRC accepted it, in an
+SQLite database in WAL mode. Writes go through a queue to a background
+thread so recording never adds latency to a booking.
+
+    python -m utils.captcha_store stats
+    python -m utils.captcha_store export --out captchas/
+"""
+
+from __future__ import annotations
+import argparse
+import atexit
+import hashlib
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, Optional, Union
+from configs.config import directories
+from utils.captcha_ocr import image_mime_type, normalize_captcha
+
+DEFAULT_PATH = directories.cache / 'captchas.sqlite3'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS captchas (
+    id INTEGER PRIMARY KEY,
+    created REAL NOT NULL,
+    sha256 TEXT NOT NULL,
+    image BLOB NOT NULL,
+    answer TEXT,
+    accepted INTEGER
+);
+CREATE TABLE IF NOT EXISTS attempts (
+    captcha_id INTEGER NOT NULL REFERENCES captchas(id),
+    engine TEXT NOT NULL,
+    answer TEXT,
+    valid INTEGER NOT NULL,
+    cached INTEGER NOT NULL,
+    latency_ms REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS attempts_captcha ON attempts(captcha_id);
+CREATE INDEX IF NOT EXISTS captchas_accepted ON captchas(accepted);
+"""
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class CaptchaStore:
+    """
+    Append-only captcha corpus.
+
+    `record()` only enqueues; the writer thread batches rows into one
+    transaction per drain. When the queue is full the record is dropped
+    (and counted) instead of blocking the caller.
+    """
+
+    def __init__(self, path: Union[Path, str, None] = None, max_queue: int = 1000):
+        self.path = Path(path or DEFAULT_PATH)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._queue = queue.Queue(maxsize=max_queue)
+        self.written = 0
+        self.dropped = 0
+        self._writer = threading.Thread(target=self._write_loop, name='captcha-store', daemon=True)
+        self._writer.start()
+
+    def record(self, image_data: bytes, attempts: list, answer: Optional[str], accepted: Optional[bool]) -> None:
+        """
+        Queue one captcha.
+        `attempts` are CaptchaOCR.last_attempts entries; `accepted` is None
+        when the server response says nothing about the captcha.
+        """
+        try:
+            self._queue.put_nowait((time.time(), image_data, list(attempts), answer, accepted))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout: float = 5) -> None:
+        """Flush pending records and stop the writer"""
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.executescript(SCHEMA)
+        return connection
+
+    def _write_loop(self) -> None:
+        connection = self._connect()
+        try:
+            stop = False
+            while not stop:
+                batch = [self._queue.get()]
+                while True:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in batch:
+                    stop = True
+                    batch = [item for item in batch if item is not None]
+                try:
+                    with connection:
+                        for item in batch:
+                            self._insert(connection, *item)
+                    self.written += len(batch)
+                except sqlite3.Error as e:
+                    logger.warning(f"Captcha store write failed: {e}")
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _insert(connection: sqlite3.Connection, created: float, image_data: bytes, attempts: list,
+                answer: Optional[str], accepted: Optional[bool]) -> None:
+        cursor = connection.execute(
+            'INSERT INTO captchas (created, sha256, image, answer, accepted) VALUES (?, ?, ?, ?, ?)',
+            (created, hashlib.sha256(image_data).hexdigest(), image_data, answer,
+             None if accepted is None else int(accepted)))
+        connection.executemany(
+            'INSERT INTO attempts (captcha_id, engine, answer, valid, cached, latency_ms) VALUES (?, ?, ?, ?, ?, ?)',
+            [(cursor.lastrowid, attempt['engine'], attempt['answer'], int(attempt['valid']),
+              int(attempt['cached']), attempt['latency_ms']) for attempt in attempts])
+
+
+def get_captcha_store(path: Union[Path, str, None] = None) -> CaptchaStore:
+    """Process-wide store per database file, flushed at exit"""
+    path = Path(path or DEFAULT_PATH)
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = CaptchaStore(path)
+            atexit.register(_stores[path].close)
+        return _stores[path]
+
+
+def iter_labelled(path: Union[Path, str, None] = None, accepted_only: bool = True) -> Iterator[tuple]:
+    """
+    (label, image bytes) pairs for captchas the server accepted.
+    With `accepted_only=False`, rejected captchas are included with a None label.
+    """
+    connection = sqlite3.connect(f'file:{Path(path or DEFAULT_PATH)}?mode=ro', uri=True)
+    try:
+        query = 'SELECT answer, accepted, image FROM captchas'
+        if accepted_only:
+            query += ' WHERE accepted = 1'
+        for answer, accepted, image in connection.execute(query + ' ORDER BY id'):
+            yield (answer.upper() if accepted == 1 and answer else None), image
+    finally:
+        connection.close()
+
+
+def engine_accuracy(path: Union[Path, str, None] = None) -> dict:
+    """
+    Per-engine answers on captchas with a verdict, and how often they
+    matched the accepted answer (both normalized, as the submit path does)
+    """
+    connection = sqlite3.connect(f'file:{Path(path or DEFAULT_PATH)}?mode=ro', uri=True)
+    connection.create_function('normalize_captcha', 1, lambda text: normalize_captcha(text)[0] if text else None,
+                               deterministic=True)
+    try:
+        rows = connection.execute("""
+            SELECT a.engine, COUNT(*), AVG(a.latency_ms), SUM(a.valid),
+                   SUM(c.accepted = 1 AND normalize_captcha(a.answer) = normalize_captcha(c.answer))
+            FROM attempts a JOIN captchas c ON c.id = a.captcha_id
+            WHERE c.accepted IS NOT NULL AND a.cached = 0
+            GROUP BY a.engine
+        """).fetchall()
+    finally:
+        connection.close()
+    return {
+        engine: {
+            'answers': count,
+            'avg_latency_ms': round(latency or 0.0, 1),
+            'pass_rate': round((valid or 0) / count, 3),
+            'confirmed': correct or 0,
+        }
+        for engine, count, latency, valid, correct in rows
+    }
+
+
+def main() -> None:
+    """args command"""
+    parser = argparse.ArgumentParser(description="Inspect or export the captcha corpus")
+    parser.add_argument('--db', type=Path, default=DEFAULT_PATH)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('stats', help="per-engine answers and confirmed solves")
+    export_parser = subparsers.add_parser('export', help="write accepted captchas as <answer>_<n>.<ext>")
+    export_parser.add_argument('--out', type=Path, required=True)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    if args.command == 'stats':
+        for engine, stat in engine_accuracy(args.db).items():
+            logger.info('%-8s %s', engine, stat)
+        return
+
+    args.out.mkdir(parents=True, exist_ok=True)
+    count = 0
+    for count, (label, image) in enumerate(iter_labelled(args.db), 1):
+        suffix = image_mime_type(image).split('/')[1]
+        (args.out / f'{label}_{count:05d}.{suffix}').write_bytes(image)
+    logger.info('Exported %d captchas to %s', count, args.out)
+
+
+if __name__:
+    logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    main()
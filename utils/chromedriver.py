@@ -0,0 +1,138 @@
+"""
+This module is for resolving a ChromeDriver binary that matches the installed Chrome.
+"""
+
+from __future__ import annotations
+import logging
+import os
+import re
+import shutil
+import subprocess
+import threading
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+import orjson
+from configs.config import directories
+
+MANIFEST_PATH = directories.cache / 'chromedriver.json'
+
+CHROME_CANDIDATES = [
+    'google-chrome',
+    'google-chrome-stable',
+    'chromium',
+    'chromium-browser',
+    '/Applications/Google Chrome.app/Contents/MacOS/Google Chrome',
+]
+
+_lock = threading.Lock()
+_resolved: Optional[str] = None
+
+
+def _read_major(binary: str) -> Optional[int]:
+    """Run `<binary> --version` and return the major version"""
+    try:
+        output = subprocess.run([binary, '--version'], capture_output=True,
+                                text=True, timeout=10, check=False).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    match = re.search(r'(\d+)\.\d+\.\d+', output)
+    return int(match.group(1)) if match else None
+
+
+@lru_cache(maxsize=None)
+def detect_chrome_major(chrome_binary: Optional[str] = None) -> Optional[int]:
+    """Detect the installed Chrome major version (once per process)"""
+    candidates = [chrome_binary] if chrome_binary else CHROME_CANDIDATES
+    for candidate in candidates:
+        binary = candidate if os.path.isfile(candidate) else shutil.which(candidate)
+        if binary:
+            major = _read_major(binary)
+            if major:
+                return major
+    return None
+
+
+def load_manifest() -> dict:
+    """Read the cached Chrome to ChromeDriver mapping"""
+    try:
+        return orjson.loads(MANIFEST_PATH.read_bytes())   # pylint: disable=maybe-no-member
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest: dict) -> None:
+    """Write the cached Chrome to ChromeDriver mapping"""
+    MANIFEST_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = MANIFEST_PATH.with_suffix('.tmp')
+    tmp_path.write_bytes(orjson.dumps(manifest, option=orjson.OPT_INDENT_2))   # pylint: disable=maybe-no-member
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+def is_manifest_valid(manifest: dict, chrome_major: Optional[int]) -> bool:
+    """Cheap local check: same Chrome major and the driver binary is unchanged on disk"""
+    driver_path = manifest.get('driver_path')
+    if not driver_path or not chrome_major or manifest.get('chrome_major') != chrome_major:
+        return False
+    try:
+        stat = os.stat(driver_path)
+    except OSError:
+        return False
+    return (os.access(driver_path, os.X_OK)
+            and stat.st_size == manifest.get('driver_size')
+            and int(stat.st_mtime) == manifest.get('driver_mtime'))
+
+
+def resolve_chromedriver(force: bool = False) -> str:
+    """
+    Return a ChromeDriver path for the installed Chrome.
+    Uses the cached manifest when it still matches and only falls back
+    to webdriver-manager (network lookup/download) on mismatch.
+    """
+    global _resolved   # pylint: disable=global-statement
+
+    with _lock:
+        if _resolved and not force:
+            return _resolved
+
+        chrome_major = detect_chrome_major(os.environ.get('CHROME_BIN'))
+        manifest = load_manifest()
+        if not force and is_manifest_valid(manifest, chrome_major):
+            logger.info('Using cached ChromeDriver for Chrome %s: %s',
+                        chrome_major, manifest['driver_path'])
+            _resolved = manifest['driver_path']
+            return _resolved
+
+        logger.info('Resolving ChromeDriver via webdriver-manager (Chrome %s)...', chrome_major)
+        # pylint: disable=import-outside-toplevel
+        from webdriver_manager.chrome import ChromeDriverManager
+        driver_path = ChromeDriverManager().install()
+
+        driver_major = _read_major(driver_path)
+        if chrome_major and driver_major and driver_major != chrome_major:
+            logger.warning('ChromeDriver %s does not match Chrome %s',
+                           driver_major, chrome_major)
+        else:
+            stat = os.stat(driver_path)
+            save_manifest({
+                'chrome_major': chrome_major,
+                'driver_major': driver_major,
+                'driver_path': str(Path(driver_path).resolve()),
+                'driver_size': stat.st_size,
+                'driver_mtime': int(stat.st_mtime),
+            })
+
+        _resolved = driver_path
+        return _resolved
+
+
+def clear_process_cache() -> None:
+    """Forget the per-process resolution (used by the startup benchmark)"""
+    global _resolved   # pylint: disable=global-statement
+    with _lock:
+        _resolved = None
+    detect_chrome_major.cache_clear()
+
+
+if __name__:
+    logger = logging.getLogger(__name__)
@@ -0,0 +1,333 @@
+"""
+This module is for the offline captcha OCR engine (NumPy, CPU only).
+
+Captchas are binarized, cut into one glyph per character and classified
+by a small two-layer network whose weights are trained offline from
+labelled images:
+
+    python -m utils.local_ocr train --data captchas/ --out .cache/local_ocr.npz
+    python -m utils.local_ocr evaluate --data captchas/ --weights .cache/local_ocr.npz
+
+Labelled images are named after their answer, e.g. `AC7K.png` or
+`AC7K_0012.jpg`. By default training runs on the cleaned ink masks of
+utils.captcha_ocr.clean_captcha (arc and noise removed) and the weights
+record that, so CaptchaOCR feeds the model the same variant; `--raw`
+trains on the images as captured.
+"""
+
+from __future__ import annotations
+import argparse
+import io
+import logging
+import random
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional, Union
+from configs.config import directories
+
+try:
+    import numpy as np
+    from PIL import Image
+    LOCAL_OCR_AVAILABLE = True
+except ImportError:
+    LOCAL_OCR_AVAILABLE = False
+
+# Characters THSRC draws in its captchas
+CHARSET = '2345679ACFHKMNQRTYZ'
+CAPTCHA_LENGTH = 4
+GLYPH_SHAPE = (20, 16)
+DEFAULT_WEIGHTS = directories.cache / 'local_ocr.npz'
+IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg', '.gif')
+
+
+def decode_image(image_data: bytes) -> np.ndarray:
+    """Decode image bytes to a float32 grayscale array in [0, 1]"""
+    with Image.open(io.BytesIO(image_data)) as image:
+        return np.asarray(image.convert('L'), dtype=np.float32) / 255.0
+
+
+def otsu_threshold(gray: np.ndarray) -> float:
+    """Otsu's threshold from a 256-bin histogram"""
+    hist = np.bincount((gray * 255).astype(np.uint8).ravel(), minlength=256).astype(np.float64)
+    weight = np.cumsum(hist)
+    mean = np.cumsum(hist * np.arange(256))
+    total_weight, total_mean = weight[-1], mean[-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = (total_mean * weight - mean * total_weight) ** 2 / (weight * (total_weight - weight))
+    return float(np.nanargmax(between)) / 255.0
+
+
+def remove_specks(ink: np.ndarray, min_neighbours: int = 2) -> np.ndarray:
+    """Drop ink pixels with fewer than `min_neighbours` inked 8-neighbours"""
+    padded = np.pad(ink, 1).astype(np.uint8)
+    neighbours = sum(padded[1 + dy:padded.shape[0] - 1 + dy, 1 + dx:padded.shape[1] - 1 + dx]
+                     for dy in (-1, 0, 1) for dx in (-1, 0, 1)) - ink
+    return ink & (neighbours >= min_neighbours)
+
+
+def binarize(gray: np.ndarray) -> np.ndarray:
+    """Ink mask (dark pixels) with isolated specks removed"""
+    return remove_specks(gray < otsu_threshold(gray))
+
+
+def segment(ink: np.ndarray, length: int = CAPTCHA_LENGTH) -> list:
+    """
+    Cut the ink mask into `length` glyphs: boundaries start at equal widths
+    and snap to the emptiest column nearby.
+    """
+    cols = np.flatnonzero(ink.any(axis=0))
+    rows = np.flatnonzero(ink.any(axis=1))
+    if cols.size == 0:
+        return []
+    ink = ink[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    width = ink.shape[1]
+    if width < length:
+        return []
+
+    profile = ink.sum(axis=0)
+    slack = max(1, width // (3 * length))
+    bounds = [0]
+    for index in range(1, length):
+        guess = round(index * width / length)
+        low, high = max(bounds[-1] + 1, guess - slack), min(width - 1, guess + slack)
+        bounds.append(low + int(np.argmin(profile[low:high + 1])) if high >= low else guess)
+    bounds.append(width)
+    return [ink[:, start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def glyph_features(glyph: np.ndarray) -> np.ndarray:
+    """Crop a glyph to its ink and resample it to GLYPH_SHAPE"""
+    rows = np.flatnonzero(glyph.any(axis=1))
+    cols = np.flatnonzero(glyph.any(axis=0))
+    if rows.size:
+        glyph = glyph[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    height, width = glyph.shape
+    row_index = (np.arange(GLYPH_SHAPE[0]) * height / GLYPH_SHAPE[0]).astype(int)
+    col_index = (np.arange(GLYPH_SHAPE[1]) * width / GLYPH_SHAPE[1]).astype(int)
+    return glyph[np.ix_(row_index, col_index)].astype(np.float32).ravel()
+
+
+def extract_features(image: Union[bytes, np.ndarray], length: int = CAPTCHA_LENGTH) -> Optional[np.ndarray]:
+    """Feature matrix (one row per character) from image bytes, a grayscale array or an ink mask"""
+    if isinstance(image, (bytes, bytearray)):
+        image = decode_image(image)
+    ink = image if image.dtype == bool else binarize(image)
+    glyphs = segment(ink, length)
+    if len(glyphs) != length:
+        return None
+    return np.stack([glyph_features(glyph) for glyph in glyphs])
+
+
+class LocalModel:
+    """
+    Two-layer perceptron classifying one glyph at a time
+    """
+
+    def __init__(self, weights: dict, charset: str = CHARSET, variant: str = 'original'):
+        self.weights = weights
+        self.charset = charset
+        # Image variant the model was trained on (see utils.captcha_ocr.PreparedCaptcha)
+        self.variant = variant
+
+    @classmethod
+    def load(cls, path: Union[Path, str]) -> LocalModel:
+        """Load weights saved by `save`"""
+        with np.load(path) as data:
+            weights = {name: data[name] for name in ('w1', 'b1', 'w2', 'b2')}
+            charset = str(data['charset'])
+            variant = str(data['variant']) if 'variant' in data else 'original'
+        return cls(weights, charset, variant)
+
+    def save(self, path: Union[Path, str]) -> None:
+        """Save weights and charset to a .npz file"""
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        np.savez_compressed(path, charset=np.array(self.charset), variant=np.array(self.variant), **self.weights)
+
+    def predict_proba(self, features: np.ndarray) -> np.ndarray:
+        """Class probabilities, shape (characters, len(charset))"""
+        hidden = np.maximum(features @ self.weights['w1'] + self.weights['b1'], 0)
+        logits = hidden @ self.weights['w2'] + self.weights['b2']
+        logits -= logits.max(axis=1, keepdims=True)
+        exp = np.exp(logits)
+        return exp / exp.sum(axis=1, keepdims=True)
+
+    @classmethod
+    def train(cls, features: np.ndarray, labels: np.ndarray, charset: str = CHARSET, hidden: int = 128,
+              epochs: int = 400, learning_rate: float = 0.01, seed: int = 0, variant: str = 'original') -> LocalModel:
+        """Full-batch Adam on softmax cross-entropy"""
+        rng = np.random.default_rng(seed)
+        n_features, n_classes = features.shape[1], len(charset)
+        weights = {
+            'w1': (rng.standard_normal((n_features, hidden)) * np.sqrt(2 / n_features)).astype(np.float32),
+            'b1': np.zeros(hidden, dtype=np.float32),
+            'w2': (rng.standard_normal((hidden, n_classes)) * np.sqrt(2 / hidden)).astype(np.float32),
+            'b2': np.zeros(n_classes, dtype=np.float32),
+        }
+        moments = {name: (np.zeros_like(value), np.zeros_like(value)) for name, value in weights.items()}
+        targets = np.eye(n_classes, dtype=np.float32)[labels]
+        model = cls(weights, charset, variant)
+
+        for step in range(1, epochs + 1):
+            pre_hidden = features @ weights['w1'] + weights['b1']
+            hidden_out = np.maximum(pre_hidden, 0)
+            probs = model.predict_proba(features)
+            grad_logits = (probs - targets) / len(features)
+            grad_hidden = (grad_logits @ weights['w2'].T) * (pre_hidden > 0)
+            grads = {
+                'w2': hidden_out.T @ grad_logits,
+                'b2': grad_logits.sum(axis=0),
+                'w1': features.T @ grad_hidden,
+                'b1': grad_hidden.sum(axis=0),
+            }
+            for name, grad in grads.items():
+                first, second = moments[name]
+                first[:] = 0.9 * first + 0.1 * grad
+                second[:] = 0.999 * second + 0.001 * grad ** 2
+                corrected = first / (1 - 0.9 ** step) / (np.sqrt(second / (1 - 0.999 ** step)) + 1e-8)
+                weights[name] -= (learning_rate * corrected).astype(np.float32)
+        return model
+
+
+@lru_cache(maxsize=None)
+def load_model(path: str) -> LocalModel:
+    """Weights are loaded once per process"""
+    return LocalModel.load(path)
+
+
+class LocalOCR:
+    """
+    Offline OCR engine for CaptchaOCR
+    """
+
+    def __init__(self, weights_path: Union[Path, str, None] = None, min_confidence: float = 0.9):
+        self.model = load_model(str(weights_path or DEFAULT_WEIGHTS))
+        self.min_confidence = min_confidence
+
+    @staticmethod
+    def is_available(weights_path: Union[Path, str, None] = None) -> bool:
+        """NumPy/Pillow are installed and trained weights exist"""
+        return LOCAL_OCR_AVAILABLE and Path(weights_path or DEFAULT_WEIGHTS).is_file()
+
+    def predict(self, image: Union[bytes, np.ndarray]) -> tuple:
+        """Return (text, per-character probabilities) or (None, None)"""
+        features = extract_features(image)
+        if features is None:
+            return None, None
+        probs = self.model.predict_proba(features)
+        text = ''.join(self.model.charset[index] for index in probs.argmax(axis=1))
+        return text, probs
+
+    def recognize(self, image: Union[bytes, np.ndarray]) -> tuple:
+        """
+        (text, confidence): the best guess (None when unreadable) and its
+        lowest character probability; guesses below `min_confidence` are
+        for the caller to treat as unsure
+        """
+        text, probs = self.predict(image)
+        if text is None:
+            return None, 0.0
+        return text, float(probs.max(axis=1).min())
+
+
+def load_labelled(directory: Union[Path, str]) -> list:
+    """(label, image bytes) pairs from files named after their answer"""
+    samples = []
+    for path in sorted(Path(directory).iterdir()):
+        if path.suffix.lower() in IMAGE_SUFFIXES:
+            samples.append((path.stem.split('_')[0].upper(), path.read_bytes()))
+    return samples
+
+
+def prepare_samples(samples: list, variant: str) -> list:
+    """Turn (label, image bytes) pairs into the input variant a model is trained on"""
+    if variant == 'original':
+        return samples
+    from utils.captcha_ocr import PreparedCaptcha   # pylint: disable=import-outside-toplevel
+    return [(label, PreparedCaptcha(image_data).get(variant)) for label, image_data in samples]
+
+
+def build_dataset(samples: list, charset: str = CHARSET) -> tuple:
+    """Stack glyph features and class indices, skipping unusable samples"""
+    features, labels = [], []
+    for label, image_data in samples:
+        if len(label) != CAPTCHA_LENGTH or any(char not in charset for char in label):
+            continue
+        matrix = extract_features(image_data)
+        if matrix is None:
+            continue
+        features.append(matrix)
+        labels.extend(charset.index(char) for char in label)
+    if not features:
+        raise ValueError("No usable labelled captchas")
+    return np.concatenate(features), np.array(labels)
+
+
+def evaluate(engine: LocalOCR, samples: list) -> dict:
+    """Captcha/character accuracy and latency of an engine on labelled samples"""
+    correct = chars_correct = chars_total = 0
+    latencies = []
+    for label, image_data in samples:
+        start = time.perf_counter()
+        text, _ = engine.predict(image_data)
+        latencies.append(time.perf_counter() - start)
+        correct += text == label
+        chars_total += len(label)
+        chars_correct += sum(a == b for a, b in zip(text or '', label))
+    return {
+        'samples': len(samples),
+        'accuracy': correct / len(samples) if samples else 0.0,
+        'char_accuracy': chars_correct / chars_total if chars_total else 0.0,
+        'avg_latency_ms': sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+def main() -> None:
+    """args command"""
+    parser = argparse.ArgumentParser(description="Train or evaluate the local captcha OCR engine")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    train_parser = subparsers.add_parser('train', help="train weights from labelled images")
+    train_parser.add_argument('--data', type=Path, required=True)
+    train_parser.add_argument('--out', type=Path, default=DEFAULT_WEIGHTS)
+    train_parser.add_argument('--epochs', type=int, default=400)
+    train_parser.add_argument('--holdout', type=float, default=0.2, help="fraction kept for evaluation")
+    train_parser.add_argument('--raw', action='store_true', help="train on images as captured, not cleaned masks")
+    train_parser.add_argument('--seed', type=int, default=0, help="shuffle seed for the holdout split")
+    eval_parser = subparsers.add_parser('evaluate', help="evaluate weights on labelled images")
+    eval_parser.add_argument('--data', type=Path, required=True)
+    eval_parser.add_argument('--weights', type=Path, default=DEFAULT_WEIGHTS)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    samples = load_labelled(args.data)
+
+    if args.command == 'train':
+        variant = 'original' if args.raw else 'mask'
+        samples = prepare_samples(samples, variant)
+        # Files sort by label, so an unshuffled tail would be a label-biased holdout
+        random.Random(args.seed).shuffle(samples)
+        split = int(len(samples) * (1 - args.holdout))
+        train_samples, test_samples = samples[:split], samples[split:]
+        features, labels = build_dataset(train_samples)
+        model = LocalModel.train(features, labels, epochs=args.epochs, variant=variant)
+        model.save(args.out)
+        logger.info('Trained on %d captchas (%s), saved to %s', len(train_samples), variant, args.out)
+        samples = test_samples
+        if not samples:
+            return
+        load_model.cache_clear()
+
+    engine = LocalOCR(args.out if args.command == 'train' else args.weights)
+    if args.command == 'evaluate':
+        samples = prepare_samples(samples, engine.model.variant)
+    result = evaluate(engine, samples)
+    logger.info('Accuracy %.1f%% (characters %.1f%%) on %d captchas, %.2f ms per captcha',
+                result['accuracy'] * 100, result['char_accuracy'] * 100,
+                result['samples'], result['avg_latency_ms'])
+
+
+if __name__:
+    logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+"""
+This module is for the process-wide captcha OCR service.
+
+One CaptchaOCR (pooled HTTP clients, Gemini model, result cache, engine
+stats) is shared by every booking in the process. Each remote engine has
+its own bounded queue, worker threads and token bucket; the bucket halves
+its rate on a quota error (HTTP 429) and creeps back up on success, so
+concurrent bookings slow down together instead of all being throttled.
+Recognitions are returned as futures.
+"""
+
+from __future__ import annotations
+import atexit
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Optional
+from utils.captcha_ocr import ENGINE_LABELS, CaptchaOCR, PreparedCaptcha, normalize_captcha
+
+# Per remote engine: worker threads, sustained requests per second, burst
+DEFAULT_LIMITS = {
+    'holey': {'workers': 4, 'rate': 5.0, 'burst': 10},
+    'gemini': {'workers': 2, 'rate': 1.0, 'burst': 4},
+}
+
+_service: Optional[OCRService] = None
+_service_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Token bucket with AIMD rate control: a quota error halves the rate
+    (down to `base_rate / 16`) and drains the bucket, every success adds
+    back a tenth of the base rate.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.throttled = 0
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Take one token, waiting up to `timeout` seconds; False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    wait = min(wait, remaining)
+                self._cond.wait(wait)
+
+    def penalize(self) -> None:
+        """Quota error: halve the rate and empty the bucket"""
+        with self._cond:
+            self._refill()
+            self.rate = max(self.base_rate / 16, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+            self.throttled += 1
+
+    def reward(self) -> None:
+        """Successful call: recover towards the base rate"""
+        with self._cond:
+            if self.rate < self.base_rate:
+                self._refill()
+                self.rate = min(self.base_rate, self.rate + self.base_rate / 10)
+
+
+class OCRService:
+    """
+    Shared OCR engines behind per-engine queues and rate limits.
+
+    `submit()` returns a Future of the recognized text (None when every
+    engine failed); `future.attempts` lists the engine calls made for it,
+    in the CaptchaOCR.last_attempts format.
+    """
+
+    def __init__(self, ocr: CaptchaOCR, limits: Optional[dict] = None, queue_size: int = 32,
+                 acquire_timeout: float = 5.0):
+        self.ocr = ocr
+        self.acquire_timeout = acquire_timeout
+        self.rejected = 0
+        self.limits = limits or {}
+        self.queue_size = queue_size
+        self.buckets = {}
+        self.queues = {}
+        self._workers = []
+        self._engines_lock = threading.Lock()
+        ocr.quota_listeners.append(self._on_quota)
+
+        for name in ocr.engines:
+            if name != 'local':
+                self._start_engine(name)
+
+        # Open the holey.cc connection before the first captcha
+        threading.Thread(target=ocr.warm_up, daemon=True).start()
+
+    @classmethod
+    def from_config(cls, config: dict) -> OCRService:
+        """Build from a service config ([captcha] and [ocr-service] sections)"""
+        service_config = config.get('ocr-service', {})
+        limits = {
+            name: {key: service_config[f'{name}-{key}'] for key in ('workers', 'rate', 'burst')
+                   if f'{name}-{key}' in service_config}
+            for name in DEFAULT_LIMITS
+        }
+        return cls(CaptchaOCR.from_config(config), limits, service_config.get('queue-size', 32))
+
+    def _start_engine(self, name: str) -> None:
+        """Create the queue, rate limit and workers of a remote engine (once)"""
+        with self._engines_lock:
+            if name in self.queues:
+                return
+            limit = {**DEFAULT_LIMITS.get(name, DEFAULT_LIMITS['holey']), **self.limits.get(name, {})}
+            self.buckets[name] = TokenBucket(limit['rate'], limit['burst'])
+            self.queues[name] = queue.Queue(maxsize=self.queue_size)
+            for index in range(limit['workers']):
+                worker = threading.Thread(target=self._work, args=(name,), name=f'ocr-{name}-{index}', daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def configure_gemini(self, api_key: str) -> None:
+        """
+        Switch Gemini to a new API key in place: bookings holding this
+        service keep working and pick up the new key on their next captcha
+        """
+        if self.ocr.configure_gemini(api_key):
+            self._start_engine('gemini')
+
+    def submit(self, image_data: bytes, use_gemini_first: bool = None, hedge_delay: Optional[float] = None,
+               agreement_wait: float = 0.0) -> Future:
+        """
+        Recognize a captcha in the background.
+
+        Args:
+            image_data: Raw image bytes
+            use_gemini_first: Engine order (None: from live engine stats)
+            hedge_delay: None tries engines one after the other; a number
+                starts the next engine after that many seconds (0 = all at
+                once); 'auto' derives it from the first engine's latency
+            agreement_wait: Seconds to wait for the other engine after a
+                winner to compare answers (hedged only)
+        """
+        order = self.ocr.engine_order(use_gemini_first)
+        if hedge_delay == 'auto':
+            remote = [name for name in order if name != 'local']
+            hedge_delay = self.ocr.tracker.hedge_delay(remote[0]) if remote else None
+        recognition = _Recognition(self, image_data, order, hedge_delay, agreement_wait)
+        recognition.start()
+        return recognition.future
+
+    def submit_engine(self, name: str, image_data: bytes, prepared: PreparedCaptcha = None,
+                      attempts: list = None) -> Future:
+        """Queue one engine call; resolves to its valid result or None"""
+        future = Future()
+        if name == 'local':
+            future.set_running_or_notify_cancel()
+            future.set_result(self.ocr._run_engine(name, image_data, prepared, attempts))   # pylint: disable=protected-access
+            return future
+        try:
+            self.queues[name].put_nowait((future, image_data, prepared, attempts))
+        except queue.Full:
+            self.rejected += 1
+            logger.warning(f"[{ENGINE_LABELS[name]}] OCR queue full, skipping engine")
+            future.set_running_or_notify_cancel()
+            future.set_result(None)
+        return future
+
+    def _work(self, name: str) -> None:
+        while True:
+            job = self.queues[name].get()
+            if job is None:
+                return
+            future, image_data, prepared, attempts = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            if not self.buckets[name].acquire(self.acquire_timeout):
+                logger.warning(f"[{ENGINE_LABELS[name]}] Rate limited, skipping engine")
+                future.set_result(None)
+                continue
+            try:
+                result = self.ocr._run_engine(name, image_data, prepared, attempts)   # pylint: disable=protected-access
+            except Exception as e:
+                logger.warning(f"[{ENGINE_LABELS[name]}] OCR failed: {e}")
+                result = None
+            if result:
+                self.buckets[name].reward()
+            future.set_result(result)
+
+    def _on_quota(self, name: str) -> None:
+        if name in self.buckets:
+            self.buckets[name].penalize()
+            logger.warning(f"[{ENGINE_LABELS[name]}] Quota error, rate lowered to "
+                           f"{self.buckets[name].rate:.2f}/s")
+
+    def stats(self) -> dict:
+        """Engine stats plus queue depth, current rate and throttling per engine"""
+        return {
+            'engines': self.ocr.stats(),
+            'queues': {name: q.qsize() for name, q in self.queues.items()},
+            'rates': {name: round(bucket.rate, 2) for name, bucket in self.buckets.items()},
+            'throttled': {name: bucket.throttled for name, bucket in self.buckets.items()},
+            'rejected': self.rejected,
+            'cache': self.ocr.cache.stats(),
+        }
+
+    def close(self) -> None:
+        """Stop the workers and close the shared clients"""
+        for name, engine_queue in self.queues.items():
+            for _ in range(sum(worker.name.startswith(f'ocr-{name}-') for worker in self._workers)):
+                try:
+                    engine_queue.put_nowait(None)
+                except queue.Full:
+                    # Daemon workers; a full queue must not block the caller
+                    break
+        self.ocr.close()
+
+
+class _Recognition:
+    """One submitted captcha: walks the engine order via future callbacks, no thread of its own"""
+
+    def __init__(self, service: OCRService, image_data: bytes, order: list, hedge_delay: Optional[float],
+                 agreement_wait: float):
+        self.service = service
+        self.image_data = image_data
+        self.prepared = PreparedCaptcha(image_data)
+        self.pending = list(order)
+        self.hedge_delay = hedge_delay
+        self.agreement_wait = agreement_wait
+        self.running = {}
+        self.winner = None
+        self.finished = False
+        self.timer = None
+        self.lock = threading.RLock()
+        self.future = Future()
+        self.future.attempts = []
+        self.future.set_running_or_notify_cancel()
+
+    def start(self) -> None:
+        """Run the local engine inline, then queue the remote ones"""
+        self.service.ocr._count_recognition()   # pylint: disable=protected-access
+        with self.lock:
+            if 'local' in self.pending:
+                self.pending.remove('local')
+                future = self.service.submit_engine('local', self.image_data, self.prepared, self.future.attempts)
+                if future.result():
+                    self._finish(future.result(), 'local')
+                    return
+            self._launch_next()
+
+    def _launch_next(self) -> None:
+        if not self.pending:
+            if not self.running:
+                self._finish(None, None)
+            return
+        name = self.pending.pop(0)
+        future = self.service.submit_engine(name, self.image_data, self.prepared, self.future.attempts)
+        self.running[future] = name
+        future.add_done_callback(self._done)
+        if self.hedge_delay is not None and self.pending and not self.finished:
+            if self.hedge_delay <= 0:
+                self._launch_next()
+            else:
+                self.timer = threading.Timer(self.hedge_delay, self._hedge)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _hedge(self) -> None:
+        with self.lock:
+            if not self.finished and self.winner is None:
+                self._launch_next()
+
+    def _done(self, future: Future) -> None:
+        with self.lock:
+            name = self.running.pop(future, None)
+            result = None if future.cancelled() else future.result()
+            if self.finished:
+                return
+            if self.winner is not None:
+                # Agreement check: the other engine answered in time
+                if result:
+                    same = normalize_captcha(result)[0] == normalize_captcha(self.winner[1])[0]
+                    self.service.ocr.last_agreement = same
+                    logger.info(f"OCR engines {'agree' if self.service.ocr.last_agreement else 'disagree'}")
+                if not self.running:
+                    self._finish(self.winner[1], self.winner[0])
+                return
+            if result:
+                if self.agreement_wait > 0 and self.running:
+                    self.winner = (name, result)
+                    self._cancel_timer()
+                    self.timer = threading.Timer(self.agreement_wait, self._agreement_timeout)
+                    self.timer.daemon = True
+                    self.timer.start()
+                else:
+                    self._finish(result, name)
+                return
+            # This engine failed: move on without waiting for the hedge timer
+            self._cancel_timer()
+            self._launch_next()
+
+    def _agreement_timeout(self) -> None:
+        with self.lock:
+            if not self.finished:
+                self._finish(self.winner[1], self.winner[0])
+
+    def _cancel_timer(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def _finish(self, result, name) -> None:
+        self.finished = True
+        self._cancel_timer()
+        # Queued calls are dropped; a request already in flight can't be interrupted
+        for future in list(self.running):
+            future.cancel()
+        if result:
+            self.service.ocr._record_win(name)   # pylint: disable=protected-access
+            logger.info(f"[{ENGINE_LABELS[name]}] Captcha: {result}")
+        else:
+            logger.warning("All OCR engines failed")
+        self.future.set_result(result)
+
+
+def get_ocr_service(config: dict) -> OCRService:
+    """Process-wide OCR service (built from the first caller's service config)"""
+    global _service   # pylint: disable=global-statement
+    with _service_lock:
+        if _service is None:
+            _service = OCRService.from_config(config)
+            atexit.register(_service.close)
+        return _service
+
+
+def set_gemini_api_key(api_key: str) -> None:
+    """
+    Use a new Gemini API key from now on. The shared service is
+    reconfigured, not closed, so bookings that are running keep their OCR
+    """
+    with _service_lock:
+        if _service is not None:
+            _service.configure_gemini(api_key)
+
+
+if __name__:
+    logger = logging.getLogger(__name__)
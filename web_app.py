@@ -7,6 +7,7 @@ import threading
 from datetime import datetime
 from flask import Flask, render_template_string, request, jsonify
 from functools import wraps
+from services.job_queue import JobQueue, QueueFull, QUEUED, RUNNING
 
 # Load environment variables
 try:
@@ -21,16 +22,10 @@ app.secret_key = os.environ.get('SECRET_KEY', 'thsrc-ticket-bot-secret')
 # Password protection
 APP_PASSWORD = os.environ.get('APP_PASSWORD', '')
 
-# Global state for booking status
-booking_status = {
-    'running': False,
-    'logs': [],
-    'result': None,
-    'thread': None,
-    'attempt': 0,
-    'max_attempts': 50,  # Maximum auto-retry attempts
-    'stop_requested': False
-}
+# Booking jobs: how many run at once and how many may wait for a worker
+BOOKING_WORKERS = int(os.environ.get('BOOKING_WORKERS', 2))
+MAX_PENDING_JOBS = int(os.environ.get('MAX_PENDING_JOBS', 50))
+config_lock = threading.Lock()
 
 # Check Gemini API key availability
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY', '')
@@ -801,6 +796,10 @@ HTML_TEMPLATE = '''
                         <label>重試間隔 (秒)</label>
                         <input type="number" name="retry_interval" value="5" min="1" max="60">
                     </div>
+                    <div class="form-group">
+                        <label>同時搶票工作階段數</label>
+                        <input type="number" name="race_sessions" value="1" min="1" max="8">
+                    </div>
                 </div>
 
                 <div style="display: flex; gap: 16px; margin-top: 32px;">
@@ -943,6 +942,9 @@ HTML_TEMPLATE = '''
         });
 
         let pollInterval = null;
+        // This page's own job: other users' jobs run on the same server
+        let jobId = null;
+        let logOffset = 0;
 
         form.addEventListener('submit', async (e) => {
             e.preventDefault();
@@ -966,6 +968,9 @@ HTML_TEMPLATE = '''
                 });
 
                 if (response.ok) {
+                    const booking = await response.json();
+                    jobId = booking.job_id;
+                    logOffset = 0;
                     startPolling();
                 } else {
                     const error = await response.json();
@@ -980,7 +985,8 @@ HTML_TEMPLATE = '''
 
         stopBtn.addEventListener('click', async () => {
             try {
-                await fetch('/api/stop', { method: 'POST' });
+                if (!jobId) return;
+                await fetch(`/api/jobs/${jobId}/cancel`, { method: 'POST' });
                 stopBtn.textContent = '停止中...';
                 stopBtn.disabled = true;
             } catch (err) {
@@ -997,23 +1003,34 @@ HTML_TEMPLATE = '''
             statusBar.classList.remove('active');
         }
 
-        function startPolling() {
+        async function startPolling() {
+            try {
+                const settings = await (await fetch('/api/settings')).json();
+                geminiStatus.innerHTML = settings.has_gemini_key
+                    ? '<span style="color:#059669;">Gemini 辨識: 開啟</span>'
+                    : '<span style="color:#94A3B8;">Gemini 辨識: 關閉</span>';
+            } catch (err) {
+                console.error('Settings error:', err);
+            }
+
             pollInterval = setInterval(async () => {
                 try {
-                    const response = await fetch('/api/status');
-                    const status = await response.json();
-
-                    attemptCounter.textContent = `嘗試次數: ${status.attempt} / ${status.max_attempts}`;
-                    geminiStatus.innerHTML = status.gemini_enabled
-                        ? '<span style="color:#059669;">Gemini 辨識: 開啟</span>'
-                        : '<span style="color:#94A3B8;">Gemini 辨識: 關閉</span>';
+                    const status = await (await fetch(`/api/jobs/${jobId}`)).json();
+                    const info = status.info || {};
+                    attemptCounter.textContent = `嘗試次數: ${info.attempt || 0} / ${info.max_attempts || 50}`;
+                    if (status.position) {
+                        attemptCounter.textContent += ` (排隊中，前面還有 ${status.position} 筆)`;
+                    }
 
-                    logContent.innerHTML = status.logs.map(log =>
+                    // Only the lines added since the last poll
+                    const logs = await (await fetch(`/api/jobs/${jobId}/logs?offset=${logOffset}`)).json();
+                    logOffset = logs.offset;
+                    logContent.innerHTML += logs.logs.map(log =>
                         `<div class="log-line">${log}</div>`
                     ).join('');
                     logSection.scrollTop = logSection.scrollHeight;
 
-                    if (!status.running) {
+                    if (status.status !== 'queued' && status.status !== 'running') {
                         clearInterval(pollInterval);
                         resetUI();
 
@@ -1355,6 +1372,9 @@ def settings():
     if data.get('gemini_api_key'):
         GEMINI_API_KEY = data['gemini_api_key']
         os.environ['GEMINI_API_KEY'] = GEMINI_API_KEY
+        # The shared OCR service configured Gemini with the old key
+        from utils.ocr_service import set_gemini_api_key
+        set_gemini_api_key(GEMINI_API_KEY)
         updated.append('gemini_api_key')
 
     # Save to .env file for persistence
@@ -1383,89 +1403,132 @@ def settings():
     return jsonify({'success': True, 'updated': updated})
 
 
-@app.route('/api/book', methods=['POST'])
-@check_auth
-def start_booking():
-    global booking_status
-
-    if booking_status['running']:
-        return jsonify({'error': True, 'message': '訂票程序正在執行中'}), 400
+def submit_job(data: dict):
+    """Queue a booking job for the JSON body `data`; returns (job, error response)"""
+    if not isinstance(data, dict):
+        return None, (jsonify({'error': True, 'message': '請求格式錯誤'}), 400)
+    # Fair scheduling is per user: an explicit user, else the passenger ID, else the client address
+    user = str(data.get('user') or data.get('id') or request.remote_addr)
+    try:
+        priority = int(data.get('priority', 0))
+    except (TypeError, ValueError):
+        return None, (jsonify({'error': True, 'message': 'priority 必須是整數'}), 400)
+    try:
+        return job_queue.submit(data, user, priority), None
+    except QueueFull:
+        return None, (jsonify({'error': True, 'message': '排隊中的訂票工作已滿，請稍後再試'}), 429)
 
-    data = request.json
 
-    # Reset status
-    booking_status['running'] = True
-    booking_status['logs'] = []
-    booking_status['result'] = None
+def legacy_job(job_id):
+    """The job a single-job endpoint acts on: `job_id` if given, else the most recent one"""
+    return job_queue.get(job_id) if job_id else job_queue.latest
 
-    # Start booking in background thread
-    thread = threading.Thread(target=run_booking, args=(data,))
-    thread.daemon = True
-    thread.start()
-    booking_status['thread'] = thread
 
-    return jsonify({'success': True, 'message': 'Booking started'})
+@app.route('/api/book', methods=['POST'])
+@check_auth
+def start_booking():
+    job, error = submit_job(request.json)
+    if error:
+        return error
+    return jsonify({'success': True, 'message': 'Booking started', 'job_id': job.id})
 
 
 @app.route('/api/status')
 @check_auth
 def get_status():
+    """Status of ?job_id= (default: the most recent job), a single-job view of /api/jobs"""
+    job = legacy_job(request.args.get('job_id'))
     return jsonify({
-        'running': booking_status['running'],
-        'logs': booking_status['logs'][-100:],  # Last 100 lines
-        'result': booking_status['result'],
-        'attempt': booking_status['attempt'],
-        'max_attempts': booking_status['max_attempts'],
-        'gemini_enabled': bool(GEMINI_API_KEY)
+        'running': job is not None and job.status in (QUEUED, RUNNING),
+        'logs': job.to_dict(logs=100)['logs'] if job else [],  # Last 100 lines
+        'result': job.result if job else None,
+        'attempt': job.info.get('attempt', 0) if job else 0,
+        'max_attempts': job.info.get('max_attempts', 50) if job else 50,
+        'gemini_enabled': bool(GEMINI_API_KEY),
+        'job_id': job.id if job else None,
     })
 
 
 @app.route('/api/stop', methods=['POST'])
 @check_auth
 def stop_booking():
-    global booking_status
-    booking_status['stop_requested'] = True
+    """Cancel job_id (query or JSON body; default: the most recent job)"""
+    job = legacy_job(request.args.get('job_id') or (request.get_json(silent=True) or {}).get('job_id'))
+    if job is not None:
+        job_queue.cancel(job.id)
     return jsonify({'success': True, 'message': 'Stop requested'})
 
 
+@app.route('/api/jobs', methods=['GET', 'POST'])
+@check_auth
+def jobs():
+    if request.method == 'POST':
+        job, error = submit_job(request.json)
+        if error:
+            return error
+        return jsonify({'success': True, 'job': job.to_dict()}), 201
+
+    return jsonify({
+        'jobs': [job.to_dict() for job in job_queue.list_jobs(request.args.get('user'))],
+        'stats': job_queue.stats(),
+    })
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET', 'DELETE'])
+@check_auth
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': True, 'message': '找不到此訂票工作'}), 404
+    if request.method == 'DELETE':
+        job_queue.cancel(job_id)
+    status = job.to_dict(logs=100)
+    status['position'] = job_queue.position(job)
+    return jsonify(status)
+
+
+@app.route('/api/jobs/<job_id>/logs')
+@check_auth
+def job_logs(job_id):
+    """Log lines from ?offset= on; poll again with the returned offset"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': True, 'message': '找不到此訂票工作'}), 404
+    lines, offset = job.read_logs(request.args.get('offset', 0, type=int))
+    return jsonify({'logs': lines, 'offset': offset, 'status': job.status})
+
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+@check_auth
+def cancel_job(job_id):
+    if job_queue.get(job_id) is None:
+        return jsonify({'error': True, 'message': '找不到此訂票工作'}), 404
+    if not job_queue.cancel(job_id):
+        return jsonify({'error': True, 'message': '訂票工作已結束'}), 409
+    return jsonify({'success': True, 'message': 'Cancel requested'})
+
+
 class WebLogHandler(logging.Handler):
-    """Custom log handler to capture logs for web interface"""
+    """Routes records tagged with a job_id (see run_booking) into that job's logs"""
     def emit(self, record):
         try:
-            msg = self.format(record)
-            booking_status['logs'].append(msg)
+            job = job_queue.get(getattr(record, 'job_id', None))
+            if job is not None:
+                job.log(self.format(record))
         except Exception:
             pass
 
 
-def run_booking(data):
-    """Run the booking process in background with auto-retry"""
-    global booking_status
-    import time as time_module
-
-    # Setup logging
-    logger = logging.getLogger('THSRC')
-    logger.setLevel(logging.INFO)
-    handler = WebLogHandler()
-    handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s', '%H:%M:%S'))
-    logger.addHandler(handler)
-
-    max_attempts = int(data.get('max_attempts', 50))
-    retry_interval = int(data.get('retry_interval', 5))
-    booking_status['max_attempts'] = max_attempts
-
-    # Log OCR system status
-    if GEMINI_API_KEY:
-        logger.info("Dual OCR System: holey.cc + Gemini Vision (ENABLED)")
-    else:
-        logger.info("OCR System: holey.cc only (Set GEMINI_API_KEY for better accuracy)")
-
-    try:
-        # Update user_config.toml with form data
-        import rtoml
-        from pathlib import Path
+def booking_fields(data):
+    """
+    THSRC fields for one job: user_config.toml's overlaid with the form data.
+    The form is also saved back as the defaults for the next run.
+    """
+    import rtoml
+    from pathlib import Path
 
-        config_path = Path(__file__).parent / 'user_config.toml'
+    config_path = Path(__file__).parent / 'user_config.toml'
+    with config_lock:
         config = rtoml.load(config_path)
 
         # Update fields
@@ -1500,62 +1563,123 @@ def run_booking(data):
         # Save config
         rtoml.dump(config, config_path)
 
+    return config['fields']['THSRC']
+
+
+def run_booking(job):
+    """Run one booking job with auto-retry; returns 'SUCCESS' or None"""
+    data = job.data
+
+    # One shared logger; the job ID routes records to the job's logs (WebLogHandler)
+    logger = logging.LoggerAdapter(logging.getLogger('THSRC.jobs'), {'job_id': job.id})
+
+    max_attempts = int(data.get('max_attempts', 50))
+    retry_interval = int(data.get('retry_interval', 5))
+    race_sessions = max(1, int(data.get('race_sessions', 1)))
+    job.info.update({'attempt': 0, 'max_attempts': max_attempts, 'race_sessions': race_sessions})
+
+    # Log OCR system status
+    if GEMINI_API_KEY:
+        logger.info("Dual OCR System: holey.cc + Gemini Vision (ENABLED)")
+    else:
+        logger.info("OCR System: holey.cc only (Set GEMINI_API_KEY for better accuracy)")
+
+    driver_pool = None
+    result = None
+    try:
+        trip_fields = booking_fields(data)
+
         logger.info(f"Booking: {data.get('start_station')} -> {data.get('dest_station')}")
         logger.info(f"Date: {data.get('outbound_date')} {data.get('outbound_time')}")
         logger.info(f"Auto-retry enabled: Max {max_attempts} attempts, {retry_interval}s interval")
 
         # Import booking modules
         from services.thsrc import THSRC
+        from services.base_service import driver_options
+        from services.driver_pool import DriverPool
+        from services.race import BookingRace, Race, RaceCancelled
         from utils.io import load_toml
         from configs.config import filenames
 
+        service_config = load_toml(str(filenames.config).format(service='THSRC'))
+        lean = bool(data.get('lean', False))
+
+        # Keep Chrome warm across attempts instead of cold-starting it every retry
+        # (one driver per racing session)
+        driver_pool = DriverPool(size=race_sessions, logger=logger, **driver_options(service_config, lean))
+        driver_pool.prewarm()
+
         class Args:
             def __init__(self):
                 self.log = logger
-                self.config = load_toml(str(filenames.config).format(service='THSRC'))
+                self.config = service_config
                 self.service = 'THSRC'
+                self.fields = trip_fields
                 self.locale = 'zh-TW'
                 self.auto = True
                 self.list = False
                 self.proxy = None
+                self.lean = lean
+                self.driver_pool = driver_pool
 
         # Auto-retry loop
         for attempt in range(1, max_attempts + 1):
-            if booking_status['stop_requested']:
+            if job.cancelled:
                 logger.info("Booking stopped by user")
                 break
 
-            booking_status['attempt'] = attempt
+            job.info['attempt'] = attempt
             logger.info(f"\n{'='*50}")
             logger.info(f"AUTO-RETRY ATTEMPT {attempt}/{max_attempts}")
             logger.info(f"{'='*50}")
 
+            # Cancelling the job stops the attempt's sessions at their next checkpoint
+            race = Race()
+            job.on_cancel(race.cancel)
+
+            thsrc = None
             try:
                 args = Args()
+                if race_sessions > 1:
+                    report = BookingRace(THSRC, args, race_sessions, logger, race=race).run()
+                    if report['winner'] is not None:
+                        logger.info("Booking completed successfully!")
+                        result = 'SUCCESS'
+                        break
+                    raise RuntimeError(f"no session of {race_sessions} booked")
+
+                args.race = race
                 thsrc = THSRC(args)
                 thsrc.main()
 
                 # If we get here without exception, booking was successful
                 logger.info("Booking completed successfully!")
-                booking_status['result'] = 'SUCCESS'
+                result = 'SUCCESS'
+                break
+
+            except RaceCancelled:
+                logger.info("Booking stopped by user")
                 break
 
             except SystemExit as e:
                 if e.code == 0:
                     logger.info("Booking completed successfully!")
-                    booking_status['result'] = 'SUCCESS'
+                    result = 'SUCCESS'
                     break
                 else:
                     logger.warning(f"Attempt {attempt} failed (exit code: {e.code})")
-                    if attempt < max_attempts and not booking_status['stop_requested']:
-                        logger.info(f"Waiting {retry_interval}s before next attempt...")
-                        time_module.sleep(retry_interval)
 
             except Exception as e:
                 logger.warning(f"Attempt {attempt} error: {str(e)}")
-                if attempt < max_attempts and not booking_status['stop_requested']:
-                    logger.info(f"Waiting {retry_interval}s before next attempt...")
-                    time_module.sleep(retry_interval)
+
+            finally:
+                # Hand the driver back to the pool (reset, not quit) before waiting
+                if thsrc is not None:
+                    thsrc.close()
+
+            if attempt < max_attempts and not job.cancelled:
+                logger.info(f"Waiting {retry_interval}s before next attempt...")
+                job.cancel_event.wait(retry_interval)
 
         else:
             logger.error(f"All {max_attempts} attempts failed. Please try again later.")
@@ -1564,11 +1688,20 @@ def run_booking(data):
         logger.error(f"Booking error: {str(e)}")
         import traceback
         logger.error(traceback.format_exc())
+        raise
     finally:
-        booking_status['running'] = False
-        booking_status['stop_requested'] = False
-        booking_status['attempt'] = 0
-        logger.removeHandler(handler)
+        if driver_pool is not None:
+            logger.info(f"Driver pool stats: {driver_pool.stats()}")
+            driver_pool.close()
+
+    return result
+
+
+job_queue = JobQueue(run_booking, workers=BOOKING_WORKERS, max_pending=MAX_PENDING_JOBS)
+web_log_handler = WebLogHandler()
+web_log_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s', '%H:%M:%S'))
+logging.getLogger('THSRC').setLevel(logging.INFO)
+logging.getLogger('THSRC').addHandler(web_log_handler)
 
 
 if __name__ == '__main__':